@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import astropy.units as u
+
+from lsst.validate.drp.calcsrd.amx import (AMxObjectArrays,
+                                           calcRmsDistancesMultiAnnulus)
+from lsst.validate.drp.groupedarrays import GroupedArrays
+
+description = """
+Time the AMx pair evaluation on synthetic matched sources with a growing
+number of worker processes, and check that every number of workers gives
+the same RMS distances.
+
+Prints one row per number of workers: the wall-clock time, the speedup over
+a single process and the parallel efficiency (speedup / workers).
+
+Example call:
+benchmarkAMxWorkers.py --nObjects 20000 --workers 1 2 4 8
+"""
+
+
+def makeMatches(nObjects, nVisits, fieldSize, seed):
+    """Synthetic matched sources of stars detected in random visits.
+
+    Parameters
+    ----------
+    nObjects : `int`
+        Number of stars.
+    nVisits : `int`
+        Number of visits; each star is detected in 2 to ``nVisits`` of them.
+    fieldSize : `float`
+        Side of the square field over which the stars are spread [degrees].
+    seed : `int`
+        Seed of the random positions, visits and magnitudes.
+
+    Returns
+    -------
+    matches : `lsst.validate.drp.groupedarrays.GroupedArrays`
+    """
+    np.random.seed(seed)
+    counts = np.random.randint(2, nVisits + 1, nObjects)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    index = np.repeat(np.arange(nObjects), counts)
+    ra0 = np.deg2rad(10 + fieldSize*np.random.uniform(-0.5, 0.5, nObjects))
+    dec0 = np.deg2rad(20 + fieldSize*np.random.uniform(-0.5, 0.5, nObjects))
+    columns = {'coord_ra': ra0[index] + 5e-8*np.random.randn(len(index)),
+               'coord_dec': dec0[index] + 5e-8*np.random.randn(len(index)),
+               'visit': np.concatenate([np.random.choice(nVisits, n, replace=False)
+                                        for n in counts]),
+               'base_PsfFlux_mag': np.random.uniform(17, 22, nObjects)[index]}
+    return GroupedArrays(offsets, columns)
+
+
+def benchmark(objectArrays, annuli, magRange, workers, chunkSize):
+    """Time `calcRmsDistancesMultiAnnulus` for each number of workers.
+
+    Returns
+    -------
+    times : `list` of `float`
+        Wall-clock time of each number of workers [seconds].
+    """
+    times = []
+    reference = None
+    for nWorkers in workers:
+        objectArrays.rmsDistanceCache.clear()
+        start = time.time()
+        rmsDistances = calcRmsDistancesMultiAnnulus(objectArrays, annuli, magRange,
+                                                    nWorkers=nWorkers,
+                                                    chunkSize=chunkSize)
+        times.append(time.time() - start)
+        if reference is None:
+            reference = rmsDistances
+        for expected, observed in zip(reference, rmsDistances):
+            if not np.array_equal(expected.value, observed.value):
+                raise RuntimeError('RMS distances with {0:d} workers differ from those '
+                                   'with {1:d}.'.format(nWorkers, workers[0]))
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nObjects', type=int, default=20000,
+                        help='Number of synthetic stars.')
+    parser.add_argument('--nVisits', type=int, default=10,
+                        help='Number of visits.')
+    parser.add_argument('--fieldSize', type=float, default=1.,
+                        help='Side of the field [degrees].')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='Numbers of worker processes to time; 1 and powers '
+                             'of 2 up to the number of cores by default.')
+    parser.add_argument('--chunkSize', type=int, default=1000,
+                        help='Number of first objects of pairs per task.')
+    parser.add_argument('--seed', type=int, default=2468,
+                        help='Seed of the synthetic stars.')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers is None:
+        nCores = multiprocessing.cpu_count()
+        workers = [1] + [2**i for i in range(1, nCores.bit_length())]
+        if workers[-1] != nCores:
+            workers.append(nCores)
+
+    matches = makeMatches(args.nObjects, args.nVisits, args.fieldSize, args.seed)
+    objectArrays = AMxObjectArrays.fromGroupView(matches)
+    # AM1 and AM2 annuli
+    annuli = [np.array([4., 6.])*u.arcmin, np.array([19., 21.])*u.arcmin]
+    magRange = np.array([17., 21.5])*u.mag
+
+    times = benchmark(objectArrays, annuli, magRange, workers, args.chunkSize)
+    print('{0:d} objects, {1:d} visits, {2:d} cores'.format(
+        args.nObjects, args.nVisits, multiprocessing.cpu_count()))
+    print('{0:>8s} {1:>9s} {2:>8s} {3:>10s}'.format('workers', 'time [s]', 'speedup',
+                                                   'efficiency'))
+    for nWorkers, seconds in zip(workers, times):
+        speedup = times[0]/seconds
+        print('{0:8d} {1:9.2f} {2:8.2f} {3:10.2f}'.format(nWorkers, seconds, speedup,
+                                                         speedup/nWorkers))
@@ -0,0 +1,206 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Astrometric repeatability (the AMx statistic) resolved by the CCDs of
+the pairs of stars.
+"""
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import astropy.units as u
+
+from lsst.validate.base import BlobBase
+
+from .calcsrd.amx import (AMxObjectArrays, iterRmsDistanceChunks,
+                          radiansToMilliarcsec)
+from .groupedarrays import GroupedArrays
+from .util import quantityValues
+
+
+__all__ = ['AMxCcdMap']
+
+
+class AMxCcdMap(BlobBase):
+    """Serializable median RMS distance of the pairs of stars in an annulus,
+    for each pair of CCDs and for each CCD.
+
+    Each star is assigned the CCD on which it was most often detected, and
+    each pair the CCDs of its two stars. The RMS distances of the pairs are
+    reduced by CCD pair with grouped (sort and `numpy.bincount`)
+    reductions, so a CCD or a region of the focal plane that degrades AMx
+    stands out in the maps.
+
+    The pairs are enumerated here unless ``rmsDistances`` and ``pairs``
+    are given. `makeAMxMeasurements` passes those of its own pass over
+    pairs, so that the map costs no second pass when it is made with the
+    AMx measurements.
+
+    Parameters
+    ----------
+    matchedMultiVisitDataset : `MatchedMultiVisitDataset`
+        A dataset containing matched statistics for stars across multiple
+        visits.
+    annulus : `astropy.units.Quantity`, optional
+        Inner and outer separation of the pairs of stars. Default: 4 to 6
+        arcmin, as for AM1.
+    magRange : 2-element `list`, `tuple`, or `numpy.ndarray`, optional
+        brighter, fainter limits of the magnitude range to include.
+        Default: ``[17.0, 21.5]`` mag, as for `AMxMeasurement`.
+    nWorkers : `int`, optional
+        Number of processes over which to split the pairs of stars.
+    objectArrays : `AMxObjectArrays`, optional
+        Arrays extracted from ``matchedMultiVisitDataset.safeMatches`` with
+        the CCD of each object, if already computed.
+    verbose : `bool`, optional
+        Output additional information on the analysis steps.
+    rmsDistances : `astropy.units.Quantity`, optional
+        RMS distances of the pairs of stars in ``annulus``, if already
+        computed (see `calcRmsDistancesByFirstObject`).
+    pairs : 2-`tuple` of `numpy.ndarray`, optional
+        First and second star of each of ``rmsDistances``, among the
+        objects of ``objectArrays`` in ``magRange``.
+
+    Attributes
+    ----------
+    magRange : `astropy.units.Quantity`
+        Magnitude range of the stars.
+    annulus : `astropy.units.Quantity`
+        Inner and outer separation of the pairs of stars.
+    ccds : `astropy.units.Quantity`
+        Identifiers of the CCDs, which index the rows and columns of the
+        matrices.
+    nPairs : `astropy.units.Quantity`
+        Number of pairs of stars on each pair of CCDs (symmetric matrix).
+    medianRms : `astropy.units.Quantity`
+        Median RMS distance of the pairs of stars on each pair of CCDs
+        (symmetric matrix, NaN where there are no pairs).
+    ccdNPairs : `astropy.units.Quantity`
+        Number of pairs with at least one star on each CCD.
+    ccdMedianRms : `astropy.units.Quantity`
+        Median RMS distance of the pairs with at least one star on each
+        CCD.
+    """
+
+    name = 'AMxCcdMap'
+
+    def __init__(self, matchedMultiVisitDataset, annulus=None, magRange=None,
+                 nWorkers=1, objectArrays=None, verbose=False,
+                 rmsDistances=None, pairs=None):
+        BlobBase.__init__(self)
+
+        self.register_datum(
+            'magRange',
+            label='Mag range',
+            description='Stellar magnitude selection range')
+        self.register_datum(
+            'annulus',
+            label='annulus radii',
+            description='Inner and outer radii of selection annulus')
+        self.register_datum(
+            'ccds',
+            label='CCD',
+            description='Identifiers of the CCDs')
+        self.register_datum(
+            'nPairs',
+            label='N(pairs)',
+            description='Number of pairs of stars on each pair of CCDs')
+        self.register_datum(
+            'medianRms',
+            label='AMx',
+            description='Median RMS distance of the pairs of stars on each '
+                        'pair of CCDs')
+        self.register_datum(
+            'ccdNPairs',
+            label='N(pairs)',
+            description='Number of pairs of stars with a star on each CCD')
+        self.register_datum(
+            'ccdMedianRms',
+            label='AMx',
+            description='Median RMS distance of the pairs of stars with a '
+                        'star on each CCD')
+
+        if annulus is None:
+            annulus = np.array([4., 6.]) * u.arcmin
+        elif not isinstance(annulus, u.Quantity):
+            annulus = np.asarray(annulus, dtype=float) * u.arcmin
+        if magRange is None:
+            magRange = np.array([17.0, 21.5]) * u.mag
+        elif not isinstance(magRange, u.Quantity):
+            magRange = np.array(magRange) * u.mag
+
+        if objectArrays is None or objectArrays.ccds is None:
+            objectArrays = AMxObjectArrays.fromGroupView(
+                matchedMultiVisitDataset.safeMatches,
+                ccdKey=matchedMultiVisitDataset.ccdKey)
+        # The pairs index the objects in the magnitude range
+        ccds = objectArrays.ccds[objectArrays.magRangeSelection(magRange)]
+        ccdValues, ccdIndex = np.unique(ccds, return_inverse=True)
+        nCcds = len(ccdValues)
+
+        if rmsDistances is not None and pairs is not None:
+            rmsDistances = quantityValues(rmsDistances, u.marcsec)
+            first, second = ccdIndex[pairs[0]], ccdIndex[pairs[1]]
+        else:
+            empty = np.zeros(0, dtype=np.int64)
+            rmsDistances, first, second = [np.zeros(0)], [empty], [empty]
+            for chunkRms, chunkPairs in iterRmsDistanceChunks(
+                    objectArrays, [annulus], magRange, verbose=verbose,
+                    nWorkers=nWorkers, withPairs=True):
+                obj1, obj2 = chunkPairs[0]
+                rmsDistances.append(radiansToMilliarcsec(chunkRms[0]))
+                first.append(ccdIndex[obj1])
+                second.append(ccdIndex[obj2])
+            rmsDistances = np.concatenate(rmsDistances)
+            first, second = np.concatenate(first), np.concatenate(second)
+
+        # Unordered pairs of CCDs, then both triangles of the matrices
+        low, high = np.minimum(first, second), np.maximum(first, second)
+        nPairs, medianRms = self._groupedMedians(low*nCcds + high,
+                                                 rmsDistances, nCcds**2)
+        nPairs = nPairs.reshape(nCcds, nCcds)
+        medianRms = medianRms.reshape(nCcds, nCcds)
+        lower = np.tril_indices(nCcds, -1)
+        nPairs[lower] = nPairs.T[lower]
+        medianRms[lower] = medianRms.T[lower]
+
+        # Each pair counts once for each of its CCDs
+        otherCcd = first != second
+        ccdNPairs, ccdMedianRms = self._groupedMedians(
+            np.concatenate([first, second[otherCcd]]),
+            np.concatenate([rmsDistances, rmsDistances[otherCcd]]), nCcds)
+
+        self.magRange = magRange
+        self.annulus = annulus
+        self.ccds = ccdValues * u.Unit('')
+        self.nPairs = nPairs * u.Unit('')
+        self.medianRms = medianRms * u.marcsec
+        self.ccdNPairs = ccdNPairs * u.Unit('')
+        self.ccdMedianRms = ccdMedianRms * u.marcsec
+
+    @staticmethod
+    def _groupedMedians(labels, values, nGroups):
+        """Number and median of ``values`` with each of ``nGroups``
+        ``labels``.
+        """
+        counts = np.bincount(labels, minlength=nGroups)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        order = np.argsort(labels, kind='mergesort')
+        grouped = GroupedArrays(offsets, {'rms': values[order]})
+        return counts, grouped.groupMedian('rms')
@@ -0,0 +1,179 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Astrometric repeatability (the AMx statistic) as a function of the
+separation of pairs of stars, evaluated in a single pass over pairs.
+"""
+
+from __future__ import print_function, absolute_import
+from builtins import range
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from lsst.validate.base import BlobBase
+
+from .calcsrd.amx import calcRmsDistanceSketches
+
+
+__all__ = ['AMxProfile']
+
+
+class AMxProfile(BlobBase):
+    """Serializable median and percentiles of the RMS distance of pairs of
+    stars in bins of separation.
+
+    Every pair of stars up to the outermost bin edge is enumerated once and
+    assigned to its separation bin, so the whole profile costs about as much
+    as AM3 alone. The per-pair RMS distances are accumulated in a
+    `LogQuantileSketch` for each bin rather than kept, so memory use does
+    not grow with the number of pairs; percentiles are resolved to 0.25%.
+
+    A bin from ``D - width/2`` to ``D + width/2`` gives AMx for that ``D``
+    (to this resolution), so AM1, AM2 and AM3 are special cases of the
+    profile.
+
+    Parameters
+    ----------
+    matchedMultiVisitDataset : `MatchedMultiVisitDataset`
+        A dataset containing matched statistics for stars across multiple
+        visits.
+    binEdges : `astropy.units.Quantity`, optional
+        Increasing edges of the separation bins. Default: 20 logarithmic
+        bins from 1 to 300 arcmin.
+    magRange : 2-element `list`, `tuple`, or `numpy.ndarray`, optional
+        brighter, fainter limits of the magnitude range to include.
+        Default: ``[17.0, 21.5]`` mag, as for `AMxMeasurement`.
+    percentiles : `list` of `float`, optional
+        Percentiles of the RMS distance to compute in each bin, besides the
+        median.
+    nWorkers : `int`, optional
+        Number of processes over which to split the pairs of stars.
+    objectArrays : `AMxObjectArrays`, optional
+        Arrays extracted from ``matchedMultiVisitDataset.safeMatches``, if
+        already computed (e.g., for the AMx measurements).
+    verbose : `bool`, optional
+        Output additional information on the analysis steps.
+
+    Attributes
+    ----------
+    magRange : `astropy.units.Quantity`
+        Magnitude range of the stars.
+    innerRadius, outerRadius : `astropy.units.Quantity`
+        Inner and outer radii of each separation bin.
+    separation : `astropy.units.Quantity`
+        Geometric mean of the radii of each bin.
+    nPairs : `astropy.units.Quantity`
+        Number of pairs of stars in each bin.
+    medianRms : `astropy.units.Quantity`
+        Median RMS distance of the pairs in each bin (AMx).
+    percentiles : `astropy.units.Quantity`
+        Percentiles of ``percentileRms``.
+    percentileRms : `astropy.units.Quantity`
+        Percentiles of the RMS distance of the pairs in each bin.
+        Shape: ``(nBins, len(percentiles))``.
+    """
+
+    name = 'AMxProfile'
+
+    def __init__(self, matchedMultiVisitDataset, binEdges=None, magRange=None,
+                 percentiles=(10., 25., 75., 90.), nWorkers=1,
+                 objectArrays=None, verbose=False):
+        BlobBase.__init__(self)
+
+        self.register_datum(
+            'magRange',
+            label='Mag range',
+            description='Stellar magnitude selection range')
+        self.register_datum(
+            'innerRadius',
+            label='Inner radius',
+            description='Inner radius of each separation bin')
+        self.register_datum(
+            'outerRadius',
+            label='Outer radius',
+            description='Outer radius of each separation bin')
+        self.register_datum(
+            'separation',
+            label='D',
+            description='Geometric mean separation of each bin')
+        self.register_datum(
+            'nPairs',
+            label='N(pairs)',
+            description='Number of pairs of stars in each separation bin')
+        self.register_datum(
+            'medianRms',
+            label='AMx',
+            description='Median RMS distance of the pairs of stars in each '
+                        'separation bin')
+        self.register_datum(
+            'percentiles',
+            label='Percentiles',
+            description='Percentiles of the RMS distance')
+        self.register_datum(
+            'percentileRms',
+            label='RMS percentiles',
+            description='Percentiles of the RMS distance of the pairs of '
+                        'stars in each separation bin')
+
+        if binEdges is None:
+            binEdges = np.logspace(0, np.log10(300.), 21) * u.arcmin
+        elif not isinstance(binEdges, u.Quantity):
+            binEdges = np.asarray(binEdges, dtype=float) * u.arcmin
+        if magRange is None:
+            magRange = np.array([17.0, 21.5]) * u.mag
+        elif not isinstance(magRange, u.Quantity):
+            magRange = np.array(magRange) * u.mag
+
+        if objectArrays is None:
+            objectArrays = matchedMultiVisitDataset.safeMatches
+        annuli = [binEdges[i:i + 2] for i in range(len(binEdges) - 1)]
+        sketches, _ = calcRmsDistanceSketches(objectArrays, annuli, magRange,
+                                              maxStoredPairs=0,
+                                              verbose=verbose,
+                                              nWorkers=nWorkers)
+
+        percentiles = np.asarray(percentiles, dtype=float)
+        allPercentiles = np.concatenate([[50.], percentiles])
+        rms = np.array([sketch.percentile(allPercentiles)
+                        for sketch in sketches]).reshape(len(annuli),
+                                                         len(allPercentiles))
+
+        self.magRange = magRange
+        self.innerRadius = binEdges[:-1]
+        self.outerRadius = binEdges[1:]
+        self.separation = np.sqrt(binEdges[:-1]*binEdges[1:])
+        self.nPairs = np.array([sketch.count for sketch in sketches]) * u.Unit('')
+        self.medianRms = rms[:, 0] * u.marcsec
+        self.percentiles = percentiles * u.Unit('')
+        self.percentileRms = rms[:, 1:] * u.marcsec
+
+    @property
+    def table(self):
+        """`astropy.table.Table` of the profile, one row per separation
+        bin.
+        """
+        columns = [self.innerRadius, self.outerRadius, self.nPairs,
+                   self.medianRms]
+        names = ['innerRadius', 'outerRadius', 'nPairs', 'medianRms']
+        for i, p in enumerate(self.percentiles.value):
+            columns.append(self.percentileRms[:, i])
+            names.append('rmsP{0:g}'.format(p))
+        return Table(columns, names=names)
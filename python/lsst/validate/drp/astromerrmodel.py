@@ -28,6 +28,8 @@ from scipy.optimize import curve_fit
 
 from lsst.validate.base import BlobBase
 
+from .util import quantityValues
+
 
 __all__ = ['astromErrModel', 'fitAstromErrModel', 'AstrometricErrorModel']
 
@@ -164,13 +166,17 @@ class AstrometricErrorModel(BlobBase):
             brightSnr, medianRef, matchRef)
 
     def _compute(self, snr, dist, nMatch, brightSnr, medianRef, matchRef):
-        median_dist = np.median(dist)
+        # Select and fit on the plain arrays behind the dataset's datums
+        snr = quantityValues(snr, u.Unit(''))
+        dist = quantityValues(dist, u.marcsec)
+
+        median_dist = np.median(dist) * u.marcsec
         msg = 'Median value of the astrometric scatter - all magnitudes: ' \
               '{0:.3f}'
         print(msg.format(median_dist))
 
-        bright = np.where(snr > brightSnr)
-        astromScatter = np.median(dist[bright])
+        bright = np.where(snr > quantityValues(brightSnr, u.Unit('')))
+        astromScatter = np.median(dist[bright]) * u.marcsec
         msg = 'Astrometric scatter (median) - snr > {0:.1f} : {1:.1f}'
         print(msg.format(brightSnr, astromScatter))
 
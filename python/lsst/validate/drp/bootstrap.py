@@ -0,0 +1,267 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Bootstrap confidence intervals of statistics of values that come in
+clusters (e.g., the pairs of stars that share an object, or the pairs of
+visits of a star), vectorized over the bootstrap replicates.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object, range
+
+import numpy as np
+
+
+__all__ = ['ClusterBootstrap', 'bootstrapCounts', 'percentileInterval']
+
+
+def bootstrapCounts(nClusters, nBootstrap=100, seed=None):
+    """Number of times each cluster is drawn, with replacement, in each
+    bootstrap replicate.
+
+    Parameters
+    ----------
+    nClusters : `int`
+        Number of clusters.
+    nBootstrap : `int`, optional
+        Number of bootstrap replicates.
+    seed : `int`, optional
+        Seed of the random number generator.
+
+    Returns
+    -------
+    counts : `numpy.ndarray`
+        Shape: ``(nBootstrap, nClusters)``. Each row sums to ``nClusters``.
+    """
+    rng = np.random.RandomState(seed)
+    draws = rng.randint(0, max(nClusters, 1), size=(nBootstrap, nClusters))
+    draws += nClusters*np.arange(nBootstrap)[:, np.newaxis]
+    return np.bincount(draws.ravel(), minlength=nBootstrap*nClusters).reshape(
+        nBootstrap, nClusters)
+
+
+def percentileInterval(replicates, confidence=0.95):
+    """Percentile bootstrap confidence interval.
+
+    Parameters
+    ----------
+    replicates : `numpy.ndarray`
+        Values of a statistic, one per bootstrap replicate along the first
+        axis.
+    confidence : `float`, optional
+        Confidence level of the interval.
+
+    Returns
+    -------
+    interval : `numpy.ndarray`
+        Lower and upper bounds along the first axis (NaN if all the
+        replicates are NaN).
+    """
+    alpha = 100*(1 - confidence)/2
+    replicates = np.asarray(replicates, dtype=float)
+    finite = np.isfinite(replicates).any(axis=0)
+    interval = np.full((2,) + replicates.shape[1:], np.nan)
+    if np.all(finite):
+        interval[...] = np.nanpercentile(replicates, [alpha, 100 - alpha], axis=0)
+    elif np.any(finite):
+        interval[:, finite] = np.nanpercentile(replicates[:, finite],
+                                               [alpha, 100 - alpha], axis=0)
+    return interval
+
+
+class ClusterBootstrap(object):
+    """Bootstrap replicates of the percentiles and tail fractions of values
+    that come in clusters.
+
+    Whole clusters are resampled with replacement, so the correlation of
+    the values within a cluster is accounted for. A replicate is described
+    by the number of times each cluster was drawn, which weights the values
+    of the cluster; the values are sorted once, and each statistic of all
+    the replicates is computed with array operations on them, without
+    copying the resampled values.
+
+    Parameters
+    ----------
+    values : `numpy.ndarray`
+        Values, or several samples of values (rows) that share their
+        clusters, e.g. the random samples of PA1.
+    clusters : `numpy.ndarray`
+        Cluster of each value (column), between 0 and the number of
+        clusters.
+    counts : `numpy.ndarray`
+        Number of times each cluster is drawn in each replicate, from
+        `bootstrapCounts`.
+    weights : `numpy.ndarray`, optional
+        Weight of each of ``values``, which multiplies its count.
+        Percentiles are then computed as by
+        `lsst.validate.drp.util.weightedPercentile`, rather than as by
+        `numpy.percentile` of the resampled values.
+    """
+
+    def __init__(self, values, clusters, counts, weights=None):
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        clusters = np.asarray(clusters, dtype=np.int64)
+        order = np.argsort(values, axis=-1, kind='mergesort')
+        rows = np.arange(len(values))[:, np.newaxis]
+        self.values = values[rows, order]
+        self.clusters = clusters[order]
+        self.counts = np.asarray(counts)
+        self.weights = None
+        if weights is not None:
+            weights = np.broadcast_to(np.asarray(weights, dtype=float),
+                                      values.shape)
+            self.weights = weights[rows, order]
+
+    @classmethod
+    def fromLabels(cls, values, labels, nBootstrap=100, seed=None,
+                   weights=None):
+        """Resample values by arbitrary cluster labels.
+
+        Parameters
+        ----------
+        values, weights
+            As for `ClusterBootstrap`.
+        labels : `numpy.ndarray`
+            Cluster label of each value (column), e.g. an object index.
+        nBootstrap : `int`, optional
+            Number of bootstrap replicates.
+        seed : `int`, optional
+            Seed of the resampling (see `bootstrapCounts`).
+
+        Returns
+        -------
+        bootstrap : `ClusterBootstrap`
+        """
+        uniqueLabels, clusters = np.unique(labels, return_inverse=True)
+        counts = bootstrapCounts(len(uniqueLabels), nBootstrap, seed)
+        return cls(values, clusters.reshape(np.shape(labels)), counts, weights)
+
+    @property
+    def nBootstrap(self):
+        """Number of replicates (`int`)."""
+        return len(self.counts)
+
+    def _replicateWeights(self, replicate):
+        weights = self.counts[replicate][self.clusters]
+        if self.weights is not None:
+            weights = weights*self.weights
+        return weights
+
+    def percentile(self, percentiles):
+        """Percentiles of each sample, in each replicate.
+
+        Parameters
+        ----------
+        percentiles : `float` or sequence of `float`
+            Percentiles to compute, between 0 and 100.
+
+        Returns
+        -------
+        replicates : `numpy.ndarray`
+            Shape: ``(nBootstrap, nSamples)``, then the shape of
+            ``percentiles``. NaN where a replicate has no weight.
+        """
+        quantiles = np.asarray(percentiles, dtype=float)/100.
+        nRows, nValues = self.values.shape
+        result = np.full((self.nBootstrap, nRows, quantiles.size), np.nan)
+        if nValues == 0:
+            return result.reshape((self.nBootstrap, nRows) + quantiles.shape)
+        flatValues = self.values.ravel()
+        rowStart = nValues*np.arange(nRows)[:, np.newaxis]
+
+        for replicate in range(self.nBootstrap):
+            weights = self._replicateWeights(replicate)
+            cumulative = np.cumsum(weights, axis=-1)
+            totals = cumulative[:, -1:]
+            valid = totals[:, 0] > 0
+            # Offset the rows so that their cumulative weights are sorted
+            # together, and search all of them at once
+            if self.weights is None:
+                rowOffset = 2*np.maximum(totals.max(), 1.)*np.arange(nRows)[:, np.newaxis]
+                # numpy.percentile of the resampled values: rank k is the
+                # first value whose cumulative count exceeds k
+                key = (cumulative + rowOffset).ravel()
+                rank = quantiles*(totals - 1)
+                lower = np.floor(rank)
+                below = flatValues[np.minimum(
+                    np.searchsorted(key, lower + rowOffset, side='right'),
+                    rowStart + nValues - 1)]
+                above = flatValues[np.minimum(
+                    np.searchsorted(key, lower + 1 + rowOffset, side='right'),
+                    rowStart + nValues - 1)]
+                values = below + (rank - lower)*(above - below)
+            else:
+                # Percentiles as by weightedPercentile: interpolate between
+                # the midpoints of the shares of the values drawn; values of
+                # clusters not drawn sit at the boundaries of the shares,
+                # which keeps the midpoints sorted, but are skipped
+                drawn = weights > 0
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    midpoints = np.nan_to_num(
+                        (cumulative - 0.5*weights)/totals).ravel()
+                key = midpoints + 2*np.repeat(np.arange(nRows), nValues)
+                position = np.searchsorted(
+                    key, quantiles + 2*np.arange(nRows)[:, np.newaxis])
+                flatIndex = np.arange(nRows*nValues)
+                lastDrawn = np.maximum.accumulate(
+                    np.where(drawn.ravel(), flatIndex, -1))
+                nextDrawn = np.minimum.accumulate(
+                    np.where(drawn.ravel(), flatIndex, nRows*nValues)[::-1])[::-1]
+                before = lastDrawn[np.maximum(position - 1, 0)]
+                after = nextDrawn[np.minimum(position, nRows*nValues - 1)]
+                hasBefore = (position > rowStart) & (before >= rowStart)
+                hasAfter = (position < rowStart + nValues) & (after < rowStart + nValues)
+                lower = np.where(hasBefore, before, after)
+                upper = np.where(hasAfter, after, lower)
+                lower = np.clip(lower, rowStart, rowStart + nValues - 1)
+                upper = np.clip(upper, rowStart, rowStart + nValues - 1)
+                span = midpoints[upper] - midpoints[lower]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    fraction = np.where(span > 0, (quantiles - midpoints[lower])/span, 0.)
+                values = (flatValues[lower] +
+                          fraction*(flatValues[upper] - flatValues[lower]))
+            result[replicate][valid] = values[valid]
+        return result.reshape((self.nBootstrap, nRows) + quantiles.shape)
+
+    def fractionAbove(self, threshold):
+        """Fraction of the values of each sample larger than ``threshold``
+        (weighted, if there are weights), in each replicate.
+
+        Parameters
+        ----------
+        threshold : `float`
+
+        Returns
+        -------
+        replicates : `numpy.ndarray`
+            Shape: ``(nBootstrap, nSamples)``. NaN where a replicate has no
+            weight.
+        """
+        nClusters = self.counts.shape[1]
+        weights = np.ones(self.values.shape) if self.weights is None else self.weights
+        above = np.zeros((len(self.values), nClusters))
+        total = np.zeros((len(self.values), nClusters))
+        for row in range(len(self.values)):
+            total[row] = np.bincount(self.clusters[row], weights=weights[row],
+                                     minlength=nClusters)
+            above[row] = np.bincount(self.clusters[row],
+                                     weights=weights[row]*(self.values[row] > threshold),
+                                     minlength=nClusters)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.dot(self.counts, above.T) / np.dot(self.counts, total.T)
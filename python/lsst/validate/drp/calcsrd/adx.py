@@ -20,10 +20,11 @@
 
 from __future__ import print_function, absolute_import
 
-import numpy as np
 import astropy.units as u
 
 from lsst.validate.base import MeasurementBase
+from ..bootstrap import percentileInterval
+from ..util import quantityValues
 
 
 class ADxMeasurement(MeasurementBase):
@@ -130,10 +131,22 @@ class ADxMeasurement(MeasurementBase):
             # No more than AFx of values will deviate by more than the
             # AMx (50th) + AFx percentiles
             # To compute ADx, use measured AMx and spec for AFx.
-            afxAtPercentile = np.percentile(
-                amx.rmsDistMas.to(u.marcsec),
-                100. - self.AFx) * u.marcsec
+            # Sorted once per AMx (or sketched), for every spec level
+            afxAtPercentile = amx.rmsDistribution.percentile(
+                100. - quantityValues(self.AFx, u.Unit(''))) * u.marcsec
             self.quantity = afxAtPercentile - amx.quantity
+
+            if amx.bootstrap is not None:
+                # Every resampling of the pairs at once
+                self.register_extra(
+                    'interval', label='ADx CI',
+                    description='Bootstrap 95% confidence interval on ADx, '
+                                'resampling the pairs by first object, for '
+                                'a fixed AMx')
+                amxMas = quantityValues(amx.quantity, u.marcsec)
+                replicates = amx.bootstrap.percentile(
+                    100. - quantityValues(self.AFx, u.Unit('')))[:, 0]
+                self.interval = percentileInterval(replicates - amxMas) * u.marcsec
         else:
             # FIXME previously would raise ValidateErrorNoStars
             self.quantity = None
@@ -20,10 +20,11 @@
 
 from __future__ import print_function, absolute_import
 
-import numpy as np
 import astropy.units as u
 
 from lsst.validate.base import MeasurementBase
+from ..bootstrap import percentileInterval
+from ..util import quantityValues
 
 
 class AFxMeasurement(MeasurementBase):
@@ -126,8 +127,20 @@ class AFxMeasurement(MeasurementBase):
                 filter_name=self.filter_name))
 
         if amx.quantity:
-            v = 100. * np.mean(amx.rmsDistMas > amx.quantity + self.ADx) * u.Unit('')
-            self.quantity = v
+            threshold = quantityValues(amx.quantity + self.ADx, u.marcsec)
+            # Sorted once per AMx (or sketched), for every spec level
+            self.quantity = (100. * amx.rmsDistribution.fractionAbove(threshold) *
+                             u.Unit(''))
+
+            if amx.bootstrap is not None:
+                # Every resampling of the pairs at once
+                self.register_extra(
+                    'interval', label='AFx CI',
+                    description='Bootstrap 95% confidence interval on AFx, '
+                                'resampling the pairs by first object, for '
+                                'a fixed AMx')
+                self.interval = percentileInterval(
+                    100. * amx.bootstrap.fractionAbove(threshold)[:, 0]) * u.Unit('')
         else:
             # FIXME previously would raise ValidateErrorNoStars
             self.quantity = None
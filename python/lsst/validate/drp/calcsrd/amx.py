@@ -19,13 +19,25 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 
 from __future__ import print_function, absolute_import
-from builtins import zip
+from builtins import object, range, zip
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
 
 import numpy as np
 import astropy.units as u
+from scipy.spatial import cKDTree
 
+import lsst.pipe.base as pipeBase
 from lsst.validate.base import MeasurementBase
-from ..util import averageRaDecFromCat, sphDist
+from ..bootstrap import ClusterBootstrap, percentileInterval
+from ..quantilesketch import LogQuantileSketch
+from ..sorteddistribution import SortedDistribution
+from ..util import averageRaDecFromCat, makeSeed, sphDist, quantityValues
 
 
 class AMxMeasurement(MeasurementBase):
@@ -47,6 +59,38 @@ class AMxMeasurement(MeasurementBase):
         Default: ``[17.5, 21.5]`` mag.
     verbose : `bool`, optional
         Output additional information on the analysis steps.
+    rmsDistances : `astropy.units.Quantity`, optional
+        RMS distances of the pairs in this measurement's annulus, if
+        already computed (see `makeAMxMeasurements`).
+    maxPairs : `int`, optional
+        If given, AMx is estimated from a random sample of at most this
+        many pairs (see `sampleRmsDistances`), and a confidence interval
+        is reported as the ``AMxInterval`` extra.
+    tolerance : `float` or `astropy.units.Quantity`, optional
+        With ``maxPairs``, stop sampling once the confidence interval on
+        AMx is narrower than this. [milliarcsec]
+    seed : `int`, optional
+        With ``maxPairs`` or ``nBootstrap``, seed of the random sample and
+        of the bootstrap resamplings, recorded as the ``seed`` parameter. A
+        new seed is drawn if `None`.
+    nBootstrap : `int`, optional
+        Number of bootstrap resamplings of the pairs, by first object, from
+        which confidence intervals on AMx (the ``AMxInterval`` extra), AFx
+        and ADx are computed. Default: 100 with ``maxPairs``; without it,
+        intervals are only computed if given.
+    firstObject : `numpy.ndarray`, optional
+        First object of each of ``rmsDistances``, to resample them with
+        ``nBootstrap`` (see `calcRmsDistancesByFirstObject`).
+    objectArrays : `AMxObjectArrays` or `AMxPairStore`, optional
+        Arrays extracted from ``matchedDataset.safeMatches``, if already
+        computed, to share them between measurements, or a store of its
+        pairs (not with ``maxPairs``).
+    rmsSketch : `lsst.validate.drp.quantilesketch.LogQuantileSketch`, optional
+        Sketch of the RMS distances of the pairs in this measurement's
+        annulus [milliarcsec], from which AMx is computed if
+        ``rmsDistances`` is not given (see `calcRmsDistanceSketches`). The
+        bound on the rank error of the median is reported as the
+        ``rankError`` extra.
     job : :class:`lsst.validate.drp.base.Job`, optional
         If provided, the measurement will register itself with the Job
         object.
@@ -58,7 +102,24 @@ class AMxMeasurement(MeasurementBase):
     Attributes
     ----------
     rmsDistMas : ndarray
-        RMS of distance repeatability between stellar pairs.
+        RMS of distance repeatability between stellar pairs, or `None` if
+        only ``rmsSketch`` was kept.
+    rmsSketch : `lsst.validate.drp.quantilesketch.LogQuantileSketch` or `None`
+        Sketch of the RMS distances, if AMx was computed from one.
+    rmsDistribution : `SortedDistribution`, `LogQuantileSketch` or `None`
+        Distribution of the RMS distances [mas], sorted on first access and
+        shared by the AFx and ADx measurements of every specification level.
+    AMxInterval : `astropy.units.Quantity`
+        Bootstrap confidence interval on AMx, if pairs were sampled or
+        ``nBootstrap`` was given.
+    samplingFraction : `astropy.units.Quantity`
+        Fraction of the objects whose pairs were sampled, if pairs were
+        sampled.
+    sampleClusters : `numpy.ndarray` or `None`
+        First object of each sampled pair; `None` if all pairs were used.
+    bootstrap : `lsst.validate.drp.bootstrap.ClusterBootstrap` or `None`
+        Bootstrap resamplings of ``rmsDistMas`` by first object, shared by
+        the confidence intervals on AMx, AFx and ADx.
     blob : AMxBlob
         Blob with by-products from this measurement.
 
@@ -104,8 +165,16 @@ class AMxMeasurement(MeasurementBase):
     and to astrometric measurements performed in the r and i bands.
     """
 
+    sampleClusters = None
+    bootstrap = None
+    rmsSketch = None
+    _rmsDistribution = None
+
     def __init__(self, metric, matchedDataset, filter_name, width=2.,
-                 magRange=None, linkedBlobs=None, job=None, verbose=False):
+                 magRange=None, linkedBlobs=None, job=None, verbose=False,
+                 rmsDistances=None, maxPairs=None, tolerance=None,
+                 seed=None, objectArrays=None, rmsSketch=None,
+                 nBootstrap=None, firstObject=None):
         MeasurementBase.__init__(self)
 
         self.metric = metric
@@ -150,14 +219,87 @@ class AMxMeasurement(MeasurementBase):
             for name, blob in linkedBlobs.items():
                 setattr(self, name, blob)
 
-        matches = matchedDataset.safeMatches
-        rmsDistances = calcRmsDistances(
-            matches,
-            self.annulus,
-            magRange=self.magRange,
-            verbose=verbose)
+        if objectArrays is not None:
+            matches = objectArrays
+        else:
+            matches = matchedDataset.safeMatches
+
+        if rmsDistances is None and maxPairs is not None:
+            self.register_parameter('maxPairs', quantity=maxPairs * u.Unit(''),
+                                    label='max pairs',
+                                    description='Maximum number of pairs '
+                                                'sampled.')
+            seed = makeSeed(seed)
+            self.register_parameter('seed', seed, label='seed',
+                                    description='Seed of the random sample '
+                                                'of pairs.')
+            self.register_extra(
+                'AMxInterval', label='AMx CI',
+                description='Bootstrap 95% confidence interval on AMx from '
+                            'the sampled pairs')
+            self.register_extra(
+                'samplingFraction', label='Sampled fraction',
+                description='Fraction of the objects whose pairs were '
+                            'sampled')
+            sample = sampleRmsDistances(
+                matches,
+                self.annulus,
+                magRange=self.magRange,
+                maxPairs=maxPairs,
+                tolerance=tolerance,
+                nBootstrap=nBootstrap if nBootstrap is not None else 100,
+                seed=seed,
+                verbose=verbose)
+            rmsDistances = sample.rmsDistances
+            self.sampleClusters = sample.firstObject
+            self.bootstrap = sample.bootstrap
+            self.AMxInterval = sample.interval
+            self.samplingFraction = sample.samplingFraction * u.Unit('')
+        elif rmsDistances is None and rmsSketch is not None:
+            self.rmsSketch = rmsSketch
+        elif rmsDistances is None and nBootstrap is not None:
+            rmsDistances, firstObject = calcRmsDistancesByFirstObject(
+                matches, [self.annulus], magRange=self.magRange,
+                verbose=verbose)
+            rmsDistances, firstObject = rmsDistances[0], firstObject[0]
+        elif rmsDistances is None:
+            rmsDistances = calcRmsDistances(
+                matches,
+                self.annulus,
+                magRange=self.magRange,
+                verbose=verbose)
 
-        if len(rmsDistances) == 0:
+        if nBootstrap is not None and firstObject is not None:
+            # All the pairs were evaluated: resample them by first object
+            seed = makeSeed(seed)
+            self.register_parameter('nBootstrap',
+                                    quantity=nBootstrap * u.Unit(''),
+                                    label='bootstrap',
+                                    description='Number of bootstrap '
+                                                'resamplings of the pairs.')
+            self.register_parameter('seed', seed, label='seed',
+                                    description='Seed of the bootstrap '
+                                                'resamplings.')
+            self.register_extra(
+                'AMxInterval', label='AMx CI',
+                description='Bootstrap 95% confidence interval on AMx, '
+                            'resampling the pairs by first object')
+            self.bootstrap = ClusterBootstrap.fromLabels(
+                quantityValues(rmsDistances, u.marcsec), firstObject,
+                nBootstrap, seed=seed)
+            self.AMxInterval = percentileInterval(
+                self.bootstrap.percentile(50.)[:, 0]) * u.marcsec
+
+        if self.rmsSketch is not None and self.rmsSketch.count > 0:
+            self.register_extra(
+                'rankError', label='Rank error',
+                description='Bound on the rank error of AMx, as a fraction '
+                            'of the pairs, from summarizing the RMS '
+                            'distances in a sketch')
+            self.rmsDistMas = None
+            self.quantity = self.rmsSketch.percentile(50.) * u.marcsec
+            self.rankError = self.rmsSketch.rankError(50.) * u.Unit('')
+        elif rmsDistances is None or len(rmsDistances) == 0:
             # raise ValidateErrorNoStars(
             #     'No stars found that are %.1f--%.1f arcmin apart.' %
             #     (annulus[0], annulus[1]))
@@ -168,20 +310,188 @@ class AMxMeasurement(MeasurementBase):
             self.rmsDistMas = None
             self.quantity = None
         else:
-            self.rmsDistMas = rmsDistances.to(u.marcsec)
-            self.quantity = np.median(self.rmsDistMas)
+            self.rmsDistMas = rmsDistances
+            self.quantity = np.median(
+                quantityValues(rmsDistances, u.marcsec)) * u.marcsec
 
         if job:
             job.register_measurement(self)
 
+    @property
+    def rmsDistribution(self):
+        """Distribution of the RMS distances [mas] (see Attributes)."""
+        if self._rmsDistribution is None:
+            if self.rmsDistMas is not None:
+                self._rmsDistribution = SortedDistribution(
+                    quantityValues(self.rmsDistMas, u.marcsec))
+            else:
+                self._rmsDistribution = self.rmsSketch
+        return self._rmsDistribution
+
+
+def makeAMxMeasurements(metrics, matchedDataset, filter_name, width=2.,
+                        magRange=None, linkedBlobs=None, job=None,
+                        verbose=False, nWorkers=1, maxPairs=None,
+                        tolerance=None, seed=None, objectArrays=None,
+                        pairStorePath=None, maxStoredPairs=None,
+                        nBootstrap=None, ccdMapAnnulus=None):
+    """Measure several AMx metrics with a single pass over pairs of objects.
+
+    Parameters
+    ----------
+    metrics : `list` of `lsst.validate.base.Metric`
+        AM1, AM2 and/or AM3 `~lsst.validate.base.Metric` instances.
+    matchedDataset : lsst.validate.drp.matchreduce.MatchedMultiVisitDataset
+    filter_name : `str`
+        filter_name (filter name) used in this measurement (e.g., ``'r'``).
+    width, magRange, linkedBlobs, job, verbose
+        As for `AMxMeasurement`, shared by all the measurements.
+    nWorkers : `int`, optional
+        Number of processes over which to split the pairs of objects.
+    maxPairs, tolerance, seed : optional
+        If ``maxPairs`` is given, each AMx is instead estimated from its own
+        random sample of pairs, as for `AMxMeasurement`.
+    objectArrays : `AMxObjectArrays`, optional
+        Arrays extracted from ``matchedDataset.safeMatches``, if already
+        computed. Otherwise they are extracted once for all the
+        measurements.
+    pairStorePath : `str`, optional
+        Directory of an `AMxPairStore` from which to evaluate the
+        measurements. It is built (or rebuilt, if it does not cover the
+        annuli or the objects) on first use. Ignored with ``maxPairs``.
+    maxStoredPairs : `int`, optional
+        If given, the RMS distances are summarized in a sketch as the pairs
+        are enumerated, and kept only for the measurements with at most
+        this many pairs, which bounds memory use. The others are computed
+        from the sketch (see `AMxMeasurement`). Ignored with ``maxPairs``.
+    nBootstrap : `int`, optional
+        Number of bootstrap resamplings from which to compute confidence
+        intervals, as for `AMxMeasurement`. Without ``maxPairs``, the pairs
+        are then enumerated with their first objects (see
+        `calcRmsDistancesByFirstObject`), and ``pairStorePath`` and
+        ``maxStoredPairs`` are ignored.
+    ccdMapAnnulus : `astropy.units.Quantity`, optional
+        If given, also compute an `~lsst.validate.drp.amxccdmap.AMxCcdMap`
+        of the pairs separated by these radii [arcmin], linked to each
+        measurement as ``amxCcdMap``. Its pairs are taken from the same
+        pass as the measurements, except with ``maxPairs``, or with
+        ``pairStorePath`` or ``maxStoredPairs`` and no ``nBootstrap``,
+        which do not enumerate every pair with its objects.
+
+    Returns
+    -------
+    measurements : `list` of `AMxMeasurement`
+        One measurement for each of ``metrics``, identical to those that
+        `AMxMeasurement` would compute separately.
+
+    See also
+    --------
+    calcRmsDistancesMultiAnnulus
+    """
+    if not isinstance(width, u.Quantity):
+        width = width * u.arcmin
+    if magRange is None:
+        magRange = np.array([17.0, 21.5]) * u.mag
+    elif not isinstance(magRange, u.Quantity):
+        magRange = np.array(magRange) * u.mag
+    ccdKey = matchedDataset.ccdKey if ccdMapAnnulus is not None else None
+    if objectArrays is None or (ccdKey is not None and
+                                objectArrays.ccds is None):
+        objectArrays = AMxObjectArrays.fromGroupView(
+            matchedDataset.safeMatches, ccdKey=ccdKey)
+
+    annuli = [metric.D.quantity + (width/2)*np.array([-1, +1])
+              for metric in metrics]
+    rmsDistances = None
+    if ccdMapAnnulus is not None:
+        # amxccdmap imports this module
+        from ..amxccdmap import AMxCcdMap
+        if not isinstance(ccdMapAnnulus, u.Quantity):
+            ccdMapAnnulus = np.asarray(ccdMapAnnulus, dtype=float) * u.arcmin
+        if maxPairs is None and (nBootstrap is not None or
+                                 (pairStorePath is None and
+                                  maxStoredPairs is None)):
+            # Enumerate the pairs of the map with those of the measurements,
+            # e.g. the map of AM1's annulus is free
+            passAnnuli = list(annuli)
+            mapIndex = len(annuli)
+            for i, annulus in enumerate(annuli):
+                if np.array_equal(annulus.to(u.arcmin).value,
+                                  ccdMapAnnulus.to(u.arcmin).value):
+                    mapIndex = i
+            if mapIndex == len(annuli):
+                passAnnuli.append(ccdMapAnnulus)
+            rmsDistances, firstObjects, secondObjects = \
+                calcRmsDistancesByFirstObject(
+                    objectArrays, passAnnuli, magRange, verbose=verbose,
+                    nWorkers=nWorkers, withSecondObjects=True)
+            ccdMap = AMxCcdMap(matchedDataset, annulus=ccdMapAnnulus,
+                               magRange=magRange, objectArrays=objectArrays,
+                               rmsDistances=rmsDistances[mapIndex],
+                               pairs=(firstObjects[mapIndex],
+                                      secondObjects[mapIndex]))
+            rmsDistances = rmsDistances[:len(annuli)]
+            firstObjects = firstObjects[:len(annuli)]
+        else:
+            ccdMap = AMxCcdMap(matchedDataset, annulus=ccdMapAnnulus,
+                               magRange=magRange, nWorkers=nWorkers,
+                               objectArrays=objectArrays, verbose=verbose)
+        linkedBlobs = dict(linkedBlobs or {}, amxCcdMap=ccdMap)
+
+    if maxPairs is not None:
+        return [AMxMeasurement(metric, matchedDataset, filter_name,
+                               width=width, magRange=magRange,
+                               linkedBlobs=linkedBlobs, job=job,
+                               verbose=verbose, maxPairs=maxPairs,
+                               tolerance=tolerance, seed=seed,
+                               objectArrays=objectArrays,
+                               nBootstrap=nBootstrap)
+                for metric in metrics]
+
+    if rmsDistances is not None or nBootstrap is not None:
+        if rmsDistances is None:
+            rmsDistances, firstObjects = calcRmsDistancesByFirstObject(
+                objectArrays, annuli, magRange, verbose=verbose,
+                nWorkers=nWorkers)
+        if nBootstrap is None:
+            firstObjects = [None] * len(annuli)
+        return [AMxMeasurement(metric, matchedDataset, filter_name,
+                               width=width, magRange=magRange,
+                               linkedBlobs=linkedBlobs, job=job,
+                               verbose=verbose, rmsDistances=r, seed=seed,
+                               nBootstrap=nBootstrap, firstObject=obj1)
+                for metric, r, obj1 in zip(metrics, rmsDistances,
+                                           firstObjects)]
+
+    if pairStorePath is not None:
+        objectArrays = AMxPairStore.loadOrBuild(
+            pairStorePath, objectArrays,
+            max(annulus[1] for annulus in annuli), verbose=verbose)
+    if maxStoredPairs is not None:
+        sketches, rmsDistances = calcRmsDistanceSketches(
+            objectArrays, annuli, magRange, maxStoredPairs=maxStoredPairs,
+            verbose=verbose, nWorkers=nWorkers)
+    else:
+        rmsDistances = calcRmsDistancesMultiAnnulus(
+            objectArrays, annuli, magRange=magRange,
+            verbose=verbose, nWorkers=nWorkers)
+        sketches = [None] * len(annuli)
+
+    return [AMxMeasurement(metric, matchedDataset, filter_name, width=width,
+                           magRange=magRange, linkedBlobs=linkedBlobs,
+                           job=job, verbose=verbose, rmsDistances=r,
+                           rmsSketch=sketch if r is None else None)
+            for metric, r, sketch in zip(metrics, rmsDistances, sketches)]
+
 
 def calcRmsDistances(groupView, annulus, magRange, verbose=False):
     """Calculate the RMS distance of a set of matched objects over visits.
 
     Parameters
     ----------
-    groupView : lsst.afw.table.GroupView
-        GroupView object of matched observations from MultiMatch.
+    groupView : lsst.afw.table.GroupView, GroupedArrays, AMxObjectArrays or AMxPairStore
+        GroupView object of matched observations from MultiMatch, the
+        arrays already extracted from one, or a store of its pairs.
     annulus : length-2 `astropy.units.Quantity`
         Distance range (i.e., arcmin) in which to compare objects.
         E.g., `annulus=np.array([19, 21]) * u.arcmin` would consider all
@@ -194,64 +504,1124 @@ def calcRmsDistances(groupView, annulus, magRange, verbose=False):
     Returns
     -------
     rmsDistances : `astropy.units.Quantity`
-        RMS angular separations of a set of matched objects over visits.
+        RMS angular separations of a set of matched objects over visits
+        (milliarcseconds).
+
+    See also
+    --------
+    calcRmsDistancesMultiAnnulus : The same for several annuli at once.
     """
+    return calcRmsDistancesMultiAnnulus(groupView, [annulus], magRange,
+                                        verbose=verbose)[0]
 
-    # First we make a list of the keys that we want the fields for
-    importantKeys = [groupView.schema.find(name).key for
-                     name in ['id', 'coord_ra', 'coord_dec',
-                              'object', 'visit', 'base_PsfFlux_mag']]
 
-    minMag, maxMag = magRange.to(u.mag).value
+def calcRmsDistancesMultiAnnulus(groupView, annuli, magRange, verbose=False,
+                                 nWorkers=1, chunkSize=1000):
+    """Calculate the RMS distance of a set of matched objects over visits,
+    for pairs of objects in each of several annuli.
 
-    def magInRange(cat):
-        mag = cat.get('base_PsfFlux_mag')
-        w, = np.where(np.isfinite(mag))
-        medianMag = np.median(mag[w])
-        return minMag <= medianMag and medianMag < maxMag
+    The magnitude selection, the mean positions and the enumeration of
+    pairs are only done once, up to the largest outer radius, and each
+    pair is then assigned to every annulus it falls in. Computing AM1, AM2
+    and AM3 together thus costs about as much as AM3 alone.
 
-    groupViewInMagRange = groupView.where(magInRange)
+    With ``nWorkers > 1`` chunks of first objects are evaluated on a
+    `multiprocessing.Pool`. The per-object arrays are written to a
+    temporary directory and memory-mapped read-only by the workers. The
+    results are identical to those of a single process.
 
-    # List of lists of id, importantValue
-    matchKeyOutput = [obj.get(key)
-                      for key in importantKeys
-                      for obj in groupViewInMagRange.groups]
+    The results for an `AMxObjectArrays` or an `AMxPairStore` are
+    memoized by annulus and magnitude range, so asking again for the same
+    ones is free. An `AMxPairStore` answers by filtering the stored pairs.
 
-    jump = len(groupViewInMagRange)
+    Parameters
+    ----------
+    groupView : lsst.afw.table.GroupView, GroupedArrays, AMxObjectArrays or AMxPairStore
+        GroupView object of matched observations from MultiMatch, the
+        arrays already extracted from one, or a store of its pairs.
+    annuli : `list` of length-2 `astropy.units.Quantity`
+        Distance ranges (i.e., arcmin) in which to compare objects.
+    magRange : length-2 `astropy.units.Quantity`
+        Magnitude range from which to select objects.
+    verbose : bool, optional
+        Output additional information on the analysis steps.
+    nWorkers : `int`, optional
+        Number of processes over which to split the pairs.
+    chunkSize : `int`, optional
+        Number of first objects of pairs evaluated together, and the unit
+        of work handed to each process.
+
+    Returns
+    -------
+    rmsDistances : `list` of `astropy.units.Quantity`
+        RMS angular separations over visits of the pairs of objects in
+        each annulus (milliarcseconds).
+    """
+    cache = getattr(groupView, 'rmsDistanceCache', None)
+    if cache is None:
+        return _calcRmsDistancesMultiAnnulus(groupView, annuli, magRange,
+                                             verbose, nWorkers, chunkSize)
+
+    keys = [(tuple(annulus.to(u.arcmin).value), tuple(magRange.to(u.mag).value))
+            for annulus in annuli]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    if missing:
+        missingAnnuli = [annuli[i] for i in missing]
+        if isinstance(groupView, AMxPairStore):
+            results = [groupView.rmsDistances(annulus, magRange)
+                       for annulus in missingAnnuli]
+        else:
+            results = _calcRmsDistancesMultiAnnulus(groupView, missingAnnuli,
+                                                    magRange, verbose,
+                                                    nWorkers, chunkSize)
+        for i, result in zip(missing, results):
+            cache[keys[i]] = result
+    return [cache[key] for key in keys]
+
+
+def _calcRmsDistancesMultiAnnulus(groupView, annuli, magRange, verbose,
+                                  nWorkers, chunkSize):
+    # Chunks are returned in order, so the output does not depend on
+    # nWorkers
+    rmsDistances = [[np.zeros(0)] for _ in annuli]
+    for chunkRmsDistances in iterRmsDistanceChunks(groupView, annuli,
+                                                   magRange, verbose=verbose,
+                                                   nWorkers=nWorkers,
+                                                   chunkSize=chunkSize):
+        for i, r in enumerate(chunkRmsDistances):
+            rmsDistances[i].append(r)
 
-    ra = matchKeyOutput[1*jump:2*jump]
-    dec = matchKeyOutput[2*jump:3*jump]
-    visit = matchKeyOutput[4*jump:5*jump]
+    # Convert to milliarcseconds once, and wrap the results without a copy
+    return [u.Quantity(radiansToMilliarcsec(np.concatenate(r)), u.marcsec,
+                       copy=False)
+            for r in rmsDistances]
 
-    # Calculate the mean position of each object from its constituent visits
-    # `aggregate` calulates a quantity for each object in the groupView.
-    meanRa = groupViewInMagRange.aggregate(averageRaFromCat)
-    meanDec = groupViewInMagRange.aggregate(averageDecFromCat)
 
+def calcRmsDistancesByFirstObject(groupView, annuli, magRange,
+                                  verbose=False, nWorkers=1, chunkSize=1000,
+                                  withSecondObjects=False):
+    """Calculate the RMS distances of the pairs of objects in each of
+    several annuli, with the first object of each pair.
+
+    The pairs of a first object are correlated through its positions, so
+    they are resampled together to compute bootstrap confidence intervals
+    (see `lsst.validate.drp.bootstrap.ClusterBootstrap`).
+
+    Parameters
+    ----------
+    groupView : lsst.afw.table.GroupView, GroupedArrays or AMxObjectArrays
+        GroupView object of matched observations from MultiMatch, or the
+        arrays already extracted from one.
+    annuli, magRange, verbose, nWorkers, chunkSize
+        As for `calcRmsDistancesMultiAnnulus`.
+    withSecondObjects : `bool`, optional
+        Also return the second object of each pair.
+
+    Returns
+    -------
+    rmsDistances : `list` of `astropy.units.Quantity`
+        RMS angular separations over visits of the pairs of objects in
+        each annulus (milliarcseconds).
+    firstObjects : `list` of `numpy.ndarray`
+        Index of the first object of each of ``rmsDistances``, among the
+        objects of ``groupView`` in ``magRange``.
+    secondObjects : `list` of `numpy.ndarray`
+        Only with ``withSecondObjects``: index of the second object of each
+        of ``rmsDistances``.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    rmsDistances = [[np.zeros(0)] for _ in annuli]
+    firstObjects = [[empty] for _ in annuli]
+    secondObjects = [[empty] for _ in annuli]
+    for chunkRmsDistances, chunkPairs in iterRmsDistanceChunks(
+            groupView, annuli, magRange, verbose=verbose, nWorkers=nWorkers,
+            chunkSize=chunkSize, withPairs=True):
+        for i, (r, pairs) in enumerate(zip(chunkRmsDistances, chunkPairs)):
+            obj1, obj2 = pairs
+            rmsDistances[i].append(r)
+            firstObjects[i].append(obj1)
+            if withSecondObjects:
+                secondObjects[i].append(obj2)
+    result = ([u.Quantity(radiansToMilliarcsec(np.concatenate(r)), u.marcsec,
+                          copy=False) for r in rmsDistances],
+              [np.concatenate(obj1) for obj1 in firstObjects])
+    if withSecondObjects:
+        result += ([np.concatenate(obj2) for obj2 in secondObjects],)
+    return result
+
+
+def calcRmsDistanceSketches(groupView, annuli, magRange, maxStoredPairs=None,
+                            verbose=False, nWorkers=1, chunkSize=1000):
+    """Summarize the RMS distances of the pairs of objects in each of
+    several annuli in bounded memory.
+
+    The RMS distances are fed to a `LogQuantileSketch` for each annulus as
+    the pairs are enumerated. They are also kept, as by
+    `calcRmsDistancesMultiAnnulus`, as long as there are no more than
+    ``maxStoredPairs`` of them in the annulus.
+
+    Parameters
+    ----------
+    groupView : lsst.afw.table.GroupView, GroupedArrays, AMxObjectArrays or AMxPairStore
+        As for `calcRmsDistancesMultiAnnulus`.
+    annuli : `list` of length-2 `astropy.units.Quantity`
+        Distance ranges (i.e., arcmin) in which to compare objects.
+    magRange : length-2 `astropy.units.Quantity`
+        Magnitude range from which to select objects.
+    maxStoredPairs : `int`, optional
+        Maximum number of RMS distances to keep per annulus. All of them
+        are kept if `None`.
+    verbose, nWorkers, chunkSize : optional
+        As for `calcRmsDistancesMultiAnnulus`.
+
+    Returns
+    -------
+    sketches : `list` of `lsst.validate.drp.quantilesketch.LogQuantileSketch`
+        Sketch of the RMS distances in each annulus [milliarcsec].
+    rmsDistances : `list` of `astropy.units.Quantity` or `None`
+        RMS distances in each annulus (milliarcseconds), or `None` where
+        there were more than ``maxStoredPairs``.
+    """
+    sketches = [LogQuantileSketch() for _ in annuli]
+    if isinstance(groupView, AMxPairStore):
+        # The pairs are already stored, so each annulus is read in one go
+        rmsDistances = calcRmsDistancesMultiAnnulus(groupView, annuli,
+                                                    magRange)
+        for sketch, r in zip(sketches, rmsDistances):
+            sketch.add(r.value)
+        if maxStoredPairs is not None:
+            rmsDistances = [r if len(r) <= maxStoredPairs else None
+                            for r in rmsDistances]
+    else:
+        stored = [[np.zeros(0)] for _ in annuli]
+        for chunkRmsDistances in iterRmsDistanceChunks(groupView, annuli,
+                                                       magRange,
+                                                       verbose=verbose,
+                                                       nWorkers=nWorkers,
+                                                       chunkSize=chunkSize):
+            for i, r in enumerate(chunkRmsDistances):
+                r = radiansToMilliarcsec(r)
+                sketches[i].add(r)
+                if stored[i] is not None:
+                    stored[i].append(r)
+                    if (maxStoredPairs is not None and
+                            sketches[i].count > maxStoredPairs):
+                        stored[i] = None
+        rmsDistances = [u.Quantity(np.concatenate(r), u.marcsec, copy=False)
+                        if r is not None else None for r in stored]
+    return sketches, rmsDistances
+
+
+def iterRmsDistanceChunks(groupView, annuli, magRange, verbose=False,
+                          nWorkers=1, chunkSize=1000, withPairs=False):
+    """Iterate over the RMS distances of the pairs of objects in each of
+    several annuli, a chunk of first objects at a time.
+
+    This is the single pass over pairs behind
+    `calcRmsDistancesMultiAnnulus`, for callers that reduce the RMS
+    distances as they go instead of keeping all of them.
+
+    Parameters are as for `calcRmsDistancesMultiAnnulus`, and:
+
+    withPairs : `bool`, optional
+        Also yield the two objects of each pair.
+
+    Yields
+    ------
+    rmsDistances : `list` of `numpy.ndarray`
+        RMS angular separations over visits of the pairs of the chunk in
+        each annulus. [radians]
+    pairs : `list` of 2-`tuple` of `numpy.ndarray`
+        Only with ``withPairs``: indices of the first and second objects of
+        the pairs in each annulus, among the objects of ``groupView`` in
+        ``magRange`` (see `AMxObjectArrays.inMagRange`).
+    """
+    objects = _selectAMxObjects(groupView, magRange)
+
+    annuliRadians = [arcminToRadians(annulus.to(u.arcmin).value)
+                     for annulus in annuli]
+    envelope = np.array([min(a[0] for a in annuliRadians),
+                         max(a[1] for a in annuliRadians)])
+
+    if nWorkers > 1:
+        results = _evaluatePairChunksInPool(objects, envelope, annuliRadians,
+                                            nWorkers, chunkSize, withPairs)
+    else:
+        finder = _PairFinder(objects.meanRa, objects.meanDec, envelope[1])
+        results = (_evaluatePairChunk(finder, objects.visitVectors, envelope,
+                                      annuliRadians, start, start + chunkSize,
+                                      withPairs)
+                   for start in range(0, finder.nPositions, chunkSize))
+
+    for chunkRmsDistances, chunkPairs, (noMatch1, noMatch2) in results:
+        if verbose:
+            for o1, o2 in zip(noMatch1, noMatch2):
+                print("No matching visits found for objs: %d and %d" %
+                      (o1, o2))
+        if withPairs:
+            yield chunkRmsDistances, chunkPairs
+        else:
+            yield chunkRmsDistances
+
+
+def sampleRmsDistances(groupView, annulus, magRange, maxPairs,
+                       tolerance=None, confidence=0.95, nBootstrap=100,
+                       chunkSize=100, seed=None, verbose=False):
+    """Calculate the RMS distance over visits of a random sample of the
+    pairs of objects in an annulus.
+
+    First objects are drawn in random order, a chunk at a time, and all of
+    their pairs in the annulus are evaluated. Every pair is thus equally
+    likely to be sampled, and the sample is stratified by first object.
+    Sampling stops once ``maxPairs`` pairs have been evaluated (all the
+    pairs of the first object are kept even if there are more) or, if
+    ``tolerance`` is given, once the confidence interval on the median RMS
+    distance is narrower than ``tolerance``.
+
+    Parameters
+    ----------
+    groupView : lsst.afw.table.GroupView, GroupedArrays or AMxObjectArrays
+        GroupView object of matched observations from MultiMatch, or the
+        arrays already extracted from one.
+    annulus : length-2 `astropy.units.Quantity`
+        Distance range (i.e., arcmin) in which to compare objects.
+    magRange : length-2 `astropy.units.Quantity`
+        Magnitude range from which to select objects.
+    maxPairs : `int`
+        Maximum number of pairs to evaluate.
+    tolerance : `astropy.units.Quantity`, optional
+        Stop as soon as the confidence interval on the median is narrower
+        than this (milliarcseconds if not a `~astropy.units.Quantity`).
+    confidence : `float`, optional
+        Confidence level of the interval.
+    nBootstrap : `int`, optional
+        Number of bootstrap resamplings used to compute the interval.
+    chunkSize : `int`, optional
+        Number of first objects drawn at a time.
+    seed : `int`, optional
+        Seed of the random number generator.
+    verbose : bool, optional
+        Output additional information on the analysis steps.
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+        Result struct with components:
+
+        - ``rmsDistances``: RMS angular separations over visits of the
+          sampled pairs (`astropy.units.Quantity`, milliarcseconds).
+        - ``firstObject``: index of the first object of each sampled pair
+          (`numpy.ndarray`), to resample by first object.
+        - ``interval``: confidence interval on the median of
+          ``rmsDistances`` (`astropy.units.Quantity`, milliarcseconds).
+        - ``bootstrap``: the resamplings of ``rmsDistances`` [mas] by first
+          object behind ``interval``
+          (`lsst.validate.drp.bootstrap.ClusterBootstrap`).
+        - ``samplingFraction``: fraction of the first objects whose pairs
+          were evaluated (`float`).
+
+    See also
+    --------
+    calcRmsDistances : The same for all pairs in the annulus.
+    lsst.validate.drp.bootstrap.ClusterBootstrap
+    """
+    objects = _selectAMxObjects(groupView, magRange)
     annulusRadians = arcminToRadians(annulus.to(u.arcmin).value)
+    if tolerance is not None:
+        tolerance = arcminToRadians(
+            u.Quantity(tolerance, u.marcsec).to(u.arcmin).value)
+
+    rng = np.random.RandomState(seed)
+    finder = _PairFinder(objects.meanRa, objects.meanDec, annulusRadians[1])
+    order = rng.permutation(finder.nPositions)
+
+    rmsDistances = [np.zeros(0)]
+    firstObject = [np.zeros(0, dtype=np.int64)]
+    nSampled = 0
+    nExamined = 0
+    nextCheck = 0
+    for start in range(0, len(order), chunkSize):
+        positions = np.sort(order[start:start + chunkSize])
+        obj1, obj2, dist = finder.pairsOf(positions, annulusRadians)
+        pairRms = calcPairRmsDistances(objects.visitVectors, obj1, obj2)
+
+        # Only keep whole first objects, up to maxPairs, but always keep
+        # the first one so that the sample is never empty
+        nExamined += len(positions)
+        truncated = nSampled + len(obj1) >= maxPairs
+        if nSampled + len(obj1) > maxPairs:
+            cutoff = obj1[maxPairs - nSampled]
+            if nSampled == 0:
+                cutoff = max(cutoff, obj1[0] + 1)
+            keep = obj1 < cutoff
+            obj1, obj2, pairRms = obj1[keep], obj2[keep], pairRms[keep]
+            nExamined -= np.sum(finder.finite[positions] >= cutoff)
+        nSampled += len(obj1)
+
+        noMatch = np.isnan(pairRms)
+        if verbose:
+            for o1, o2 in zip(obj1[noMatch], obj2[noMatch]):
+                print("No matching visits found for objs: %d and %d" %
+                      (o1, o2))
+        rmsDistances.append(pairRms[~noMatch])
+        firstObject.append(obj1[~noMatch])
+
+        if truncated:
+            break
+        if tolerance is not None and nSampled >= nextCheck:
+            # Check the interval again once the sample has grown by half
+            nextCheck = 1.5*nSampled
+            bootstrap = ClusterBootstrap.fromLabels(
+                np.concatenate(rmsDistances), np.concatenate(firstObject),
+                nBootstrap, seed=rng.randint(2**31))
+            lower, upper = percentileInterval(bootstrap.percentile(50.)[:, 0],
+                                              confidence)
+            if upper - lower < tolerance:
+                break
+
+    rmsDistances = radiansToMilliarcsec(np.concatenate(rmsDistances))
+    firstObject = np.concatenate(firstObject)
+    bootstrap = ClusterBootstrap.fromLabels(rmsDistances, firstObject,
+                                            nBootstrap,
+                                            seed=rng.randint(2**31))
+    interval = percentileInterval(bootstrap.percentile(50.)[:, 0], confidence)
+    return pipeBase.Struct(
+        rmsDistances=u.Quantity(rmsDistances, u.marcsec, copy=False),
+        firstObject=firstObject,
+        interval=interval * u.marcsec,
+        bootstrap=bootstrap,
+        samplingFraction=float(nExamined) / max(finder.nPositions, 1))
+
+
+class AMxObjectArrays(object):
+    """Per-object arrays used to compute AMx, extracted once from the
+    matched sources and shared by all annuli and magnitude ranges.
+
+    The positions of each object in each visit are stored as unit vectors,
+    so the trigonometric functions of the coordinates are evaluated once per
+    detection rather than once per pair and visit. They are stored flat
+    (see `VisitVectors`), so memory grows with the number of detections,
+    and selecting objects by magnitude does not copy them.
+
+    Parameters
+    ----------
+    meanRa, meanDec : `numpy.ndarray`
+        Mean position of each object [radians].
+    medianMag : `numpy.ndarray`
+        Median of the finite PSF magnitudes of each object (NaN if there
+        are none).
+    visitVectors : `VisitVectors`
+        Unit vector of the position of each object in each visit in which
+        it was detected with finite coordinates.
+    ccds : `numpy.ndarray`, optional
+        CCD on which each object was most often detected (-1 if it was
+        never detected).
+    """
+
+    def __init__(self, meanRa, meanDec, medianMag, visitVectors, ccds=None):
+        self.meanRa = np.asarray(meanRa, dtype=float)
+        self.meanDec = np.asarray(meanDec, dtype=float)
+        self.medianMag = np.asarray(medianMag, dtype=float)
+        self.visitVectors = visitVectors
+        self.ccds = np.asarray(ccds) if ccds is not None else None
+        # RMS distances by annulus and magnitude range, see
+        # `calcRmsDistancesMultiAnnulus`
+        self.rmsDistanceCache = {}
+
+    @classmethod
+    def fromGroupView(cls, groupView, ccdKey=None):
+        """Extract the arrays from matched sources.
+
+        Parameters
+        ----------
+        groupView : lsst.afw.table.GroupView or GroupedArrays
+            GroupView object of matched observations from MultiMatch.
+        ccdKey : `str`, optional
+            Name of the CCD field of the sources (e.g., ``'ccd'``), to
+            also extract the CCD of each object.
+
+        Returns
+        -------
+        objectArrays : `AMxObjectArrays`
+        """
+        # Fields are looked up by name, which works for both a GroupView
+        # and GroupedArrays (which only stores the fields validate_drp uses).
+        groups = groupView.groups
+        ras = [cat.get('coord_ra') for cat in groups]
+        decs = [cat.get('coord_dec') for cat in groups]
+        visits = [cat.get('visit') for cat in groups]
 
-    rmsDistances = list()
-    for obj1, (ra1, dec1, visit1) in enumerate(zip(meanRa, meanDec, visit)):
-        dist = sphDist(ra1, dec1, meanRa[obj1+1:], meanDec[obj1+1:])
-        objectsInAnnulus, = np.where((annulusRadians[0] <= dist) &
-                                     (dist < annulusRadians[1]))
-        for obj2 in objectsInAnnulus:
-            distances = matchVisitComputeDistance(
-                visit[obj1], ra[obj1], dec[obj1],
-                visit[obj2], ra[obj2], dec[obj2])
-            if not distances:
+        medianMag = np.full(len(groups), np.nan)
+        meanRa = np.zeros(len(groups))
+        meanDec = np.zeros(len(groups))
+        ccds = np.full(len(groups), -1, dtype=np.int64) if ccdKey else None
+        for i, cat in enumerate(groups):
+            mag = cat.get('base_PsfFlux_mag')
+            mag = mag[np.isfinite(mag)]
+            if len(mag) > 0:
+                medianMag[i] = np.median(mag)
+            # Mean position of each object from its constituent visits
+            meanRa[i], meanDec[i] = averageRaDecFromCat(cat)
+            if ccdKey and len(cat) > 0:
+                # CCD of most detections, the smallest in case of a tie
+                values, counts = np.unique(cat.get(ccdKey),
+                                           return_counts=True)
+                ccds[i] = values[np.argmax(counts)]
+
+        return cls(meanRa, meanDec, medianMag,
+                   VisitVectors.fromDetections(visits, ras, decs), ccds=ccds)
+
+    def __len__(self):
+        return len(self.meanRa)
+
+    @property
+    def visits(self):
+        """Sorted identifiers of the visits (`numpy.ndarray`)."""
+        return self.visitVectors.visits
+
+    def digest(self):
+        """Return a digest of the positions, magnitudes and detections of
+        the objects, which identifies the objects a pair store was built
+        from (see `AMxPairStore.loadOrBuild`).
+
+        Returns
+        -------
+        digest : `str`
+            Hexadecimal SHA-1 digest.
+        """
+        sha = hashlib.sha1()
+        for array in (self.meanRa, self.meanDec, self.medianMag):
+            sha.update(np.ascontiguousarray(array, dtype='<f8').tobytes())
+        self.visitVectors.updateDigest(sha)
+        return sha.hexdigest()
+
+    def magRangeSelection(self, magRange):
+        """Return whether the median magnitude of each object is in
+        ``magRange``.
+
+        Parameters
+        ----------
+        magRange : length-2 `astropy.units.Quantity`
+            Magnitude range from which to select objects; the bright limit
+            is inclusive, the faint limit exclusive.
+
+        Returns
+        -------
+        selection : `numpy.ndarray` of `bool`
+        """
+        minMag, maxMag = magRange.to(u.mag).value
+        with np.errstate(invalid='ignore'):
+            return (minMag <= self.medianMag) & (self.medianMag < maxMag)
+
+    def inMagRange(self, magRange):
+        """Return the objects whose median magnitude is in ``magRange``.
+
+        Parameters
+        ----------
+        magRange : length-2 `astropy.units.Quantity`
+            Magnitude range from which to select objects (see
+            `magRangeSelection`).
+
+        Returns
+        -------
+        objectArrays : `AMxObjectArrays`
+            The selected objects, which share the detections of ``self``.
+        """
+        selection = self.magRangeSelection(magRange)
+        ccds = self.ccds[selection] if self.ccds is not None else None
+        return AMxObjectArrays(self.meanRa[selection], self.meanDec[selection],
+                               self.medianMag[selection],
+                               self.visitVectors.select(selection), ccds=ccds)
+
+
+class AMxPairStore(object):
+    """Separation and RMS distance of every pair of objects up to a maximum
+    separation, from which AMx can be re-evaluated for any annulus and
+    magnitude range without touching the positions again.
+
+    The pairs are kept in a compact binary file that is memory-mapped
+    read-only, so a store can be reused across runs; use `build` to create
+    one and `load` to open it again.
+
+    Parameters
+    ----------
+    pairs : `numpy.ndarray`
+        Structured array of the pairs, with the fields of `pairDtype`.
+    medianMag : `numpy.ndarray`
+        Median magnitude of each object (see `AMxObjectArrays`).
+    maxRadius : `astropy.units.Quantity`
+        Maximum (exclusive) separation of the stored pairs.
+    digest : `str`, optional
+        `AMxObjectArrays.digest` of the objects of the pairs.
+    """
+
+    pairDtype = np.dtype([('obj1', '<i4'), ('obj2', '<i4'),
+                          ('dist', '<f8'), ('rms', '<f8')])
+    """Fields of each stored pair: the indices of the two objects, their
+    separation and the RMS of their separation over visits [radians].
+    """
+
+    _pairsFile = 'pairs.bin'
+    _objectsFile = 'medianMag.npy'
+    _metadataFile = 'metadata.json'
+
+    def __init__(self, pairs, medianMag, maxRadius, digest=None):
+        self.pairs = pairs
+        self.medianMag = np.asarray(medianMag, dtype=float)
+        self.maxRadius = maxRadius.to(u.arcmin)
+        self.digest = digest
+        self.rmsDistanceCache = {}
+
+    @classmethod
+    def build(cls, groupView, maxRadius, path=None, chunkSize=1000,
+              verbose=False):
+        """Compute and store the pairs of objects.
+
+        Parameters
+        ----------
+        groupView : lsst.afw.table.GroupView, GroupedArrays or AMxObjectArrays
+            GroupView object of matched observations from MultiMatch, or
+            the arrays already extracted from one. All objects are stored,
+            whatever their magnitude.
+        maxRadius : `astropy.units.Quantity`
+            Maximum separation of the pairs to store, e.g. the outer radius
+            of the largest annulus.
+        path : `str`, optional
+            Directory in which to write the store. If `None`, the pairs are
+            only kept in memory.
+        chunkSize : `int`, optional
+            Number of first objects of pairs evaluated together.
+        verbose : bool, optional
+            Output additional information on the analysis steps.
+
+        Returns
+        -------
+        store : `AMxPairStore`
+        """
+        if not isinstance(groupView, AMxObjectArrays):
+            groupView = AMxObjectArrays.fromGroupView(groupView)
+        maxRadiusRadians = arcminToRadians(maxRadius.to(u.arcmin).value)
+        finder = _PairFinder(groupView.meanRa, groupView.meanDec,
+                             maxRadiusRadians)
+
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            output = open(os.path.join(path, cls._pairsFile), 'wb')
+        chunks = []
+        try:
+            for start in range(0, finder.nPositions, chunkSize):
+                obj1, obj2, dist = finder.pairs(start, start + chunkSize,
+                                                [0., maxRadiusRadians])
+                chunk = np.zeros(len(obj1), dtype=cls.pairDtype)
+                chunk['obj1'] = obj1
+                chunk['obj2'] = obj2
+                chunk['dist'] = dist
+                chunk['rms'] = calcPairRmsDistances(groupView.visitVectors,
+                                                    obj1, obj2)
+                if path is not None:
+                    chunk.tofile(output)
+                else:
+                    chunks.append(chunk)
+        finally:
+            if path is not None:
+                output.close()
+
+        if path is None:
+            pairs = np.concatenate([np.zeros(0, dtype=cls.pairDtype)] +
+                                   chunks)
+            return cls(pairs, groupView.medianMag, maxRadius,
+                       digest=groupView.digest())
+
+        np.save(os.path.join(path, cls._objectsFile), groupView.medianMag)
+        with open(os.path.join(path, cls._metadataFile), 'w') as f:
+            json.dump({'maxRadius': maxRadius.to(u.arcmin).value,
+                       'maxRadiusUnit': 'arcmin',
+                       'digest': groupView.digest()}, f)
+        store = cls.load(path)
+        if verbose:
+            print('Stored {0:d} pairs of objects up to {1} in {2}'.format(
+                len(store.pairs), store.maxRadius, path))
+        return store
+
+    @classmethod
+    def loadOrBuild(cls, path, groupView, maxRadius, verbose=False):
+        """Open the store in ``path`` if it holds the pairs of the same
+        objects up to at least ``maxRadius``, and build it there otherwise.
+
+        The objects are the same if their positions, magnitudes and
+        detections have the `AMxObjectArrays.digest` recorded in the store.
+        Parameters are as for `build`.
+
+        Returns
+        -------
+        store : `AMxPairStore`
+        """
+        if not isinstance(groupView, AMxObjectArrays):
+            groupView = AMxObjectArrays.fromGroupView(groupView)
+        if os.path.exists(os.path.join(path, cls._metadataFile)):
+            store = cls.load(path)
+            sameObjects = (store.digest is not None and
+                           store.digest == groupView.digest())
+            if sameObjects and store.maxRadius >= maxRadius:
                 if verbose:
-                    print("No matching visits found for objs: %d and %d" %
-                          (obj1, obj2))
-                continue
+                    print('Using the {0:d} pairs of objects stored in '
+                          '{1}'.format(len(store.pairs), path))
+                return store
+        return cls.build(groupView, maxRadius, path=path, verbose=verbose)
+
+    @classmethod
+    def load(cls, path):
+        """Open a store written by `build`, memory-mapping its pairs.
+
+        Parameters
+        ----------
+        path : `str`
+            Directory of the store.
+
+        Returns
+        -------
+        store : `AMxPairStore`
+        """
+        with open(os.path.join(path, cls._metadataFile)) as f:
+            metadata = json.load(f)
+        pairsPath = os.path.join(path, cls._pairsFile)
+        if os.path.getsize(pairsPath) > 0:
+            pairs = np.memmap(pairsPath, dtype=cls.pairDtype, mode='r')
+        else:
+            pairs = np.zeros(0, dtype=cls.pairDtype)
+        return cls(pairs, np.load(os.path.join(path, cls._objectsFile)),
+                   metadata['maxRadius'] * u.Unit(metadata['maxRadiusUnit']),
+                   digest=metadata.get('digest'))
+
+    def rmsDistances(self, annulus, magRange, blockSize=2**22):
+        """RMS distances of the stored pairs in an annulus, between objects
+        in a magnitude range.
+
+        The result is identical to that of `calcRmsDistances` on the
+        objects from which the store was built.
+
+        Parameters
+        ----------
+        annulus : length-2 `astropy.units.Quantity`
+            Distance range in which to compare objects. The outer radius
+            must not exceed ``maxRadius``.
+        magRange : length-2 `astropy.units.Quantity`
+            Magnitude range from which to select objects.
+        blockSize : `int`, optional
+            Number of stored pairs read at a time.
+
+        Returns
+        -------
+        rmsDistances : `astropy.units.Quantity`
+            RMS angular separations over visits of the pairs
+            (milliarcseconds).
+        """
+        if annulus[1] > self.maxRadius:
+            raise ValueError('Annulus {0} extends beyond the {1} of the stored '
+                             'pairs.'.format(annulus, self.maxRadius))
+        annulusRadians = arcminToRadians(annulus.to(u.arcmin).value)
+        minMag, maxMag = magRange.to(u.mag).value
+        with np.errstate(invalid='ignore'):
+            inMagRange = (minMag <= self.medianMag) & (self.medianMag < maxMag)
+
+        rmsDistances = [np.zeros(0)]
+        for start in range(0, len(self.pairs), blockSize):
+            block = self.pairs[start:start + blockSize]
+            dist = block['dist']
+            rms = block['rms']
+            selected = ((annulusRadians[0] <= dist) &
+                        (dist < annulusRadians[1]) &
+                        inMagRange[block['obj1']] & inMagRange[block['obj2']] &
+                        np.isfinite(rms))
+            rmsDistances.append(np.asarray(rms[selected]))
+        return u.Quantity(radiansToMilliarcsec(np.concatenate(rmsDistances)),
+                          u.marcsec, copy=False)
+
+
+def _selectAMxObjects(groupView, magRange):
+    """`AMxObjectArrays` of the objects of ``groupView`` (or of an
+    `AMxObjectArrays`) in ``magRange``.
+    """
+    if isinstance(groupView, AMxPairStore):
+        raise TypeError('The positions of objects are not kept in an '
+                        'AMxPairStore; use the AMxObjectArrays instead.')
+    if not isinstance(groupView, AMxObjectArrays):
+        groupView = AMxObjectArrays.fromGroupView(groupView)
+    return groupView.inMagRange(magRange)
+
+
+def _evaluatePairChunk(finder, visitVectors, envelope, annuliRadians, start,
+                       stop, withPairs=False):
+    """RMS distances of the pairs whose first object is one of the finite
+    positions ``start`` to ``stop`` of ``finder``, for each annulus, their
+    two objects (if ``withPairs``, otherwise `None`), and the pairs without
+    a shared visit.
+    """
+    obj1, obj2, dist = finder.pairs(start, stop, envelope)
+    inAnnuli = [(a[0] <= dist) & (dist < a[1]) for a in annuliRadians]
+    # Only evaluate the pairs that fall in at least one annulus
+    needed = np.logical_or.reduce(inAnnuli)
+    pairRms = np.full(len(dist), np.nan)
+    pairRms[needed] = calcPairRmsDistances(visitVectors, obj1[needed],
+                                           obj2[needed])
+    noMatch = np.isnan(pairRms)
+    inAnnuli = [inAnnulus & ~noMatch for inAnnulus in inAnnuli]
+    pairs = None
+    if withPairs:
+        pairs = [(obj1[inAnnulus], obj2[inAnnulus]) for inAnnulus in inAnnuli]
+    return ([pairRms[inAnnulus] for inAnnulus in inAnnuli], pairs,
+            (obj1[needed & noMatch], obj2[needed & noMatch]))
+
+
+# State of each worker process of `_evaluatePairChunksInPool`
+_workerState = {}
+
+
+def _initPairWorker(directory, objectIndex, meanRa, meanDec, envelope,
+                    annuliRadians, withPairs):
+    _workerState['finder'] = _PairFinder(meanRa, meanDec, envelope[1])
+    _workerState['visitVectors'] = VisitVectors.load(directory, objectIndex)
+    _workerState['envelope'] = envelope
+    _workerState['annuliRadians'] = annuliRadians
+    _workerState['withPairs'] = withPairs
+
+
+def _evaluatePairChunkInWorker(bounds):
+    return _evaluatePairChunk(_workerState['finder'],
+                              _workerState['visitVectors'],
+                              _workerState['envelope'],
+                              _workerState['annuliRadians'],
+                              bounds[0], bounds[1],
+                              _workerState['withPairs'])
+
+
+def _evaluatePairChunksInPool(objects, envelope, annuliRadians, nWorkers,
+                              chunkSize, withPairs=False):
+    """Evaluate all chunks of pairs on a process pool, yielding the
+    results of `_evaluatePairChunk` in chunk order.
+
+    The workers memory-map the detections read-only from the files of
+    `VisitVectors.sharedDirectory`, which are written once for all the
+    calls on the same `AMxObjectArrays`.
+    """
+    nPositions = _PairFinder(objects.meanRa, objects.meanDec,
+                             envelope[1]).nPositions
+    bounds = [(start, start + chunkSize)
+              for start in range(0, nPositions, chunkSize)]
+
+    visitVectors = objects.visitVectors
+    objectIndex = visitVectors.detectionObjects(np.arange(len(objects)))
+    pool = multiprocessing.Pool(
+        nWorkers, initializer=_initPairWorker,
+        initargs=(visitVectors.sharedDirectory(), objectIndex,
+                  objects.meanRa, objects.meanDec, envelope, annuliRadians,
+                  withPairs))
+    try:
+        for result in pool.imap(_evaluatePairChunkInWorker, bounds):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+class _PairFinder(object):
+    """k-d tree over unit vectors to find pairs of positions within a
+    maximum separation, a chunk of first positions at a time.
+    """
+
+    def __init__(self, ra, dec, maxRadius):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        # Positions with non-finite coordinates are never within an annulus
+        self.finite, = np.where(np.isfinite(self.ra) & np.isfinite(self.dec))
+        cosDec = np.cos(self.dec[self.finite])
+        self.vectors = np.column_stack([cosDec*np.cos(self.ra[self.finite]),
+                                        cosDec*np.sin(self.ra[self.finite]),
+                                        np.sin(self.dec[self.finite])])
+        self.tree = cKDTree(self.vectors) if len(self.finite) > 1 else None
+        self.chordRadius = 2*np.sin(min(maxRadius, np.pi)/2)*(1 + 1e-8) + 1e-12
+
+    @property
+    def nPositions(self):
+        """Number of positions with finite coordinates."""
+        return len(self.finite) if self.tree is not None else 0
+
+    def pairs(self, start, stop, annulusRadians):
+        """Pairs within ``annulusRadians`` whose first position is one of
+        the finite positions ``start`` to ``stop``, in the order of a
+        brute-force search.
+        """
+        return self.pairsOf(np.arange(start, min(stop, self.nPositions)),
+                            annulusRadians)
+
+    def pairsOf(self, positions, annulusRadians):
+        """Pairs within ``annulusRadians`` whose first position is one of
+        the finite positions ``positions``, sorted by first and then second
+        position.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        if self.tree is None or len(positions) == 0:
+            return empty, empty, np.zeros(0)
+        neighbors = self.tree.query_ball_point(self.vectors[positions],
+                                               self.chordRadius)
+        counts = np.array([len(n) for n in neighbors], dtype=np.int64)
+        if counts.sum() == 0:
+            return empty, empty, np.zeros(0)
+        first = self.finite[np.repeat(positions, counts)]
+        second = self.finite[np.concatenate([np.asarray(n, dtype=np.int64)
+                                             for n in neighbors])]
+
+        # Keep each pair once, in the order of a brute-force search
+        later = second > first
+        first, second = first[later], second[later]
+        order = np.lexsort((second, first))
+        first, second = first[order], second[order]
+
+        dist = sphDist(self.ra[first], self.dec[first],
+                       self.ra[second], self.dec[second])
+        inAnnulus = (annulusRadians[0] <= dist) & (dist < annulusRadians[1])
+        return first[inAnnulus], second[inAnnulus], dist[inAnnulus]
+
+
+class VisitVectors(object):
+    """Unit vectors of the positions of objects in the visits in which they
+    were detected, stored flat, by object and then visit.
+
+    Memory grows with the number of detections rather than with the number
+    of objects times the number of visits, and selecting objects (`select`)
+    does not copy the detections.
+
+    Parameters
+    ----------
+    visits : `numpy.ndarray`
+        Sorted identifiers of the visits.
+    offsets : `numpy.ndarray`
+        Index of the first detection of each object, followed by the total
+        number of detections. Shape: ``(nObjects + 1,)``.
+    keys : `numpy.ndarray`
+        ``object*len(visits) + visitIndex`` of each detection, which sorts
+        the detections.
+    vectors : `numpy.ndarray`
+        Unit vector of the position of each detection.
+        Shape: ``(nDetections, 3)``.
+    objectIndex : `numpy.ndarray`, optional
+        Object of the detections behind each object of this selection; all
+        objects, in order, if `None`.
+    """
+
+    _arrayNames = ('visits', 'offsets', 'keys', 'vectors')
+
+    def __init__(self, visits, offsets, keys, vectors, objectIndex=None):
+        self.visits = np.asarray(visits)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.keys = keys
+        self.vectors = vectors
+        self.objectIndex = objectIndex
+        self._directory = None
+        # Owner of the detection arrays, if this is a selection
+        self._base = None
+
+    @classmethod
+    def fromDetections(cls, visits, ras, decs):
+        """Collect the unit vectors of the detections of objects.
+
+        Parameters
+        ----------
+        visits : `list` of `numpy.ndarray`
+            Visits in which each object was detected.
+        ras, decs : `list` of `numpy.ndarray`
+            RA and Dec of each detection of each object. [radians]
+
+        Returns
+        -------
+        visitVectors : `VisitVectors`
+
+        Notes
+        -----
+        If an object has several detections in the same visit, the first
+        one is used. Detections with non-finite coordinates are dropped.
+        """
+        counts = np.array([len(v) for v in visits], dtype=np.int64)
+        if counts.sum() == 0:
+            return cls(np.zeros(0), np.zeros(len(visits) + 1),
+                       np.zeros(0, dtype=np.int64), np.zeros((0, 3)))
+        allVisits = np.concatenate([np.asarray(v) for v in visits])
+        uniqueVisits, visitIndex = np.unique(allVisits, return_inverse=True)
+        objectIndex = np.repeat(np.arange(len(visits)), counts)
+
+        # Keep the first detection of each object in each visit
+        keys, detections = np.unique(objectIndex*len(uniqueVisits) +
+                                     visitIndex, return_index=True)
+        ra = _concatenate(ras)[detections]
+        dec = _concatenate(decs)[detections]
+        finite = np.isfinite(ra) & np.isfinite(dec)
+        keys, ra, dec = keys[finite], ra[finite], dec[finite]
+
+        # Trigonometric functions are only evaluated once per detection
+        cosDec = np.cos(dec)
+        vectors = np.column_stack([cosDec*np.cos(ra), cosDec*np.sin(ra),
+                                   np.sin(dec)])
+        objectCounts = np.bincount(keys // len(uniqueVisits),
+                                   minlength=len(visits))
+        offsets = np.concatenate([[0], np.cumsum(objectCounts)])
+        return cls(uniqueVisits, offsets, keys, vectors)
+
+    def __len__(self):
+        if self.objectIndex is not None:
+            return len(self.objectIndex)
+        return len(self.offsets) - 1
+
+    def __del__(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def select(self, selection):
+        """Return the objects selected by a boolean mask or index array,
+        sharing the detections.
+        """
+        indices = np.arange(len(self))[selection]
+        if self.objectIndex is not None:
+            indices = self.objectIndex[indices]
+        selected = VisitVectors(self.visits, self.offsets, self.keys,
+                                self.vectors, objectIndex=indices)
+        selected._base = self._base or self
+        return selected
+
+    def detectionObjects(self, objects):
+        """Index in ``offsets`` of the detections of ``objects``."""
+        objects = np.asarray(objects, dtype=np.int64)
+        if self.objectIndex is not None:
+            return self.objectIndex[objects]
+        return objects
+
+    def updateDigest(self, sha):
+        """Update a `hashlib` object with the visits and unit vectors of
+        the detections of each object, in order.
+        """
+        objects = self.detectionObjects(np.arange(len(self)))
+        counts = self.offsets[objects + 1] - self.offsets[objects]
+        starts = np.cumsum(counts) - counts
+        detections = (np.repeat(self.offsets[objects] - starts, counts) +
+                      np.arange(counts.sum()))
+        nVisits = max(len(self.visits), 1)
+        sha.update(np.ascontiguousarray(self.visits).tobytes())
+        sha.update(np.ascontiguousarray(counts, dtype='<i8').tobytes())
+        sha.update(np.ascontiguousarray(self.keys[detections] % nVisits,
+                                        dtype='<i8').tobytes())
+        sha.update(np.ascontiguousarray(self.vectors[detections],
+                                        dtype='<f8').tobytes())
+
+    def sharedDirectory(self):
+        """Directory holding the detection arrays as ``.npy`` files, for
+        other processes to memory-map (see `load`).
+
+        The files are written on first use and shared by all the selections
+        of the same detections; they are removed with this object.
+        """
+        base = self._base or self
+        if base._directory is None:
+            directory = tempfile.mkdtemp(prefix='amx-')
+            for name in self._arrayNames:
+                np.save(os.path.join(directory, name + '.npy'),
+                        getattr(base, name))
+            base._directory = directory
+        return base._directory
+
+    @classmethod
+    def load(cls, directory, objectIndex=None):
+        """Memory-map read-only the detections written by
+        `sharedDirectory`.
+        """
+        arrays = [np.load(os.path.join(directory, name + '.npy'),
+                          mmap_mode='r')
+                  for name in cls._arrayNames]
+        return cls(*arrays, objectIndex=objectIndex)
+
+
+def _concatenate(arrays):
+    return np.concatenate([np.asarray(a, dtype=float) for a in arrays])
+
+
+def calcPairRmsDistances(visitVectors, obj1, obj2, batchElements=2**20):
+    """Calculate the RMS over visits of the separation of pairs of objects.
+
+    Equivalent to the standard deviation of the distances returned by
+    `matchVisitComputeDistance` for each pair, computed for many pairs at
+    once.
+
+    Parameters
+    ----------
+    visitVectors : `VisitVectors`
+        Per-visit unit vectors of the objects.
+    obj1, obj2 : `numpy.ndarray`
+        Indices of the two objects of each pair.
+    batchElements : `int`, optional
+        Approximate number of detections matched at a time; limits memory
+        use.
+
+    Returns
+    -------
+    rmsDistances : `numpy.ndarray`
+        RMS separation of each pair over the visits in which both objects
+        have finite coordinates, or NaN if there are no such visits.
+        [radians]
+
+    Notes
+    -----
+    The detections of the object of each pair with the fewer detections
+    are looked up among those of the other by their sorted keys, so the
+    cost grows with the number of detections rather than of visits.
+
+    The separations are computed from the chord between the unit vectors,
+    ``2*arcsin(chord/2)``, which is as accurate as the haversine formula
+    used by `sphDist` at small angles and needs no trigonometric function
+    of the coordinates.
+    """
+    rmsDistances = np.full(len(obj1), np.nan)
+    keys, offsets = visitVectors.keys, visitVectors.offsets
+    if len(obj1) == 0 or len(keys) == 0:
+        return rmsDistances
+    obj1 = visitVectors.detectionObjects(obj1)
+    obj2 = visitVectors.detectionObjects(obj2)
+    counts = np.diff(offsets)
+    swap = counts[obj1] > counts[obj2]
+    obj1, obj2 = np.where(swap, obj2, obj1), np.where(swap, obj1, obj2)
+    nVisits = len(visitVectors.visits)
+
+    # Batches of pairs with about batchElements detections of obj1
+    cumulative = np.cumsum(counts[obj1])
+    bounds = np.searchsorted(cumulative, np.arange(batchElements,
+                                                   cumulative[-1],
+                                                   batchElements))
+    bounds = np.unique(np.concatenate([[0], bounds, [len(obj1)]]))
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        o1, o2 = obj1[start:stop], obj2[start:stop]
+        n1 = counts[o1]
+        nPairs = len(o1)
+        pair = np.repeat(np.arange(nPairs), n1)
+        starts = np.cumsum(n1) - n1
+        detection1 = (np.repeat(offsets[o1] - starts, n1) +
+                      np.arange(len(pair)))
+        # Key of the detection of obj2 in the same visit, if any
+        target = keys[detection1] + ((o2 - o1)*nVisits)[pair]
+        detection2 = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+        matched = keys[detection2] == target
 
-            finiteEntries, = np.where(np.isfinite(distances))
-            if len(finiteEntries) > 0:
-                rmsDist = np.std(np.array(distances)[finiteEntries])
-                rmsDistances.append(rmsDist)
+        pair = pair[matched]
+        difference = (np.take(visitVectors.vectors, detection1[matched], axis=0) -
+                      np.take(visitVectors.vectors, detection2[matched], axis=0))
+        chord = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+        dist = 2*np.arcsin(0.5*chord)
+        nShared = np.bincount(pair, minlength=nPairs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(pair, dist, minlength=nPairs) / nShared
+            residuals = dist - mean[pair]
+            rms = np.sqrt(np.bincount(pair, residuals**2, minlength=nPairs) /
+                          nShared)
+        rmsDistances[start:stop] = np.where(nShared > 0, rms, np.nan)
 
-    # return quantity
-    rmsDistances = np.array(rmsDistances) * u.radian
     return rmsDistances
 
 
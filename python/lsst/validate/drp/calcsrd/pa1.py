@@ -19,9 +19,10 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 
 from __future__ import print_function, absolute_import
-from builtins import range
+from builtins import zip
 
 import math
+import multiprocessing
 
 import numpy as np
 import scipy.stats
@@ -30,6 +31,11 @@ import astropy.units as u
 import lsst.pipe.base as pipeBase
 from lsst.validate.base import MeasurementBase
 
+from ..bootstrap import ClusterBootstrap, bootstrapCounts, percentileInterval
+from ..groupedarrays import GroupedArrays
+from ..sorteddistribution import SortedDistribution
+from ..util import makeSeed, quantityValues, randomStream, weightedPercentile
+
 
 class PA1Measurement(MeasurementBase):
     """Measurement of the PA1 metric: photometric repeatability of
@@ -44,6 +50,26 @@ class PA1Measurement(MeasurementBase):
         filter_name (filter name) used in this measurement (e.g., `'r'`)
     numRandomShuffles : int
         Number of times to draw random pairs from the different observations.
+    seed : int, optional
+        Seed of the random pairs, recorded as the ``seed`` parameter. A new
+        seed is drawn if `None`.
+    nWorkers : int, optional
+        Number of processes over which to split the random shuffles. The
+        result does not depend on it.
+    exact : bool, optional
+        Use every pair of visits of every star, weighted so that each star
+        contributes equally, instead of random shuffles (see `calcPa1`).
+    storedShuffles : int, optional
+        Number of random samples of ``magDiff`` to keep as extras (and so to
+        serialize with the measurement). All are kept if `None`. With 0,
+        `~lsst.validate.drp.plot.plotPA1` plots the first sample of
+        ``shuffleMagDiffs``, so a measurement loaded from JSON cannot be
+        plotted.
+    nBootstrap : int, optional
+        If given, number of bootstrap resamplings of the stars from which a
+        confidence interval on PA1 is computed, as the ``interval`` extra,
+        and on PA2 and PF1 (see `absMagDiffBootstrap`). The resamplings are
+        drawn from ``seed``, which is then also recorded if ``exact``.
     verbose : bool, optional
         Output additional information on the analysis steps.
     job : :class:`lsst.validate.drp.base.Job`, optional
@@ -62,9 +88,26 @@ class PA1Measurement(MeasurementBase):
     iqr : ndarray
        Photometric repeatability IQR of stellar pairs for each random sample.
     magDiff : ndarray
-        Magnitude differences of stars between visits, for each random sample.
+        Magnitude differences of stars between visits, for each of the first
+        ``storedShuffles`` random samples, as float32.
     magMean : ndarray
-        Mean magnitude of stars seen across visits, for each random sample.
+        Mean magnitude of stars seen across visits, as float32. It has a
+        single row, which lines up with every row of ``magDiff``.
+    magDiffWeight : ndarray or `None`
+        Weight of each of ``magDiff``, if ``exact``, as float32.
+    shuffleMagDiffs : ndarray
+        Magnitude differences [mmag] of all the random samples, as float32.
+        Not serialized; see `shuffleSamples`.
+    shuffleWeights : ndarray or `None`
+        Weight of each of ``shuffleMagDiffs``, if ``exact``. Not serialized.
+    shuffleStars : ndarray
+        Index in ``matchedDataset.safeMatches`` of the star of each column of
+        ``shuffleMagDiffs``. Not serialized.
+    interval : `astropy.units.Quantity`
+        Bootstrap confidence interval on PA1, with ``nBootstrap``.
+    bootstrapCounts : ndarray or `None`
+        Number of times each star is drawn in each bootstrap resampling,
+        with ``nBootstrap``. Not serialized.
 
     See also
     --------
@@ -75,7 +118,8 @@ class PA1Measurement(MeasurementBase):
 
     def __init__(self, metric, matchedDataset, filter_name,
                  numRandomShuffles=50, verbose=False, job=None,
-                 linkedBlobs=None):
+                 linkedBlobs=None, seed=None, nWorkers=1, exact=False,
+                 storedShuffles=None, nBootstrap=None):
         MeasurementBase.__init__(self)
         self.filter_name = filter_name
         self.metric = metric
@@ -86,6 +130,23 @@ class PA1Measurement(MeasurementBase):
                                 numRandomShuffles,
                                 label='shuffles',
                                 description='Number of random shuffles')
+        self.register_parameter('exact', exact, label='exact',
+                                description='Whether all pairs of visits '
+                                            'were used instead of random '
+                                            'shuffles')
+        if not exact:
+            seed = makeSeed(seed)
+            self.register_parameter('seed', seed, label='seed',
+                                    description='Seed of the random shuffles')
+        elif nBootstrap is not None:
+            seed = makeSeed(seed)
+            self.register_parameter('seed', seed, label='seed',
+                                    description='Seed of the bootstrap '
+                                                'resamplings')
+        self.register_parameter('storedShuffles', storedShuffles,
+                                label='stored shuffles',
+                                description='Number of random samples of the '
+                                            'magnitude differences stored')
 
         # register measurement extras
         self.register_extra(
@@ -99,11 +160,11 @@ class PA1Measurement(MeasurementBase):
         self.register_extra(
             'magDiff', label='Delta mag',
             description='Photometric repeatability differences magnitudes for '
-                        'stellar pairs for each random sample')
+                        'stellar pairs for each stored random sample')
         self.register_extra(
             'magMean', label='mag',
             description='Mean magnitude of pairs of stellar sources matched '
-                        'across visits, for each random sample.')
+                        'across visits.')
 
         self.matchedDataset = matchedDataset
         # Add external blob so that links will be persisted with
@@ -114,32 +175,228 @@ class PA1Measurement(MeasurementBase):
 
         matches = matchedDataset.safeMatches
         magKey = matchedDataset.magKey
-        results = calcPa1(matches, magKey, numRandomShuffles=numRandomShuffles)
+        results = calcPa1(matches, magKey, numRandomShuffles=numRandomShuffles,
+                          seed=seed, nWorkers=nWorkers, exact=exact)
+        self.shuffleMagDiffs = quantityValues(results['magDiff'],
+                                              u.mmag).astype(np.float32)
+        self.shuffleWeights = results['magDiffWeight']
+        self.shuffleStars = results['star']
+        self._absMagDiffDistributions = {}
+        if exact:
+            self.register_extra(
+                'magDiffWeight', label='weight',
+                description='Weight of each magnitude difference, so that '
+                            'every star contributes equally')
+            self.magDiffWeight = u.Quantity(self.shuffleWeights[:storedShuffles],
+                                            u.Unit(''), dtype=np.float32)
+        else:
+            # Plain attribute: a class default would shadow the extra
+            self.magDiffWeight = None
         self.rms = results['rms']
         self.iqr = results['iqr']
-        self.magDiff = results['magDiff']
-        self.magMean = results['magMean']
+        self.magDiff = u.Quantity(self.shuffleMagDiffs[:storedShuffles], u.mmag,
+                                  copy=False)
+        self.magMean = u.Quantity(results['magMean'][:1], u.mag, dtype=np.float32)
         self.quantity = results['PA1']
 
+        self.bootstrapCounts = None
+        self._absMagDiffBootstraps = {}
+        if nBootstrap is not None:
+            self.register_parameter('nBootstrap',
+                                    quantity=nBootstrap * u.Unit(''),
+                                    label='bootstrap',
+                                    description='Number of bootstrap '
+                                                'resamplings of the stars')
+            self.register_extra(
+                'interval', label='PA1 CI',
+                description='Bootstrap 95% confidence interval on PA1, '
+                            'resampling the stars')
+            # The shuffles draw from the streams of [seed, i], the
+            # resamplings from that of seed itself
+            nStars = self.shuffleStars.max() + 1 if len(self.shuffleStars) else 0
+            self.bootstrapCounts = bootstrapCounts(nStars, nBootstrap, seed)
+            self.interval = percentileInterval(self._bootstrapIqr()) * u.mmag
+
         if job:
             job.register_measurement(self)
 
+    def shuffleSamples(self, allShuffles=True):
+        """Magnitude differences of the random samples, e.g. to compute PA2
+        and PF1.
+
+        Parameters
+        ----------
+        allShuffles : `bool`, optional
+            Return every random sample, instead of the first one only.
+
+        Returns
+        -------
+        magDiffs : `numpy.ndarray`
+            Magnitude differences [mmag], one row per random sample (a single
+            row of all pairs of visits if ``exact``).
+        weights : `numpy.ndarray` or `None`
+            Weight of each of ``magDiffs`` if ``exact``, `None` otherwise.
+        """
+        rows = slice(None) if allShuffles else slice(0, 1)
+        if self.shuffleWeights is None:
+            return self.shuffleMagDiffs[rows], None
+        return self.shuffleMagDiffs[rows], self.shuffleWeights[rows]
+
+    def absMagDiffDistribution(self, allShuffles=True):
+        """Sorted absolute magnitude differences of the random samples,
+        shared by the PA2 and PF1 measurements of every specification
+        level.
+
+        Parameters
+        ----------
+        allShuffles : `bool`, optional
+            Include every random sample, instead of the first one only.
+
+        Returns
+        -------
+        distribution : `lsst.validate.drp.sorteddistribution.SortedDistribution`
+            Absolute magnitude differences [mmag], one row per random sample
+            (see `shuffleSamples`), sorted on the first call.
+        """
+        if allShuffles not in self._absMagDiffDistributions:
+            magDiffs, weights = self.shuffleSamples(allShuffles)
+            self._absMagDiffDistributions[allShuffles] = SortedDistribution(
+                np.abs(magDiffs), weights)
+        return self._absMagDiffDistributions[allShuffles]
+
+    def absMagDiffBootstrap(self, allShuffles=True):
+        """Bootstrap resamplings of the absolute magnitude differences of the
+        random samples, by star, shared by the confidence intervals on PA2
+        and PF1 of every specification level.
+
+        Parameters
+        ----------
+        allShuffles : `bool`, optional
+            Include every random sample, instead of the first one only.
+
+        Returns
+        -------
+        bootstrap : `lsst.validate.drp.bootstrap.ClusterBootstrap` or `None`
+            Absolute magnitude differences [mmag], one row per random sample
+            (see `shuffleSamples`), resampled by star as for the interval on
+            PA1; `None` without ``nBootstrap``.
+        """
+        if self.bootstrapCounts is None:
+            return None
+        if allShuffles not in self._absMagDiffBootstraps:
+            magDiffs, weights = self.shuffleSamples(allShuffles)
+            self._absMagDiffBootstraps[allShuffles] = ClusterBootstrap(
+                np.abs(magDiffs), self.shuffleStars, self.bootstrapCounts,
+                weights)
+        return self._absMagDiffBootstraps[allShuffles]
+
+    def _bootstrapIqr(self):
+        """PA1 of each bootstrap resampling [mmag]."""
+        if self.shuffleWeights is not None:
+            # As computeExactWidths: the quartiles are -/+ the median of the
+            # absolute differences
+            upperQuartile = self.absMagDiffBootstrap().percentile(50.)[:, 0]
+            return 2*upperQuartile * _gaussianSigmaPerIqr
+        bootstrap = ClusterBootstrap(self.shuffleMagDiffs, self.shuffleStars,
+                                     self.bootstrapCounts)
+        quartiles = bootstrap.percentile((25., 75.))
+        iqr = (quartiles[..., 1] - quartiles[..., 0]) * _gaussianSigmaPerIqr
+        # PA1 is the mean over the random samples
+        return np.mean(iqr, axis=1)
+
+
+def absMagDiffDistribution(pa1, allShuffles=True):
+    """Sorted absolute magnitude differences of a PA1 measurement, computed
+    in this run or loaded from JSON.
+
+    Parameters
+    ----------
+    pa1 : `PA1Measurement`
+        A PA1 measurement. If it was loaded from JSON, so has no
+        ``shuffleMagDiffs``, its stored ``magDiff`` samples are used instead
+        of every random sample.
+    allShuffles : `bool`, optional
+        Include every (stored) random sample, instead of the first one only.
+
+    Returns
+    -------
+    distribution : `lsst.validate.drp.sorteddistribution.SortedDistribution`
+        Absolute magnitude differences [mmag], one row per random sample
+        (see `PA1Measurement.absMagDiffDistribution`).
+
+    Raises
+    ------
+    RuntimeError
+        If ``pa1`` was loaded from JSON without stored magnitude differences
+        (measured with ``storedShuffles=0``).
+    """
+    if getattr(pa1, 'shuffleMagDiffs', None) is not None:
+        return pa1.absMagDiffDistribution(allShuffles)
+
+    magDiffs = quantityValues(pa1.magDiff, u.mmag)
+    if len(magDiffs) == 0:
+        raise RuntimeError('No magnitude differences stored with the PA1 '
+                           'measurement.')
+    rows = slice(None) if allShuffles else slice(0, 1)
+    weights = getattr(pa1, 'magDiffWeight', None)
+    if weights is not None:
+        weights = quantityValues(weights, u.Unit(''))[rows]
+    return SortedDistribution(np.abs(magDiffs[rows]), weights)
+
+
+def absMagDiffBootstrap(pa1, allShuffles=True):
+    """Bootstrap resamplings of the absolute magnitude differences of a PA1
+    measurement, computed in this run or loaded from JSON.
 
-def calcPa1(matches, magKey, numRandomShuffles=50):
+    Parameters
+    ----------
+    pa1 : `PA1Measurement`
+        A PA1 measurement.
+    allShuffles : `bool`, optional
+        Include every random sample, instead of the first one only.
+
+    Returns
+    -------
+    bootstrap : `lsst.validate.drp.bootstrap.ClusterBootstrap` or `None`
+        Resampled absolute magnitude differences [mmag] (see
+        `PA1Measurement.absMagDiffBootstrap`); `None` without
+        ``nBootstrap`` or if ``pa1`` was loaded from JSON, as the stars of
+        the differences are not serialized.
+    """
+    if getattr(pa1, 'shuffleMagDiffs', None) is None:
+        return None
+    return pa1.absMagDiffBootstrap(allShuffles)
+
+
+def calcPa1(matches, magKey, numRandomShuffles=50, seed=None, nWorkers=1,
+            exact=False):
     """Calculate the photometric repeatability of measurements across a set
     of randomly selected pairs of visits.
 
     Parameters
     ----------
-    matches : `lsst.afw.table.GroupView`
+    matches : `lsst.afw.table.GroupView` or `GroupedArrays`
         `~lsst.afw.table.GroupView` of stars matched between visits,
         from MultiMatch, provided by
         `lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
-    magKey : `lsst.afw.table` schema key
+    magKey : `lsst.afw.table` schema key or `str`
         Magnitude column key in the ``groupView``.
         E.g., ``magKey = allMatches.schema.find("base_PsfFlux_mag").key``
         where ``allMatches`` is the result of
-        `lsst.afw.table.MultiMatch.finish()`.
+        `lsst.afw.table.MultiMatch.finish()`, or the field name if
+        ``matches`` is a `~lsst.validate.drp.groupedarrays.GroupedArrays`.
+    numRandomShuffles : `int`, optional
+        Number of times to draw random pairs of visits.
+    seed : `int`, optional
+        Seed of the random pairs; a new seed is drawn if `None`.
+    nWorkers : `int`, optional
+        Number of processes over which to split the random shuffles.
+    exact : `bool`, optional
+        Use every pair of visits of every star, weighted so that each star
+        contributes equally, instead of random shuffles. The statistics
+        then describe a single "sample" of all the pairs, with
+        ``magDiffWeight`` set, and ``numRandomShuffles``, ``seed`` and
+        ``nWorkers`` are ignored.
 
     Returns
     -------
@@ -158,6 +415,12 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
           between pairs of stars. Shape: ``(nRandomSamples, nMatches)``.
         - ``magMean``: `~astropy.unit.Quantity` array of mean magnitudes of
           each pair of stars. Shape: ``(nRandomSamples, nMatches)``.
+        - ``magDiffWeight``: `numpy.ndarray` of the weight of each
+          difference, with the shape of ``magDiff``, if ``exact``;
+          otherwise `None`.
+        - ``seed``: seed of the random pairs (`int`), `None` if ``exact``.
+        - ``star``: `numpy.ndarray` of the index in ``matches`` of the star
+          of each column of ``magDiff``.
 
     Notes
     -----
@@ -192,6 +455,10 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
     realistic sources of scatter such as bad zero points, that the metric
     should include.
 
+    Outlying detections and variable stars can also be rejected from
+    ``matches`` beforehand, with the ``clipSigma`` and ``maxChi2`` options
+    of `lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
+
     Examples
     --------
     Normally ``calcPa1`` is called by `PA1Measurement`, using data from
@@ -221,33 +488,66 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
     >>> psfMagKey = allMatches.schema.find("base_PsfFlux_mag").key
     >>> pa1 = calcPa1(allMatches, psfMagKey)
     """
-    pa1Samples = [calcPa1Sample(matches, magKey)
-                  for n in range(numRandomShuffles)]
-
-    rms = np.array([pa1.rms for pa1 in pa1Samples]) * u.mmag
-    iqr = np.array([pa1.iqr for pa1 in pa1Samples]) * u.mmag
-    magDiff = np.array([pa1.magDiffs for pa1 in pa1Samples]) * u.mmag
-    magMean = np.array([pa1.magMean for pa1 in pa1Samples]) * u.mag
+    # Draw the random pairs of all the shuffles at once
+    if exact:
+        return _calcExactPa1(matches, magKey)
+
+    seed = makeSeed(seed)
+    magDiffs = getRandomDiffsRmsInMmags(matches, magKey, numRandomShuffles,
+                                        seed=seed, nWorkers=nWorkers)
+    # The mean magnitudes do not depend on the pairs
+    magMean = matches.aggregate(np.mean, field=magKey)
+    rms, iqr = computeWidths(magDiffs)
+
+    # Wrap the sample arrays as Quantities without copying them
+    rms = u.Quantity(rms, u.mmag, copy=False)
+    iqr = u.Quantity(iqr, u.mmag, copy=False)
+    magDiff = u.Quantity(magDiffs, u.mmag, copy=False)
+    magMean = u.Quantity(np.broadcast_to(magMean, magDiffs.shape),
+                         u.mag, copy=False)
     pa1 = np.mean(iqr)
     return {'rms': rms, 'iqr': iqr, 'magDiff': magDiff, 'magMean': magMean,
-            'PA1': pa1}
+            'PA1': pa1, 'magDiffWeight': None, 'seed': seed,
+            'star': np.arange(magDiffs.shape[1])}
+
+
+def _calcExactPa1(matches, magKey):
+    """`calcPa1` from all the pairs of visits."""
+    pairs = getAllDiffsRmsInMmags(matches, magKey)
+    rmsPA1, iqrPA1 = computeExactWidths(pairs.magDiffs, pairs.weights)
+    magMean = matches.aggregate(np.mean, field=magKey)[pairs.star]
+
+    rms = u.Quantity([rmsPA1], u.mmag)
+    iqr = u.Quantity([iqrPA1], u.mmag)
+    magDiff = u.Quantity(pairs.magDiffs[np.newaxis], u.mmag, copy=False)
+    magMean = u.Quantity(magMean[np.newaxis], u.mag, copy=False)
+    return {'rms': rms, 'iqr': iqr, 'magDiff': magDiff, 'magMean': magMean,
+            'PA1': iqr[0], 'magDiffWeight': pairs.weights[np.newaxis],
+            'seed': None, 'star': pairs.star}
 
 
-def calcPa1Sample(matches, magKey):
+def calcPa1Sample(matches, magKey, seed=None):
     """Compute one realization of PA1 by randomly sampling pairs of
     visits.
 
+    `calcPa1` does not use this function: it draws all of its random
+    samples at once with `getRandomDiffsRmsInMmags`. This computes a single
+    one of them, with the same random pairs for the same ``seed``.
+
     Parameters
     ----------
-    matches : `lsst.afw.table.GroupView`
+    matches : `lsst.afw.table.GroupView` or `GroupedArrays`
         `~lsst.afw.table.GroupView` of stars matched between visits,
         from MultiMatch, provided by
         `lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
-    magKey : `lsst.afw.table` schema key
+    magKey : `lsst.afw.table` schema key or `str`
         Magnitude column key in the ``groupView``.
         E.g., ``magKey = allMatches.schema.find("base_PsfFlux_mag").key``
         where ``allMatches`` is the result of
-        `lsst.afw.table.MultiMatch.finish()`.
+        `lsst.afw.table.MultiMatch.finish()`, or the field name if
+        ``matches`` is a `~lsst.validate.drp.groupedarrays.GroupedArrays`.
+    seed : `int`, optional
+        Seed of the random pairs; a new seed is drawn if `None`.
 
     Returns
     -------
@@ -265,8 +565,8 @@ def calcPa1Sample(matches, magKey):
 
     See also
     --------
-    calcPa1 : A wrapper that repeatedly calls this function to build
-        the PA1 measurement.
+    calcPa1 : Computes every random sample of the PA1 measurement.
+    getRandomDiffsRmsInMmags : Draws the random pairs of visits.
 
     Examples
     --------
@@ -275,13 +575,173 @@ def calcPa1Sample(matches, magKey):
     example of how to call ``calcPa1Sample`` directly given a Butler output
     repository:
     """
-    magDiffs = matches.aggregate(getRandomDiffRmsInMmags, field=magKey)
+    magDiffs = getRandomDiffsRmsInMmags(matches, magKey, 1, seed=seed)[0]
     magMean = matches.aggregate(np.mean, field=magKey)
     rmsPA1, iqrPA1 = computeWidths(magDiffs)
     return pipeBase.Struct(rms=rmsPA1, iqr=iqrPA1,
                            magDiffs=magDiffs, magMean=magMean,)
 
 
+def getRandomDiffsRmsInMmags(matches, magKey, numRandomShuffles, seed=None,
+                             nWorkers=1):
+    """Calculate the RMS difference in mmag between random pairings of
+    visits of every star, for several shuffles at once.
+
+    Equivalent to calling `getRandomDiffRmsInMmags` on the magnitudes of
+    each star ``numRandomShuffles`` times, with one vectorized random draw
+    per shuffle instead of a Python call and shuffle per star and shuffle.
+
+    Parameters
+    ----------
+    matches : `lsst.afw.table.GroupView` or `GroupedArrays`
+        Stars matched between visits, each with at least two visits.
+    magKey : `lsst.afw.table` schema key or `str`
+        Magnitude column key in ``matches``.
+    numRandomShuffles : `int`
+        Number of random pairings of the visits of each star.
+    seed : `int`, optional
+        Seed of the random shuffles (see `lsst.validate.drp.util.makeSeed`).
+    nWorkers : `int`, optional
+        Number of processes over which to split the shuffles.
+
+    Returns
+    -------
+    rmsMmags : `numpy.ndarray`
+        RMS difference in mmag from a random pair of visits of each star
+        (columns), for each shuffle (rows).
+        Shape: ``(numRandomShuffles, len(matches))``.
+
+    Notes
+    -----
+    For each star with ``n`` visits, the first visit of the pair is drawn
+    uniformly among the ``n`` and the second among the ``n - 1`` others,
+    so every ordered pair of distinct visits is equally likely, as with
+    `getRandomDiff`.
+
+    Each shuffle draws from its own random stream of ``seed`` (see
+    `lsst.validate.drp.util.randomStream`), so the result does not depend
+    on ``nWorkers``.
+    """
+    mags, offsets = _groupedMagnitudes(matches, magKey)
+    seed = makeSeed(seed)
+
+    shuffles = np.arange(numRandomShuffles)
+    if nWorkers <= 1 or numRandomShuffles <= 1:
+        return _randomDiffsRmsInMmags(mags, offsets, seed, shuffles)
+
+    pool = multiprocessing.Pool(nWorkers, initializer=_initShuffleWorker,
+                                initargs=(mags, offsets, seed))
+    try:
+        diffs = pool.map(_randomDiffsRmsInMmagsInWorker,
+                         np.array_split(shuffles, nWorkers))
+    finally:
+        pool.close()
+        pool.join()
+    return np.concatenate(diffs)
+
+
+def getAllDiffsRmsInMmags(matches, magKey):
+    """Calculate the RMS difference in mmag of every pair of visits of
+    every star.
+
+    Parameters
+    ----------
+    matches : `lsst.afw.table.GroupView` or `GroupedArrays`
+        Stars matched between visits, each with at least two visits.
+    magKey : `lsst.afw.table` schema key or `str`
+        Magnitude column key in ``matches``.
+
+    Returns
+    -------
+    pairs : `lsst.pipe.base.Struct`
+        The pairs of visits, grouped by star. Fields are:
+
+        - ``magDiffs``: RMS difference in mmag of each pair, i.e. the
+          difference of the magnitudes in its first and second visits
+          divided by sqrt(2) (`numpy.ndarray`).
+        - ``weights``: weight of each pair, the inverse of the number of
+          pairs of its star, so that every star has a total weight of 1
+          (`numpy.ndarray`).
+        - ``star``: index of the star of each pair (`numpy.ndarray`).
+
+    Notes
+    -----
+    A star with ``n`` visits has ``n*(n - 1)/2`` pairs. Each pair stands for
+    both of its orders, which are equally likely to be drawn by
+    `getRandomDiffsRmsInMmags`, so the distribution of the random
+    differences of a star is that of ``magDiffs`` and ``-magDiffs``.
+    """
+    mags, offsets = _groupedMagnitudes(matches, magKey)
+    counts = np.diff(offsets)
+
+    # The stars with the same number of visits share the same pairs
+    first, second, star = [], [], []
+    for n in np.unique(counts):
+        stars, = np.where(counts == n)
+        i, j = np.triu_indices(n, 1)
+        start = offsets[stars][:, np.newaxis]
+        first.append((start + i).ravel())
+        second.append((start + j).ravel())
+        star.append(np.repeat(stars, len(i)))
+    first, second, star = [np.concatenate([np.zeros(0, dtype=np.int64)] + a)
+                           for a in (first, second, star)]
+    order = np.argsort(star, kind='mergesort')
+    first, second, star = first[order], second[order], star[order]
+
+    nPairs = counts*(counts - 1)//2
+    return pipeBase.Struct(
+        magDiffs=(1000/math.sqrt(2)) * (mags[first] - mags[second]),
+        weights=1./nPairs[star],
+        star=star)
+
+
+def _groupedMagnitudes(matches, magKey):
+    """Magnitudes of the stars of ``matches``, concatenated, and the
+    offsets of each star in them.
+    """
+    if isinstance(matches, GroupedArrays):
+        offsets = matches.offsets
+        mags = np.asarray(matches.columns[magKey], dtype=float)
+    else:
+        groupMags = [cat.get(magKey) for cat in matches.groups]
+        offsets = np.concatenate([[0], np.cumsum([len(m) for m in groupMags])])
+        mags = np.concatenate([np.zeros(0)] + groupMags).astype(float)
+    if np.any(np.diff(offsets) < 2):
+        raise ValueError('Every star needs at least two visits.')
+    return mags, offsets
+
+
+def _randomDiffsRmsInMmags(mags, offsets, seed, shuffles):
+    """`getRandomDiffsRmsInMmags` of the ``shuffles`` (indices of the random
+    streams) of the magnitudes of the groups ``offsets`` of ``mags``.
+    """
+    start = offsets[:-1]
+    counts = np.diff(offsets)
+    diffs = np.empty((len(shuffles), len(counts)))
+    for row, shuffle in zip(diffs, shuffles):
+        rng = randomStream(seed, shuffle)
+        first = rng.randint(counts)
+        second = rng.randint(counts - 1)
+        # Skip over the first visit
+        second += second >= first
+        row[:] = mags[start + first] - mags[start + second]
+    diffs *= 1000/math.sqrt(2)
+    return diffs
+
+
+# State of each worker process of `getRandomDiffsRmsInMmags`
+_shuffleWorkerState = {}
+
+
+def _initShuffleWorker(mags, offsets, seed):
+    _shuffleWorkerState['args'] = (mags, offsets, seed)
+
+
+def _randomDiffsRmsInMmagsInWorker(shuffles):
+    mags, offsets, seed = _shuffleWorkerState['args']
+    return _randomDiffsRmsInMmags(mags, offsets, seed, shuffles)
+
+
 def getRandomDiffRmsInMmags(array):
     """Calculate the RMS difference in mmag between a random pairing of
     visits of a star.
@@ -362,20 +822,94 @@ def getRandomDiff(array):
     return copy[0] - copy[1]
 
 
-def computeWidths(array):
-    """Compute the RMS and the scaled inter-quartile range of an array.
+def computeExactWidths(magDiffs, weights):
+    """Compute the RMS and the scaled inter-quartile range of the weighted
+    pair differences of `getAllDiffsRmsInMmags`.
+
+    These are the widths of the distribution from which each random sample
+    of `getRandomDiffsRmsInMmags` is drawn, i.e. the values that
+    `computeWidths` converges to for many stars.
 
     Parameters
     ----------
-    array : `list` or `numpy.ndarray`
-        Array.
+    magDiffs : `numpy.ndarray`
+        Differences of the pairs, each standing for both of its orders.
+    weights : `numpy.ndarray`
+        Weight of each pair.
 
     Returns
     -------
     rms : `float`
         RMS
     iqr : `float`
-        Scaled inter-quartile range (IQR, see *Notes*).
+        Scaled inter-quartile range (IQR, see `computeWidths`).
+    """
+    rmsSigma = math.sqrt(np.sum(weights*magDiffs**2) / np.sum(weights))
+    # The distribution of the differences in both orders is symmetric, so
+    # its quartiles are -/+ the median of the absolute differences
+    upperQuartile = weightedPercentile(np.abs(magDiffs), weights, 50.)
+    iqrSigma = 2*upperQuartile * _gaussianSigmaPerIqr
+    return rmsSigma, iqrSigma
+
+
+def computeGroupedWidths(offsets, magDiffs, weights=None):
+    """Compute the RMS and the scaled inter-quartile range of groups of
+    magnitude differences, all at once.
+
+    Parameters
+    ----------
+    offsets : `numpy.ndarray`
+        Offsets of each group in ``magDiffs``, as for `GroupedArrays`.
+    magDiffs : `numpy.ndarray`
+        Magnitude differences, grouped.
+    weights : `numpy.ndarray`, optional
+        Weight of each of ``magDiffs``, for the pairs of
+        `getAllDiffsRmsInMmags`.
+
+    Returns
+    -------
+    rms : `numpy.ndarray`
+        RMS of each group, as `computeWidths` (or `computeExactWidths` if
+        weighted) would compute it; NaN for empty groups.
+    iqr : `numpy.ndarray`
+        Scaled inter-quartile range (IQR, see `computeWidths`) of each group.
+    """
+    magDiffs = np.asarray(magDiffs, dtype=float)
+    columns = {'magDiff': magDiffs, 'magDiffSq': magDiffs**2}
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        columns.update(absMagDiff=np.abs(magDiffs), weight=weights,
+                       weightedMagDiffSq=weights*magDiffs**2)
+    grouped = GroupedArrays(offsets, columns)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if weights is None:
+            rmsSigma = np.sqrt(grouped.groupMean('magDiffSq'))
+            lower, upper = grouped.groupPercentile('magDiff', (25., 75.))
+            iqr = upper - lower
+        else:
+            rmsSigma = np.sqrt(grouped.groupSum('weightedMagDiffSq') /
+                               grouped.groupSum('weight'))
+            # See computeExactWidths
+            iqr = 2*grouped.groupPercentile('absMagDiff', 50., 'weight')
+    return rmsSigma, iqr * _gaussianSigmaPerIqr
+
+
+def computeWidths(array):
+    """Compute the RMS and the scaled inter-quartile range of an array, or
+    of each row of a 2-D array.
+
+    Parameters
+    ----------
+    array : `list` or `numpy.ndarray`
+        Array, or samples (rows) of the same length.
+
+    Returns
+    -------
+    rms : `float` or `numpy.ndarray`
+        RMS (of each row).
+    iqr : `float` or `numpy.ndarray`
+        Scaled inter-quartile range (IQR, see *Notes*) (of each row).
 
     Notes
     -----
@@ -386,7 +920,32 @@ def computeWidths(array):
 
     The IQR is scaled by the IQR/RMS ratio for a Gaussian such that it
     if the array is Gaussian distributed, then the scaled IQR = RMS.
+
+    The quartiles are those of `numpy.percentile`, found by partial sorting
+    (`numpy.partition`) of all rows at once.
     """
-    rmsSigma = math.sqrt(np.mean(array**2))
-    iqrSigma = np.subtract.reduce(np.percentile(array, [75, 25])) / (scipy.stats.norm.ppf(0.75)*2)
+    array = np.asarray(array, dtype=float)
+    rmsSigma = np.sqrt(np.mean(array**2, axis=-1))
+    lower, upper = _quantiles(array, (0.25, 0.75))
+    iqrSigma = (upper - lower) * _gaussianSigmaPerIqr
+    if array.ndim == 1:
+        return float(rmsSigma), float(iqrSigma)
     return rmsSigma, iqrSigma
+
+
+# Ratio of the standard deviation to the inter-quartile range of a Gaussian
+_gaussianSigmaPerIqr = 1. / (2*scipy.stats.norm.ppf(0.75))
+
+
+def _quantiles(array, quantiles):
+    """Quantiles of the last axis of ``array``, linearly interpolated as by
+    `numpy.percentile`, from a single partial sort.
+    """
+    n = array.shape[-1]
+    positions = np.asarray(quantiles, dtype=float)*(n - 1)
+    below = np.floor(positions).astype(int)
+    above = np.minimum(below + 1, n - 1)
+    partitioned = np.partition(array, np.unique(np.concatenate([below, above])),
+                               axis=-1)
+    return [partitioned[..., b] + (p - b)*(partitioned[..., a] - partitioned[..., b])
+            for p, b, a in zip(positions, below, above)]
@@ -24,6 +24,9 @@ import numpy as np
 import astropy.units as u
 
 from lsst.validate.base import MeasurementBase
+from ..bootstrap import percentileInterval
+from ..util import quantityValues
+from .pa1 import absMagDiffBootstrap, absMagDiffDistribution
 
 
 class PF1Measurement(MeasurementBase):
@@ -36,12 +39,22 @@ class PF1Measurement(MeasurementBase):
         A PF1 `~lsst.validate.base.Metric` instance.
     matchedDataset : lsst.validate.drp.matchreduce.MatchedMultiVisitDataset
     pa1 : PA1Measurement
-        A PA1 measurement instance.
+        A PA1 measurement instance, computed in this run or loaded from JSON.
+        A loaded one must have stored magnitude differences (``magDiff``,
+        see ``storedShuffles``); only those are used, and no ``interval`` is
+        reported.
     filter_name : str
         filter_name (filter name) used in this measurement (e.g., `'r'`).
     spec_name : str
         Name of a specification level to measure against (e.g., design,
         minimum, stretch).
+    allShuffles : bool, optional
+        Compute PF1 for every random sample of ``pa1`` and report the mean,
+        with the standard deviation as the ``shuffleStd`` extra, instead of
+        using the first sample only.
+        If ``pa1`` was measured with ``nBootstrap``, a bootstrap confidence
+        interval from the same resamplings of the stars is reported as the
+        ``interval`` extra.
     verbose : bool, optional
         Output additional information on the analysis steps.
     job : :class:`lsst.validate.drp.base.Job`, optional
@@ -62,7 +75,7 @@ class PF1Measurement(MeasurementBase):
     """
 
     def __init__(self, metric, matchedDataset, pa1, filter_name, spec_name,
-                 linkedBlobs=None, job=None, verbose=False):
+                 linkedBlobs=None, job=None, verbose=False, allShuffles=False):
         MeasurementBase.__init__(self)
         self.filter_name = filter_name
         self.spec_name = spec_name  # spec-dependent measure because of PF1 dep
@@ -72,6 +85,18 @@ class PF1Measurement(MeasurementBase):
             PA2.get_spec(spec_name, filter_name=self.filter_name)
         self.register_parameter('pa2', datum=pa2spec.datum)
 
+        self.register_parameter('allShuffles', allShuffles, label='all shuffles',
+                                description='Whether every random sample of '
+                                            'PA1 was used')
+        if allShuffles:
+            self.register_extra(
+                'shuffleValues', label='PF1',
+                description='PF1 of each random sample of PA1')
+            self.register_extra(
+                'shuffleStd', label='std(PF1)',
+                description='Standard deviation of PF1 over the random '
+                            'samples of PA1')
+
         self.matchedDataset = matchedDataset
 
         # Add external blob so that links will be persisted with
@@ -80,10 +105,25 @@ class PF1Measurement(MeasurementBase):
             for name, blob in linkedBlobs.items():
                 setattr(self, name, blob)
 
-        # Use first random sample from original PA1 measurement
-        magDiffs = pa1.magDiff[0, :]
+        # First random sample from the PA1 measurement, or all of them,
+        # sorted once for every spec level (and weighted if exact)
+        absMagDiffs = absMagDiffDistribution(pa1, allShuffles)
+        pa2 = quantityValues(self.pa2, u.mmag)
+        values = 100 * absMagDiffs.fractionAbove(pa2) * u.Unit('')
+        self.quantity = np.mean(values)
+        if allShuffles:
+            self.shuffleValues = values
+            self.shuffleStd = np.std(values)
 
-        self.quantity = 100 * np.mean(np.abs(magDiffs) > self.pa2) * u.Unit('')
+        bootstrap = absMagDiffBootstrap(pa1, allShuffles)
+        if bootstrap is not None:
+            self.register_extra(
+                'interval', label='PF1 CI',
+                description='Bootstrap 95% confidence interval on PF1, '
+                            'resampling the stars')
+            # Every resampling at once, averaged over the random samples
+            self.interval = percentileInterval(
+                np.mean(100 * bootstrap.fractionAbove(pa2), axis=1)) * u.Unit('')
 
         if job:
             job.register_measurement(self)
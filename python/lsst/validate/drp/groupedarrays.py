@@ -0,0 +1,535 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Compact columnar storage for sources matched across visits, with
+vectorized per-object reductions.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object, range, zip
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+__all__ = ['GroupedArrays']
+
+
+class GroupedArrays(object):
+    """Columns of matched sources stored as flat arrays, with the sources of
+    each group (object) stored contiguously.
+
+    `GroupedArrays` implements the parts of the `lsst.afw.table.GroupView`
+    interface used by ``validate_drp`` (``len``, ``groups``, ``where`` and
+    ``aggregate`` with field names), so it can stand in for a ``GroupView``
+    once the afw catalogs are no longer needed. It also provides vectorized
+    per-group reductions; `aggregate` uses them automatically for
+    `numpy.mean`, `numpy.std`, `numpy.median`, `numpy.min`, `numpy.max` and
+    `numpy.sum`.
+
+    Parameters
+    ----------
+    offsets : `numpy.ndarray`
+        Index of the first source of each group, followed by the total
+        number of sources. Shape: ``(nGroups + 1,)``.
+    columns : `dict` of `numpy.ndarray`
+        Per-source columns keyed by field name. Shape: ``(offsets[-1],)``.
+    ids : `numpy.ndarray`, optional
+        Identifier of each group (e.g., the ``object`` ID from
+        `lsst.afw.table.MultiMatch`). Shape: ``(nGroups,)``.
+    """
+
+    def __init__(self, offsets, columns, ids=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = OrderedDict(columns)
+        if ids is None:
+            ids = np.arange(len(self.offsets) - 1)
+        self.ids = np.asarray(ids)
+        self._groupIndex = None
+
+    @classmethod
+    def fromGroupView(cls, groupView, fields, dtypes=None):
+        """Copy columns out of a `lsst.afw.table.GroupView`.
+
+        Parameters
+        ----------
+        groupView : `lsst.afw.table.GroupView`
+            Matched sources grouped by object.
+        fields : `list` of `str`
+            Names of the fields to copy.
+        dtypes : `dict`, optional
+            Storage `numpy.dtype` for some or all of ``fields``. Fields that
+            are not listed keep the dtype of the afw table column.
+
+        Returns
+        -------
+        groupedArrays : `GroupedArrays`
+        """
+        if dtypes is None:
+            dtypes = {}
+        groups = groupView.groups
+        counts = np.array([len(cat) for cat in groups], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        columns = OrderedDict()
+        for name in fields:
+            if len(groups) > 0:
+                column = np.concatenate([np.asarray(cat.get(name))
+                                         for cat in groups])
+            else:
+                column = np.zeros(0)
+            if name in dtypes:
+                column = column.astype(dtypes[name])
+            columns[name] = column
+
+        ids = getattr(groupView, 'ids', None)
+        return cls(offsets, columns, ids=ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        """Number of sources in each group (`numpy.ndarray`)."""
+        return np.diff(self.offsets)
+
+    @property
+    def nSources(self):
+        """Total number of sources in all groups (`int`)."""
+        return int(self.offsets[-1])
+
+    @property
+    def groupIndex(self):
+        """Index of the group of each source (`numpy.ndarray`)."""
+        if self._groupIndex is None:
+            self._groupIndex = np.repeat(np.arange(len(self), dtype=np.int64),
+                                         self.counts)
+        return self._groupIndex
+
+    @property
+    def nbytes(self):
+        """Total memory used by the columns and offsets, in bytes (`int`)."""
+        return int(self.offsets.nbytes + self.ids.nbytes +
+                   sum(column.nbytes for column in self.columns.values()))
+
+    @property
+    def bytesPerSource(self):
+        """Memory used per source, in bytes (`float`)."""
+        return self.nbytes / max(self.nSources, 1)
+
+    def get(self, name):
+        """Flat column ``name`` for all sources (`numpy.ndarray`)."""
+        return self.columns[name]
+
+    @property
+    def groups(self):
+        """Per-group views with a ``get(name)`` method, like the catalogs in
+        `lsst.afw.table.GroupView.groups`.
+        """
+        return [_Group(self, i) for i in range(len(self))]
+
+    def subset(self, selection):
+        """Return the groups selected by a boolean mask or index array.
+
+        Parameters
+        ----------
+        selection : `numpy.ndarray`
+            Boolean mask with one entry per group, or group indices.
+
+        Returns
+        -------
+        groupedArrays : `GroupedArrays`
+        """
+        indices = np.arange(len(self))[selection]
+        counts = self.counts[indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        # Source indices of the selected groups, in group order
+        sourceIndices = (np.repeat(self.offsets[indices] - offsets[:-1], counts) +
+                         np.arange(offsets[-1]))
+        columns = OrderedDict((name, column[sourceIndices])
+                              for name, column in self.columns.items())
+        return GroupedArrays(offsets, columns, ids=self.ids[indices])
+
+    def selectSources(self, mask):
+        """Return the sources selected by a boolean mask, in the same groups.
+
+        Parameters
+        ----------
+        mask : `numpy.ndarray`
+            Boolean mask with one entry per source.
+
+        Returns
+        -------
+        groupedArrays : `GroupedArrays`
+            The selected sources, grouped as in ``self``. Groups may be left
+            with fewer sources, or none.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        counts = np.bincount(self.groupIndex[mask], minlength=len(self))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        columns = OrderedDict((name, column[mask])
+                              for name, column in self.columns.items())
+        return GroupedArrays(offsets, columns, ids=self.ids)
+
+    def where(self, predicate):
+        """Return the groups for which ``predicate(group)`` is true, like
+        `lsst.afw.table.GroupView.where`.
+        """
+        return self.subset(np.array([bool(predicate(group))
+                                     for group in self.groups], dtype=bool))
+
+    def aggregate(self, function, field=None, dtype=float):
+        """Apply a function to each group, like
+        `lsst.afw.table.GroupView.aggregate`.
+
+        Parameters
+        ----------
+        function : callable
+            Called with the column ``field`` of each group, or with the
+            group itself if ``field`` is `None`.
+        field : `str`, optional
+            Name of the column to pass to ``function``.
+        dtype : `numpy.dtype`, optional
+            Output dtype.
+
+        Returns
+        -------
+        output : `numpy.ndarray`
+            One value per group.
+        """
+        if field is not None and function in self._vectorizedReductions:
+            reduction = getattr(self, self._vectorizedReductions[function])
+            return reduction(field).astype(dtype)
+
+        output = np.zeros(len(self), dtype=dtype)
+        if field is None:
+            for i, group in enumerate(self.groups):
+                output[i] = function(group)
+        else:
+            column = self.columns[field]
+            for i in range(len(self)):
+                output[i] = function(column[self.offsets[i]:self.offsets[i+1]])
+        return output
+
+    def _values(self, field):
+        """Column ``field`` as float64, for accurate reductions."""
+        return np.asarray(self.columns[field], dtype=np.float64)
+
+    def groupSum(self, field):
+        """Sum of ``field`` in each group."""
+        return np.bincount(self.groupIndex, weights=self._values(field),
+                           minlength=len(self))
+
+    def groupMean(self, field):
+        """Mean of ``field`` in each group (NaN for empty groups)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.groupSum(field) / self.counts
+
+    def groupStd(self, field):
+        """Population standard deviation of ``field`` in each group, as
+        `numpy.std`.
+        """
+        values = self._values(field)
+        residuals = values - self.groupMean(field)[self.groupIndex]
+        sumSq = np.bincount(self.groupIndex, weights=residuals**2,
+                            minlength=len(self))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(sumSq / self.counts)
+
+    def groupMedian(self, field):
+        """Median of ``field`` in each group, as `numpy.median` (NaN if the
+        group is empty or contains a NaN).
+        """
+        values = self._values(field)
+        counts = self.counts
+        order = self._orderWithinGroups(values)
+        sortedValues = values[order]
+
+        median = np.full(len(self), np.nan)
+        nonEmpty = counts > 0
+        start = self.offsets[:-1][nonEmpty]
+        n = counts[nonEmpty]
+        median[nonEmpty] = 0.5*(sortedValues[start + (n - 1)//2] +
+                                sortedValues[start + n//2])
+        hasNan = np.bincount(self.groupIndex, weights=np.isnan(values),
+                             minlength=len(self)) > 0
+        median[hasNan] = np.nan
+        return median
+
+    def groupPercentile(self, field, percentiles, weightField=None):
+        """Percentiles of ``field`` in each group, as `numpy.percentile` or,
+        with weights, as `lsst.validate.drp.util.weightedPercentile` (NaN
+        if the group is empty, has no weight or contains a NaN).
+
+        Parameters
+        ----------
+        field : `str`
+            Name of the column.
+        percentiles : `float` or sequence of `float`
+            Percentiles to compute, between 0 and 100. The groups are sorted
+            once for all of them.
+        weightField : `str`, optional
+            Name of a column of non-negative weights of ``field``.
+
+        Returns
+        -------
+        result : `numpy.ndarray`
+            Shape: that of ``percentiles``, then the number of groups.
+        """
+        values = self._values(field)
+        order = self._orderWithinGroups(values)
+        sortedValues = values[order]
+        start = self.offsets[:-1]
+        last = np.maximum(self.offsets[1:] - 1, start)
+        quantiles = np.asarray(percentiles, dtype=float)/100.
+
+        result = np.full(quantiles.shape + (len(self),), np.nan)
+        if weightField is None:
+            nonEmpty = self.counts > 0
+            for quantile, row in zip(quantiles.ravel(), result.reshape(-1, len(self))):
+                rank = quantile*(self.counts[nonEmpty] - 1)
+                lower = start[nonEmpty] + np.floor(rank).astype(np.int64)
+                upper = np.minimum(lower + 1, last[nonEmpty])
+                row[nonEmpty] = (sortedValues[lower] + (rank - np.floor(rank)) *
+                                 (sortedValues[upper] - sortedValues[lower]))
+        else:
+            weights = self._values(weightField)[order]
+            totals = np.bincount(self.groupIndex, weights=weights,
+                                 minlength=len(self))
+            cumulative = np.cumsum(weights)
+            before = np.concatenate([[0.], cumulative])[start]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                midpoints = ((cumulative - before[self.groupIndex] - 0.5*weights) /
+                             totals[self.groupIndex])
+            # Each group's midpoints are in [0, 1], so offsetting them by
+            # twice the group index sorts them all; find the first midpoint
+            # of each group that is at least the quantile.
+            key = 2*self.groupIndex + np.nan_to_num(midpoints)
+            groups, = np.where(totals > 0)
+            for quantile, row in zip(quantiles.ravel(), result.reshape(-1, len(self))):
+                above = np.searchsorted(key, 2*groups + quantile)
+                above = np.clip(above, start[groups], last[groups])
+                below = np.maximum(above - 1, start[groups])
+                span = midpoints[above] - midpoints[below]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    fraction = np.where(span > 0,
+                                        (quantile - midpoints[below])/span, 1.)
+                fraction = np.clip(fraction, 0., 1.)
+                row[groups] = (sortedValues[below] + fraction *
+                               (sortedValues[above] - sortedValues[below]))
+        hasNan = np.bincount(self.groupIndex, weights=np.isnan(values),
+                             minlength=len(self)) > 0
+        result[..., hasNan] = np.nan
+        return result
+
+    def groupMode(self, field):
+        """Most frequent value of ``field`` in each group, the smallest in
+        case of a tie (NaN if the group is empty).
+        """
+        values = self._values(field)
+        order = self._orderWithinGroups(values)
+        sortedValues = values[order]
+        sortedGroups = self.groupIndex[order]
+        # Runs of equal values within each group
+        newRun = np.ones(len(values), dtype=bool)
+        newRun[1:] = ((sortedGroups[1:] != sortedGroups[:-1]) |
+                      (sortedValues[1:] != sortedValues[:-1]))
+        runStart, = np.where(newRun)
+        runLength = np.diff(np.append(runStart, len(values)))
+        runGroup = sortedGroups[runStart]
+        runValue = sortedValues[runStart]
+        # Longest, then smallest, run first in each group
+        runOrder = np.lexsort((runValue, -runLength, runGroup))
+        runGroup, runValue = runGroup[runOrder], runValue[runOrder]
+        first = np.ones(len(runGroup), dtype=bool)
+        first[1:] = runGroup[1:] != runGroup[:-1]
+
+        mode = np.full(len(self), np.nan)
+        mode[runGroup[first]] = runValue[first]
+        return mode
+
+    def groupSigmaClip(self, field, nSigma=3., maxIter=5, errField=None,
+                       mask=None):
+        """Iteratively reject the outlying sources of each group.
+
+        Each iteration rejects the sources of a group further from the
+        median of its remaining sources than ``nSigma`` times their standard
+        deviation or, with ``errField``, than ``nSigma`` times the reported
+        uncertainty of each source. It stops when no more sources are
+        rejected, or after ``maxIter`` iterations. All groups are processed
+        at once; the values are sorted within groups a single time.
+
+        Parameters
+        ----------
+        field : `str`
+            Name of the column.
+        nSigma : `float`, optional
+            Rejection threshold.
+        maxIter : `int`, optional
+            Maximum number of iterations.
+        errField : `str`, optional
+            Name of a column of 1-sigma uncertainties of ``field``.
+        mask : `numpy.ndarray`, optional
+            Boolean mask of the sources to start from; the others are
+            rejected.
+
+        Returns
+        -------
+        kept : `numpy.ndarray`
+            Boolean mask of the sources that were not rejected. Non-finite
+            values are always rejected.
+        """
+        values = self._values(field)
+        kept = np.isfinite(values)
+        if mask is not None:
+            kept &= np.asarray(mask, dtype=bool)
+        order = self._orderWithinGroups(values)
+        sortedValues = values[order]
+        if errField is not None:
+            tolerance = nSigma*self._values(errField)
+
+        for _ in range(maxIter):
+            center = self._keptGroupMedian(sortedValues, kept[order])
+            residuals = np.abs(values - center[self.groupIndex])
+            if errField is None:
+                nKept = np.bincount(self.groupIndex, weights=kept,
+                                    minlength=len(self))
+                keptValues = np.where(kept, values, 0.)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = np.bincount(self.groupIndex, weights=keptValues,
+                                       minlength=len(self)) / nKept
+                    variance = np.bincount(
+                        self.groupIndex,
+                        weights=kept*(keptValues - mean[self.groupIndex])**2,
+                        minlength=len(self)) / nKept
+                tolerance = nSigma*np.sqrt(variance)[self.groupIndex]
+            with np.errstate(invalid='ignore'):
+                clipped = kept & (residuals <= tolerance)
+            if np.array_equal(clipped, kept):
+                break
+            kept = clipped
+        return kept
+
+    def _keptGroupMedian(self, sortedValues, sortedKept):
+        """Median of the kept values of each group (NaN if none are kept),
+        given the values sorted within groups (see `_orderWithinGroups`).
+        """
+        nKept = np.bincount(self.groupIndex, weights=sortedKept,
+                            minlength=len(self)).astype(np.int64)
+        cumulative = np.cumsum(sortedKept)
+        keptBefore = np.concatenate([[0], np.cumsum(nKept)])[:-1]
+        median = np.full(len(self), np.nan)
+        groups, = np.where(nKept > 0)
+        # Position of the kept values of each rank within their group
+        lower = np.searchsorted(cumulative,
+                                keptBefore[groups] + (nKept[groups] - 1)//2 + 1)
+        upper = np.searchsorted(cumulative,
+                                keptBefore[groups] + nKept[groups]//2 + 1)
+        median[groups] = 0.5*(sortedValues[lower] + sortedValues[upper])
+        return median
+
+    def groupReducedChi2(self, field, errField, mask=None):
+        """Reduced chi-square of ``field`` in each group about its
+        inverse-variance weighted mean, e.g. to find variable objects.
+
+        Parameters
+        ----------
+        field : `str`
+            Name of the column.
+        errField : `str`
+            Name of a column of 1-sigma uncertainties of ``field``.
+        mask : `numpy.ndarray`, optional
+            Boolean mask of the sources to include.
+
+        Returns
+        -------
+        chi2 : `numpy.ndarray`
+            Chi-square per degree of freedom (NaN for groups with fewer than
+            two sources).
+        """
+        values = self._values(field)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weights = 1. / self._values(errField)**2
+        included = np.isfinite(values) & np.isfinite(weights)
+        if mask is not None:
+            included &= np.asarray(mask, dtype=bool)
+        weights = np.where(included, weights, 0.)
+        values = np.where(included, values, 0.)
+
+        def groupSum(x):
+            return np.bincount(self.groupIndex, weights=x, minlength=len(self))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = groupSum(weights*values) / groupSum(weights)
+            chi2 = groupSum(weights*(values - mean[self.groupIndex])**2)
+            dof = groupSum(included) - 1
+            return np.where(dof > 0, chi2 / dof, np.nan)
+
+    def _orderWithinGroups(self, values):
+        """Indices that sort ``values`` within each group.
+
+        The values are sorted, then stably by group, which is about twice as
+        fast as `numpy.lexsort`.
+        """
+        order = np.argsort(values, kind='quicksort')
+        return order[np.argsort(self.groupIndex[order], kind='mergesort')]
+
+    def _groupExtremum(self, field, ufunc):
+        values = self._values(field)
+        result = np.full(len(self), np.nan)
+        nonEmpty = self.counts > 0
+        if nonEmpty.any():
+            result[nonEmpty] = ufunc.reduceat(values,
+                                              self.offsets[:-1][nonEmpty])
+        return result
+
+    def groupMax(self, field):
+        """Maximum of ``field`` in each group, as `numpy.max`."""
+        return self._groupExtremum(field, np.maximum)
+
+    def groupMin(self, field):
+        """Minimum of ``field`` in each group, as `numpy.min`."""
+        return self._groupExtremum(field, np.minimum)
+
+    _vectorizedReductions = {
+        np.sum: 'groupSum',
+        np.mean: 'groupMean',
+        np.std: 'groupStd',
+        np.median: 'groupMedian',
+        np.max: 'groupMax',
+        np.min: 'groupMin',
+    }
+
+
+class _Group(object):
+    """View of the columns of one group of a `GroupedArrays`."""
+
+    def __init__(self, groupedArrays, index):
+        self._groupedArrays = groupedArrays
+        self._slice = slice(groupedArrays.offsets[index],
+                            groupedArrays.offsets[index + 1])
+
+    def __len__(self):
+        return self._slice.stop - self._slice.start
+
+    def get(self, name):
+        return self._groupedArrays.columns[name][self._slice]
+
+    __getitem__ = get
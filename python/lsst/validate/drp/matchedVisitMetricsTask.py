@@ -3,7 +3,7 @@ from __future__ import division, print_function, absolute_import
 import os
 
 from lsst.pipe.base import CmdLineTask, ArgumentParser, TaskRunner
-from lsst.pex.config import Config, Field
+from lsst.pex.config import Config, Field, ListField
 from lsst.meas.base.forcedPhotCcd import PerTractCcdDataIdContainer
 from lsst.utils import getPackageDir
 from lsst.validate.base import load_metrics
@@ -52,6 +52,29 @@ class MatchedVisitMetricsConfig(Config):
         dtype=float, default=50,
         doc="Minimum median PSF signal-to-noise ratio for a match to be considered safe."
     )
+    compact = Field(
+        dtype=bool, default=False,
+        doc="Store matched sources in compact form (float32 photometry, "
+            "only the fields used) to reduce memory use."
+    )
+    clipSigma = Field(
+        dtype=float, optional=True,
+        doc="If set, reject safe detections further than this many standard "
+            "deviations from the median magnitude of their star (requires compact)."
+    )
+    maxChi2 = Field(
+        dtype=float, optional=True,
+        doc="If set, reject safe stars whose magnitudes have a larger reduced "
+            "chi-square than this, e.g. variable stars (requires compact)."
+    )
+    safeSnrSweep = ListField(
+        dtype=float, default=[],
+        doc="safeSnr thresholds at which to additionally evaluate PA1."
+    )
+    brightSnrSweep = ListField(
+        dtype=float, default=[],
+        doc="brightSnr thresholds at which to additionally fit the error models."
+    )
     makeJson = Field(
         dtype=bool, default=True,
         doc="Whether to write JSON outputs."
@@ -68,6 +91,79 @@ class MatchedVisitMetricsConfig(Config):
         dtype=bool, default=False,
         doc="Whether to use jointcal (or meas_mosaic) to calibrate measurements"
     )
+    nWorkers = Field(
+        dtype=int, default=1,
+        doc="Number of processes used to evaluate pairs of stars for AMx and "
+            "the random shuffles of PA1."
+    )
+    seed = Field(
+        dtype=int, optional=True,
+        doc="Seed of the random draws (PA1 pairs of visits, AMx pair sampling). "
+            "A new seed is drawn, and recorded in the JSON output, if not set."
+    )
+    pa1Exact = Field(
+        dtype=bool, default=False,
+        doc="Compute PA1, PA2 and PF1 from all pairs of visits of each star, "
+            "instead of random pairs."
+    )
+    pa1StoredShuffles = Field(
+        dtype=int, optional=True,
+        doc="If set, store only this many random samples of the PA1 magnitude "
+            "differences in the JSON output."
+    )
+    pa1MagBins = ListField(
+        dtype=float, default=[],
+        doc="Magnitude bin edges (mag) in which to additionally compute PA1."
+    )
+    pa1ByCcd = Field(
+        dtype=bool, default=False,
+        doc="Additionally compute PA1 for the stars on each CCD."
+    )
+    zeroPoints = Field(
+        dtype=bool, default=False,
+        doc="Fit a magnitude offset to each visit, and compute PA1 once they are removed."
+    )
+    zeroPointsByCcd = Field(
+        dtype=bool, default=False,
+        doc="With zeroPoints, fit an offset to each CCD of each visit."
+    )
+    pa2AllShuffles = Field(
+        dtype=bool, default=False,
+        doc="Compute PA2 and PF1 as the mean over all random samples of PA1."
+    )
+    nBootstrap = Field(
+        dtype=int, optional=True,
+        doc="If set, number of bootstrap resamplings of the stars from which to "
+            "compute a confidence interval on each metric."
+    )
+    amxMaxPairs = Field(
+        dtype=int, optional=True,
+        doc="If set, estimate AMx from a random sample of at most this many pairs."
+    )
+    amxTolerance = Field(
+        dtype=float, optional=True,
+        doc="Stop sampling pairs once the AMx confidence interval is narrower "
+            "than this (milliarcseconds)."
+    )
+    amxProfileBins = ListField(
+        dtype=float, default=[],
+        doc="Separation bin edges (arcmin) at which to additionally compute AMx."
+    )
+    amxPairStore = Field(
+        dtype=str, optional=True,
+        doc="Directory in which to store the pairs of stars for AMx, to reuse "
+            "them in later runs on the same data."
+    )
+    amxCcdMapAnnulus = ListField(
+        dtype=float, default=[],
+        doc="Inner and outer separation (arcmin) of the pairs of stars for which "
+            "to additionally map AMx over pairs of CCDs."
+    )
+    amxMaxStoredPairs = Field(
+        dtype=int, optional=True,
+        doc="If set, keep the RMS distances of at most this many pairs per AMx "
+            "metric and compute the others from a bounded-memory sketch."
+    )
 
 
 class MatchedVisitMetricsTask(CmdLineTask):
@@ -108,7 +204,28 @@ class MatchedVisitMetricsTask(CmdLineTask):
                            makeJson=self.config.makeJson,
                            filterName=filterName,
                            outputPrefix=self.config.outputPrefix,
-                           useJointCal=self.config.useJointCal)
+                           useJointCal=self.config.useJointCal,
+                           compact=self.config.compact,
+                           safeSnrSweep=list(self.config.safeSnrSweep),
+                           brightSnrSweep=list(self.config.brightSnrSweep),
+                           nWorkers=self.config.nWorkers,
+                           amxMaxPairs=self.config.amxMaxPairs,
+                           amxTolerance=self.config.amxTolerance,
+                           amxProfileBins=list(self.config.amxProfileBins),
+                           amxPairStore=self.config.amxPairStore,
+                           amxMaxStoredPairs=self.config.amxMaxStoredPairs,
+                           amxCcdMapAnnulus=list(self.config.amxCcdMapAnnulus),
+                           seed=self.config.seed,
+                           pa1Exact=self.config.pa1Exact,
+                           pa1StoredShuffles=self.config.pa1StoredShuffles,
+                           pa2AllShuffles=self.config.pa2AllShuffles,
+                           pa1MagBins=list(self.config.pa1MagBins),
+                           pa1ByCcd=self.config.pa1ByCcd,
+                           nBootstrap=self.config.nBootstrap,
+                           clipSigma=self.config.clipSigma,
+                           maxChi2=self.config.maxChi2,
+                           zeroPoints=self.config.zeroPoints,
+                           zeroPointsByCcd=self.config.zeroPointsByCcd)
         if self.config.makePlots:
             plot_metrics(job, filterName, outputPrefix=self.config.outputPrefix)
 
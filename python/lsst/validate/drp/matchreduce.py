@@ -23,6 +23,9 @@ for measurement classes, plotting functions, and JSON persistence.
 
 from __future__ import print_function, absolute_import
 
+from collections import OrderedDict
+import time
+
 import numpy as np
 import astropy.units as u
 
@@ -30,12 +33,14 @@ import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.image.utils as afwImageUtils
 import lsst.daf.persistence as dafPersist
-from lsst.afw.table import (SourceCatalog, SchemaMapper, Field,
+from lsst.afw.table import (SourceCatalog, SourceTable, SchemaMapper, Field,
                             MultiMatch, SimpleRecord, GroupView,
                             SOURCE_IO_NO_FOOTPRINTS)
 from lsst.afw.fits import FitsError
+import lsst.pipe.base as pipeBase
 from lsst.validate.base import BlobBase
 
+from .groupedarrays import GroupedArrays
 from .util import getCcdKeyName, positionRmsFromCat
 
 
@@ -50,9 +55,14 @@ class MatchedMultiVisitDataset(BlobBase):
 
     Parameters
     ----------
-    repo : `str` or `Butler`
+    repo : `str`, `Butler` or `GroupedArrays`
         A Butler instance or a repository URL that can be used to construct
-        one.
+        one. Sources already matched across visits can be given instead as a
+        `GroupedArrays`, with the ``visit``, CCD, ``coord_ra``,
+        ``coord_dec``, ``base_PsfFlux_mag``, ``base_PsfFlux_magErr``,
+        ``base_PsfFlux_snr``, ``base_ClassificationExtendedness_value`` and
+        ``base_PixelFlags_flag_{saturated,cr,bad,edge}`` fields of every
+        source; ``dataIds`` then only give the filter and CCD key names.
     dataIds : `list` of `dict`
         List of `butler` data IDs of Image catalogs to compare to reference.
         The `calexp` cpixel image is needed for the photometric calibration.
@@ -60,6 +70,21 @@ class MatchedMultiVisitDataset(BlobBase):
         Radius for matching. Default is 1 arcsecond.
     safeSnr : `float`, optional
         Minimum median SNR for a match to be considered "safe".
+    useJointCal : `bool`, optional
+        Use jointcal/meas_mosaic outputs to calibrate positions and fluxes.
+    compact : `bool`, optional
+        Reduce the memory footprint of the matched data (see *Notes*).
+    clipSigma : `float`, optional
+        If given, reject from ``safeMatches`` the detections whose PSF
+        magnitude is further than this many standard deviations from the
+        median magnitude of their object, iteratively (see
+        `GroupedArrays.groupSigmaClip`). Requires ``compact``.
+    maxChi2 : `float`, optional
+        If given, reject from ``safeMatches`` the objects, e.g. variable
+        stars, whose PSF magnitudes have a larger reduced chi-square than
+        this given their reported uncertainties (see
+        `GroupedArrays.groupReducedChi2`), after ``clipSigma``. Requires
+        ``compact``.
     verbose : `bool`, optional
         Output additional information on the analysis steps.
 
@@ -67,6 +92,8 @@ class MatchedMultiVisitDataset(BlobBase):
     ----------
     filterName : `str`
         Name of filter used for all observations.
+    safeSnr : `float`
+        Minimum median SNR for a match to be considered "safe".
     mag : `astropy.units.Quantity`
         Mean PSF magnitudes of stars over multiple visits (magnitudes).
     magerr : `astropy.units.Quantity`
@@ -93,22 +120,84 @@ class MatchedMultiVisitDataset(BlobBase):
     safeMatches
         safe matches, as an afw.table.GroupView. Safe matches
         are good matches that are sufficiently bright and sufficiently
-        compact.
+        compact. With ``clipSigma`` or ``maxChi2``, the outlying detections
+        and variable objects are rejected from them, and objects left with
+        fewer than 2 detections are dropped.
+
+        *Not serialized.*
+    safeSourceMask : `numpy.ndarray` or `None`
+        With ``clipSigma`` or ``maxChi2``, mask of the detections of the
+        safe matches, before rejection, that were kept; `None` otherwise.
+
+        *Not serialized.*
+    ccdKey : `str`
+        Name of the CCD field of the matched sources (e.g., ``'ccd'`` or
+        ``'ccdnum'``, see `getCcdKeyName`).
 
         *Not serialized.*
     magKey
         Key for `"base_PsfFlux_mag"` in the `goodMatches` and `safeMatches`
-        catalog tables.
+        catalog tables (the field name itself in ``compact`` mode).
+
+        *Not serialized.*
+    bytesPerSource : `float`
+        Memory used per matched source by ``goodMatches`` in ``compact``
+        mode; `None` otherwise.
+
+        *Not serialized.*
+    computeTimes : `collections.OrderedDict`
+        Wall-clock time (seconds) spent computing each lazily-evaluated
+        attribute, in the order they were computed.
 
         *Not serialized.*
+
+    Notes
+    -----
+    Catalogs are loaded and matched when the dataset is constructed, but
+    ``goodMatches``, ``safeMatches`` and the per-object datums (``snr``,
+    ``mag``, ``magrms``, ``magerr`` and ``dist``) are only computed, and then
+    memoized, the first time they are accessed. Measurements that only need
+    some of them do not pay for the others. Call `materialize` to compute
+    all datums up front; this is done automatically before serialization.
+
+    In ``compact`` mode only the fields needed by validate_drp are carried
+    through the match. Once the good matches are selected they are copied
+    into a `GroupedArrays` and the afw catalogs are released, so
+    ``goodMatches`` and ``safeMatches`` are `GroupedArrays` instead of
+    `lsst.afw.table.GroupView`. Magnitudes, their errors, SNR and
+    extendedness are stored as float32 and visits and CCDs as int32; sky
+    coordinates stay float64, as astrometric repeatability needs better
+    than milliarcsecond precision. Reductions are carried out in float64.
+    The float32 rounding (relative precision 6e-8) bounds the differences
+    from the full-precision results to:
+
+    - ``mag``, ``magrms``, ``magerr``: < 0.01 mmag;
+    - ``snr``: relative 1e-7;
+    - ``dist`` and the astrometric metrics (AMx, AFx, ADx): identical,
+      except for objects whose median magnitude is within 0.01 mmag of a
+      ``magRange`` limit;
+    - PA1, PA2 and PF1: < 0.01 mmag per pair difference; objects whose
+      median SNR is within 1e-7 (relative) of ``safeSnr`` may be selected
+      differently;
+    - photometric and astrometric error models: fitted parameters to
+      relative 1e-5, ``photScatter`` < 0.01 mmag and ``astromRms``
+      identical, except for objects whose median SNR is within 1e-7
+      (relative) of ``brightSnr``.
+
+    These tolerances are checked end to end, on the same matched sources
+    with and without ``compact``, in ``tests/test_matchreduce.py``.
     """
 
     name = 'MatchedMultiVisitDataset'
 
     def __init__(self, repo, dataIds, matchRadius=None, safeSnr=50.,
-                 useJointCal=False, verbose=False):
+                 useJointCal=False, compact=False, clipSigma=None,
+                 maxChi2=None, verbose=False):
         BlobBase.__init__(self)
 
+        if (clipSigma is not None or maxChi2 is not None) and not compact:
+            raise ValueError('Rejecting outliers requires compact=True.')
+
         self.verbose = verbose
         if not matchRadius:
             matchRadius = afwGeom.Angle(1, afwGeom.arcseconds)
@@ -150,15 +239,45 @@ class MatchedMultiVisitDataset(BlobBase):
             description='RMS of sky coordinates of stars over multiple visits')
 
         # Match catalogs across visits
-        self._matchedCatalog = self._loadAndMatchCatalogs(
-            repo, dataIds, matchRadius, useJointCal=useJointCal)
-        self.magKey = self._matchedCatalog.schema.find("base_PsfFlux_mag").key
-        # Reduce catalogs into summary statistics.
-        # These are the serialiable attributes of this class.
-        self._reduceStars(self._matchedCatalog, safeSnr)
+        self.ccdKey = getCcdKeyName(dataIds[0])
+        if isinstance(repo, GroupedArrays):
+            self._matchedCatalog = repo
+            self.magKey = 'base_PsfFlux_mag'
+        else:
+            self._matchedCatalog = self._loadAndMatchCatalogs(
+                repo, dataIds, matchRadius, useJointCal=useJointCal,
+                compact=compact)
+            self.magKey = self._matchedCatalog.schema.find("base_PsfFlux_mag").key
+
+        if clipSigma is not None:
+            self.register_datum(
+                'clipSigma',
+                quantity=float(clipSigma) * u.Unit(''),
+                description='Threshold, in standard deviations, of the '
+                            'rejection of outlying detections')
+        if maxChi2 is not None:
+            self.register_datum(
+                'maxChi2',
+                quantity=float(maxChi2) * u.Unit(''),
+                description='Maximum reduced chi-square of the magnitudes of '
+                            'safe objects')
+
+        # Selections and summary statistics are computed on first access
+        # (see `materialize`).
+        self.safeSnr = safeSnr
+        self._clipSigma = clipSigma
+        self._maxChi2 = maxChi2
+        self.safeSourceMask = None
+        self.computeTimes = OrderedDict()
+        self._goodMatches = None
+        self._safeMatches = None
+        self.bytesPerSource = None
+
+        if compact:
+            self._compactify()
 
     def _loadAndMatchCatalogs(self, repo, dataIds, matchRadius,
-                              useJointCal=False):
+                              useJointCal=False, compact=False):
         """Load data from specific visit. Match with reference.
 
         Parameters
@@ -171,6 +290,10 @@ class MatchedMultiVisitDataset(BlobBase):
             calibration.
         matchRadius :  afwGeom.Angle(), optional
             Radius for matching. Default is 1 arcsecond.
+        useJointCal : bool, optional
+            Use jointcal/meas_mosaic outputs to calibrate positions and fluxes.
+        compact : bool, optional
+            Only carry the fields used by validate_drp through the match.
 
         Returns
         -------
@@ -194,7 +317,16 @@ class MatchedMultiVisitDataset(BlobBase):
 
         schema = butler.get(dataset + "_schema").schema
         mapper = SchemaMapper(schema)
-        mapper.addMinimalSchema(schema)
+        if compact:
+            mapper.addMinimalSchema(SourceTable.makeMinimalSchema())
+            inputFields = list(self._compactInputFields)
+            if useJointCal:
+                # Needed by `updateCoord`
+                inputFields += ['slot_Centroid_x', 'slot_Centroid_y']
+            for name in inputFields:
+                mapper.addMapping(schema.find(name).key)
+        else:
+            mapper.addMinimalSchema(schema)
         mapper.addOutputField(Field[float]('base_PsfFlux_snr',
                                            'PSF flux SNR'))
         mapper.addOutputField(Field[float]('base_PsfFlux_mag',
@@ -210,9 +342,6 @@ class MatchedMultiVisitDataset(BlobBase):
                             radius=matchRadius,
                             RecordClass=SimpleRecord)
 
-        # create the new extented source catalog
-        srcVis = SourceCatalog(newSchema)
-
         for vId in dataIds:
 
             if useJointCal:
@@ -284,7 +413,6 @@ class MatchedMultiVisitDataset(BlobBase):
                     tmpCat['base_PsfFlux_mag'][:] = _[0]
                     tmpCat['base_PsfFlux_magErr'][:] = _[1]
 
-            srcVis.extend(tmpCat, False)
             mmatch.add(catalog=tmpCat, dataId=vId)
 
         # Complete the match, returning a catalog that includes
@@ -297,28 +425,204 @@ class MatchedMultiVisitDataset(BlobBase):
 
         return allMatches
 
-    def _reduceStars(self, allMatches, safeSnr=50.0):
-        """Calculate summary statistics for each star. These are persisted
-        as object attributes.
+    # Fields of the input `src` catalogs needed in ``compact`` mode
+    _compactInputFields = ('base_PsfFlux_flux',
+                           'base_PsfFlux_fluxSigma',
+                           'base_PixelFlags_flag_saturated',
+                           'base_PixelFlags_flag_cr',
+                           'base_PixelFlags_flag_bad',
+                           'base_PixelFlags_flag_edge',
+                           'base_ClassificationExtendedness_value')
+
+    # Columns of `goodMatches`, and their storage types, in ``compact`` mode
+    _compactDtypes = OrderedDict([
+        ('coord_ra', np.float64),
+        ('coord_dec', np.float64),
+        ('visit', np.int32),
+        ('base_PsfFlux_mag', np.float32),
+        ('base_PsfFlux_magErr', np.float32),
+        ('base_PsfFlux_snr', np.float32),
+        ('base_ClassificationExtendedness_value', np.float32),
+    ])
+
+    def _compactify(self):
+        """Copy the good matches into compact arrays and release the afw
+        catalogs.
+        """
+        goodMatches = self._timeComputation(
+            'goodMatches', self._selectGoodMatches, self._matchedCatalog)
+        dtypes = OrderedDict(self._compactDtypes)
+        dtypes[self.ccdKey] = np.int32
+        self._goodMatches = GroupedArrays.fromGroupView(
+            goodMatches, list(dtypes), dtypes=dtypes)
+        self._matchedCatalog = None
+        self.magKey = 'base_PsfFlux_mag'
+
+        self.bytesPerSource = self._goodMatches.bytesPerSource
+        if self.verbose:
+            print('Compact matched data: {0:d} sources in {1:d} objects, '
+                  '{2:.1f} bytes per source'.format(
+                      self._goodMatches.nSources, len(self._goodMatches),
+                      self.bytesPerSource))
+
+    def materialize(self):
+        """Compute every lazily-evaluated datum of this blob.
+
+        This is called automatically before the blob is serialized to JSON,
+        but can also be called explicitly to front-load the computation.
+        """
+        for name in self._lazyDatumNames:
+            getattr(self, name)
+
+    @property
+    def json(self):
+        """JSON representation of the blob, with all datums computed."""
+        self.materialize()
+        return super(MatchedMultiVisitDataset, self).json
+
+    @property
+    def goodMatches(self):
+        """Good matches, as an `lsst.afw.table.GroupView` (computed on first
+        access).
+        """
+        if self._goodMatches is None:
+            self._goodMatches = self._timeComputation(
+                'goodMatches', self._selectGoodMatches, self._matchedCatalog)
+        return self._goodMatches
+
+    @property
+    def safeMatches(self):
+        """Safe matches, as an `lsst.afw.table.GroupView` (computed on first
+        access).
+        """
+        if self._safeMatches is None:
+            self._safeMatches = self._timeComputation(
+                'safeMatches', self._selectSafeMatches, self.goodMatches,
+                self.safeSnr)
+            if self.rejectsOutliers:
+                self._safeMatches = self._timeComputation(
+                    'outliers', self._rejectOutliers, self._safeMatches)
+        return self._safeMatches
+
+    @property
+    def snr(self):
+        """Median signal-to-noise ratio of PSF magnitudes over multiple
+        visits (`astropy.units.Quantity`, computed on first access).
+        """
+        return self._getLazyDatum('snr', self._computeSnr, u.Unit(''))
+
+    @property
+    def mag(self):
+        """Mean PSF magnitudes of stars over multiple visits
+        (`astropy.units.Quantity`, computed on first access).
+        """
+        return self._getLazyDatum('mag', self._computeMag, u.mag)
+
+    @property
+    def magrms(self):
+        """RMS of PSF magnitudes over multiple visits
+        (`astropy.units.Quantity`, computed on first access).
+        """
+        return self._getLazyDatum('magrms', self._computeMagRms, u.mag)
+
+    @property
+    def magerr(self):
+        """Median 1-sigma uncertainty of PSF magnitudes over multiple visits
+        (`astropy.units.Quantity`, computed on first access).
+        """
+        return self._getLazyDatum('magerr', self._computeMagErr, u.mag)
+
+    @property
+    def dist(self):
+        """RMS of sky coordinates of stars over multiple visits
+        (`astropy.units.Quantity`, computed on first access).
+        """
+        return self._getLazyDatum('dist', self._computeDist,
+                                  u.milliarcsecond)
+
+    _lazyDatumNames = ('snr', 'mag', 'magrms', 'magerr', 'dist')
+
+    def _getLazyDatum(self, name, computeFunc, unit):
+        """Return the quantity of datum ``name``, computing it with
+        ``computeFunc`` if it has not been set yet.
+
+        ``computeFunc`` returns a plain array in ``unit``; the datum's
+        quantity is a view of that array, so no copy is made.
+        """
+        datum = self.datums[name]
+        if datum.quantity is None:
+            values = self._timeComputation(name, computeFunc)
+            datum.quantity = u.Quantity(values, unit, copy=False)
+        return datum.quantity
+
+    def _timeComputation(self, name, func, *args):
+        """Call ``func(*args)``, recording the elapsed time in
+        ``computeTimes[name]``.
+        """
+        startTime = time.time()
+        result = func(*args)
+        self.computeTimes[name] = time.time() - startTime
+        if self.verbose:
+            print('Computed {0} in {1:.3f} s'.format(
+                name, self.computeTimes[name]))
+        return result
+
+    def _computeSnr(self):
+        return self.goodMatches.aggregate(
+            np.median, field="base_PsfFlux_snr")
+
+    def _computeMag(self):
+        # Pass field=magKey so np.mean just gets that as its input
+        return self.goodMatches.aggregate(np.mean, field=self.magKey)
+
+    def _computeMagRms(self):
+        return self.goodMatches.aggregate(np.std, field=self.magKey)
+
+    def _computeMagErr(self):
+        return self.goodMatches.aggregate(
+            np.median, field="base_PsfFlux_magErr")
+
+    def _computeDist(self):
+        # positionRmsFromCat knows how to query a group
+        # so we give it the whole thing by going with the default `field=None`.
+        return self.goodMatches.aggregate(positionRmsFromCat)
+
+    def _selectGoodMatches(self, allMatches):
+        """Filter matches down to objects with at least 2 sources and good
+        flags.
 
         Parameters
         ----------
-        allMatches : afw.table.GroupView
+        allMatches : afw.table.GroupView or GroupedArrays
             GroupView object with matches.
-        safeSnr : float, optional
-            Minimum median SNR for a match to be considered "safe".
+
+        Returns
+        -------
+        goodMatches : afw.table.GroupView or GroupedArrays
+            GroupView object with the good matches.
         """
-        # Filter down to matches with at least 2 sources and good flags
-        flagKeys = [allMatches.schema.find("base_PixelFlags_flag_%s" % flag).key
-                    for flag in ("saturated", "cr", "bad", "edge")]
+        flags = ["base_PixelFlags_flag_%s" % flag
+                 for flag in ("saturated", "cr", "bad", "edge")]
         nMatchesRequired = 2
+        goodSnr = 3
+
+        if isinstance(allMatches, GroupedArrays):
+            bad = ~np.isfinite(allMatches.get("base_PsfFlux_mag"))
+            for flag in flags:
+                bad |= allMatches.get(flag).astype(bool)
+            nBad = np.bincount(allMatches.groupIndex[bad],
+                               minlength=len(allMatches))
+            with np.errstate(invalid='ignore'):
+                psfSnr = allMatches.groupMedian("base_PsfFlux_snr")
+                return allMatches.subset((allMatches.counts >= nMatchesRequired) &
+                                         (nBad == 0) & (psfSnr >= goodSnr))
+
+        flagKeys = [allMatches.schema.find(flag).key for flag in flags]
 
         psfSnrKey = allMatches.schema.find("base_PsfFlux_snr").key
         psfMagKey = allMatches.schema.find("base_PsfFlux_mag").key
-        psfMagErrKey = allMatches.schema.find("base_PsfFlux_magErr").key
-        extendedKey = allMatches.schema.find("base_ClassificationExtendedness_value").key
 
-        def goodFilter(cat, goodSnr=3):
+        def goodFilter(cat):
             if len(cat) < nMatchesRequired:
                 return False
             for flagKey in flagKeys:
@@ -330,28 +634,119 @@ class MatchedMultiVisitDataset(BlobBase):
             # Note that this also implicitly checks for psfSnr being non-nan.
             return psfSnr >= goodSnr
 
-        goodMatches = allMatches.where(goodFilter)
+        return allMatches.where(goodFilter)
+
+    @property
+    def rejectsOutliers(self):
+        """`True` if outlying detections and variable objects are rejected
+        from the safe matches (``clipSigma`` or ``maxChi2`` given).
+        """
+        return self._clipSigma is not None or self._maxChi2 is not None
+
+    def rejectOutliers(self, matches):
+        """Reject outlying detections and variable objects, as they are
+        rejected from the safe matches, with grouped reductions over all
+        objects at once.
+
+        Every object is rejected independently of the others, so this can
+        be applied to any subset of the good matches.
+
+        Parameters
+        ----------
+        matches : GroupedArrays
+            Matches to reject outliers from.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            Result struct with components:
+
+            - ``matches``: the matches without the rejected detections, and
+              without the objects left with fewer than 2 detections
+              (`GroupedArrays`).
+            - ``sourceMask``: mask of the detections of ``matches`` that
+              were kept (`numpy.ndarray`).
+            - ``objectMask``: mask of the objects of ``matches`` that were
+              kept (`numpy.ndarray`).
+            - ``nClipped``: number of outlying detections (`int`).
+            - ``nVariable``: number of variable objects (`int`).
+        """
+        kept = np.isfinite(matches.get(self.magKey))
+        if self._clipSigma is not None:
+            kept = matches.groupSigmaClip(self.magKey,
+                                          nSigma=self._clipSigma,
+                                          mask=kept)
+        nClipped = int(np.sum(~kept))
+        nVariable = 0
+        if self._maxChi2 is not None:
+            chi2 = matches.groupReducedChi2(self.magKey,
+                                            'base_PsfFlux_magErr',
+                                            mask=kept)
+            variable = chi2 > self._maxChi2
+            nVariable = int(np.sum(variable))
+            kept &= ~variable[matches.groupIndex]
+
+        clipped = matches.selectSources(kept)
+        objectMask = clipped.counts >= 2
+        clipped = clipped.subset(objectMask)
+        return pipeBase.Struct(matches=clipped, sourceMask=kept,
+                               objectMask=objectMask, nClipped=nClipped,
+                               nVariable=nVariable)
+
+    def _rejectOutliers(self, safeMatches):
+        """Reject outlying detections and variable objects from the safe
+        matches (see `rejectOutliers`).
+
+        Parameters
+        ----------
+        safeMatches : GroupedArrays
+            The safe matches.
+
+        Returns
+        -------
+        safeMatches : GroupedArrays
+            The safe matches without the rejected detections, and without
+            the objects left with fewer than 2 detections.
+        """
+        rejected = self.rejectOutliers(safeMatches)
+        self.safeSourceMask = rejected.sourceMask
+        if self.verbose:
+            print('Rejected {0:d} outlying detections and {1:d} variable '
+                  'objects: {2:d} of {3:d} safe objects left'.format(
+                      rejected.nClipped, rejected.nVariable,
+                      len(rejected.matches), len(safeMatches)))
+        return rejected.matches
+
+    def _selectSafeMatches(self, goodMatches, safeSnr=50.0):
+        """Filter good matches further to a limited range in S/N and
+        extendedness to select bright stars.
+
+        Parameters
+        ----------
+        goodMatches : afw.table.GroupView or GroupedArrays
+            GroupView object with the good matches.
+        safeSnr : float, optional
+            Minimum median SNR for a match to be considered "safe".
 
-        # Filter further to a limited range in S/N and extendedness
-        # to select bright stars.
+        Returns
+        -------
+        safeMatches : afw.table.GroupView or GroupedArrays
+            GroupView object with the safe matches.
+        """
         safeMaxExtended = 1.0
 
+        if isinstance(goodMatches, GroupedArrays):
+            psfSnr = goodMatches.groupMedian("base_PsfFlux_snr")
+            extended = goodMatches.groupMax("base_ClassificationExtendedness_value")
+            return goodMatches.subset((psfSnr >= safeSnr) &
+                                      (extended < safeMaxExtended))
+
+        psfSnrKey = goodMatches.schema.find("base_PsfFlux_snr").key
+        extendedKey = goodMatches.schema.find("base_ClassificationExtendedness_value").key
+
         def safeFilter(cat):
             psfSnr = np.median(cat.get(psfSnrKey))
             extended = np.max(cat.get(extendedKey))
             return psfSnr >= safeSnr and extended < safeMaxExtended
 
-        safeMatches = goodMatches.where(safeFilter)
-
-        # Pass field=psfMagKey so np.mean just gets that as its input
-        self.snr = goodMatches.aggregate(np.median, field=psfSnrKey) * u.Unit('')
-        self.mag = goodMatches.aggregate(np.mean, field=psfMagKey) * u.mag
-        self.magrms = goodMatches.aggregate(np.std, field=psfMagKey) * u.mag
-        self.magerr = goodMatches.aggregate(np.median, field=psfMagErrKey) * u.mag
-        # positionRmsFromCat knows how to query a group
-        # so we give it the whole thing by going with the default `field=None`.
-        self.dist = goodMatches.aggregate(positionRmsFromCat) * u.milliarcsecond
-
-        # These attributes are not serialized
-        self.goodMatches = goodMatches
-        self.safeMatches = safeMatches
+        return goodMatches.where(safeFilter)
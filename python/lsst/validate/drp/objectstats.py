@@ -0,0 +1,411 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Mergeable per-object sufficient statistics of matched sources, so that
+partial results (e.g., per CCD or per tract) can be combined.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object, range, zip
+
+import numpy as np
+
+from .groupedarrays import GroupedArrays
+
+
+__all__ = ['ObjectStatistics']
+
+
+class ObjectStatistics(object):
+    """Per-object sufficient statistics of sources matched across visits.
+
+    Each object keeps the number of detections, the running mean and sum of
+    squared deviations of its magnitudes, the sum and sum of squares of
+    the unit vectors of its positions relative to a reference vector, the
+    OR of its bad-pixel flags, whether all its magnitudes are finite, its
+    maximum extendedness, and the lists of SNR and magnitude errors of its
+    detections (medians cannot be merged from summaries).
+
+    Statistics for the same objects computed from disjoint sets of
+    detections are combined with `merge`, which is associative and
+    commutative up to floating point rounding. After merging all partial
+    results, the statistics reproduce the good/safe selection and the
+    ``snr``, ``mag``, ``magrms``, ``magerr`` and ``dist`` datums of
+    `~lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
+
+    Use `fromSources` or `fromGroupView` to build instances rather than
+    calling the constructor directly.
+
+    Parameters
+    ----------
+    ids : `numpy.ndarray`
+        Identifier of each object. Identifiers must refer to the same
+        object in all the partial results that are merged.
+    count : `numpy.ndarray`
+        Number of detections of each object.
+    magMean : `numpy.ndarray`
+        Mean magnitude of each object.
+    magM2 : `numpy.ndarray`
+        Sum of squared deviations of the magnitudes from ``magMean``.
+    refVector : `numpy.ndarray`
+        Reference unit vector of each object. Shape: ``(nObjects, 3)``.
+    offsetSum : `numpy.ndarray`
+        Sum of the offsets of the detection unit vectors from
+        ``refVector``. Shape: ``(nObjects, 3)``.
+    offsetSumSq : `numpy.ndarray`
+        Sum of the squared norms of those offsets.
+    flagged : `numpy.ndarray`
+        `True` if any detection has a bad-pixel flag set.
+    allFinite : `numpy.ndarray`
+        `True` if the magnitudes of all detections are finite.
+    extendedness : `numpy.ndarray`
+        Maximum extendedness of the detections.
+    detectionIndex : `numpy.ndarray`
+        Index of the object of each detection, into ``ids``.
+    snr : `numpy.ndarray`
+        PSF SNR of each detection.
+    magErr : `numpy.ndarray`
+        PSF magnitude error of each detection.
+
+    Notes
+    -----
+    Positions are kept as offsets from a per-object reference unit vector
+    (the first detection seen), rather than as raw unit vector sums. Sums
+    of raw unit vectors would lose the milliarcsecond scatter to
+    cancellation. The position RMS is computed from chord lengths, which
+    differ from the arc lengths used by `~lsst.validate.drp.util.sphDist`
+    by a relative amount of order ``chord**2/24``, i.e., far below
+    floating point precision at the separations of matched sources.
+    """
+
+    flagFields = ['base_PixelFlags_flag_%s' % flag
+                  for flag in ("saturated", "cr", "bad", "edge")]
+
+    def __init__(self, ids, count, magMean, magM2, refVector, offsetSum,
+                 offsetSumSq, flagged, allFinite, extendedness,
+                 detectionIndex, snr, magErr):
+        self.ids = np.asarray(ids)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.magMean = np.asarray(magMean, dtype=np.float64)
+        self.magM2 = np.asarray(magM2, dtype=np.float64)
+        self.refVector = np.asarray(refVector, dtype=np.float64)
+        self.offsetSum = np.asarray(offsetSum, dtype=np.float64)
+        self.offsetSumSq = np.asarray(offsetSumSq, dtype=np.float64)
+        self.flagged = np.asarray(flagged, dtype=bool)
+        self.allFinite = np.asarray(allFinite, dtype=bool)
+        self.extendedness = np.asarray(extendedness, dtype=np.float64)
+        self.detectionIndex = np.asarray(detectionIndex, dtype=np.int64)
+        self.snr = np.asarray(snr, dtype=np.float64)
+        self.magErr = np.asarray(magErr, dtype=np.float64)
+        self._detections = None
+
+    @classmethod
+    def fromSources(cls, objectIds, ra, dec, mag, magErr, snr, flagged,
+                    extendedness):
+        """Compute the statistics of individual detections.
+
+        Parameters
+        ----------
+        objectIds : `numpy.ndarray`
+            Identifier of the object of each detection.
+        ra, dec : `numpy.ndarray`
+            Coordinates of each detection [radians].
+        mag, magErr, snr : `numpy.ndarray`
+            PSF magnitude, magnitude error and SNR of each detection.
+        flagged : `numpy.ndarray`
+            `True` for detections with a bad-pixel flag set.
+        extendedness : `numpy.ndarray`
+            Extendedness of each detection.
+
+        Returns
+        -------
+        statistics : `ObjectStatistics`
+        """
+        ids, detectionIndex = np.unique(objectIds, return_inverse=True)
+        nObjects = len(ids)
+        mag = np.asarray(mag, dtype=np.float64)
+        xyz = _unitVectors(np.asarray(ra, dtype=np.float64),
+                           np.asarray(dec, dtype=np.float64))
+
+        count = np.bincount(detectionIndex, minlength=nObjects)
+        magMean = np.bincount(detectionIndex, weights=mag,
+                              minlength=nObjects) / count
+        magM2 = np.bincount(detectionIndex,
+                            weights=(mag - magMean[detectionIndex])**2,
+                            minlength=nObjects)
+
+        refVector = xyz[_firstOccurrence(detectionIndex, nObjects)]
+        offsets = xyz - refVector[detectionIndex]
+        offsetSum = _groupSumVectors(detectionIndex, offsets, nObjects)
+        offsetSumSq = np.bincount(detectionIndex,
+                                  weights=np.sum(offsets**2, axis=1),
+                                  minlength=nObjects)
+
+        flagged = np.bincount(detectionIndex, weights=np.asarray(flagged),
+                              minlength=nObjects) > 0
+        allFinite = np.bincount(detectionIndex, weights=~np.isfinite(mag),
+                                minlength=nObjects) == 0
+        extendedness = _groupMax(detectionIndex, extendedness, nObjects)
+
+        return cls(ids, count, magMean, magM2, refVector, offsetSum,
+                   offsetSumSq, flagged, allFinite, extendedness,
+                   detectionIndex, snr, magErr)
+
+    @classmethod
+    def fromGroupView(cls, groupView, magKey='base_PsfFlux_mag'):
+        """Compute the statistics of matched sources.
+
+        Parameters
+        ----------
+        groupView : `lsst.afw.table.GroupView` or `GroupedArrays`
+            Matched sources grouped by object, e.g. all the matches of one
+            CCD or tract, before the good sources are selected.
+        magKey : `str`, optional
+            Name of the magnitude field.
+
+        Returns
+        -------
+        statistics : `ObjectStatistics`
+        """
+        groups = groupView.groups
+        counts = [len(cat) for cat in groups]
+
+        def column(name):
+            if len(groups) == 0:
+                return np.zeros(0)
+            return np.concatenate([np.asarray(cat.get(name), dtype=np.float64)
+                                   for cat in groups])
+
+        flagged = np.zeros(sum(counts), dtype=bool)
+        for name in cls.flagFields:
+            flagged |= column(name).astype(bool)
+
+        objectIds = np.repeat(np.asarray(groupView.ids), counts)
+        return cls.fromSources(objectIds,
+                               column('coord_ra'), column('coord_dec'),
+                               column(magKey),
+                               column('base_PsfFlux_magErr'),
+                               column('base_PsfFlux_snr'),
+                               flagged,
+                               column('base_ClassificationExtendedness_value'))
+
+    def merge(self, other):
+        """Combine with the statistics of another set of detections.
+
+        Parameters
+        ----------
+        other : `ObjectStatistics`
+            Statistics of detections disjoint from those of ``self``.
+
+        Returns
+        -------
+        merged : `ObjectStatistics`
+            Statistics of the union of the detections.
+        """
+        return ObjectStatistics.mergeAll([self, other])
+
+    @staticmethod
+    def mergeAll(statisticsList):
+        """Combine any number of partial statistics at once.
+
+        Parameters
+        ----------
+        statisticsList : `list` of `ObjectStatistics`
+            Statistics of disjoint sets of detections.
+
+        Returns
+        -------
+        merged : `ObjectStatistics`
+            Statistics of the union of the detections.
+        """
+        if len(statisticsList) == 1:
+            return statisticsList[0]
+
+        def concat(name):
+            return np.concatenate([getattr(s, name) for s in statisticsList])
+
+        ids, partIndex = np.unique(concat('ids'), return_inverse=True)
+        nObjects = len(ids)
+
+        # Magnitudes: pooled mean and sum of squared deviations
+        partCount = concat('count')
+        partMean = concat('magMean')
+        count = np.bincount(partIndex, weights=partCount, minlength=nObjects)
+        magMean = np.bincount(partIndex, weights=partCount*partMean,
+                              minlength=nObjects) / count
+        magM2 = np.bincount(partIndex,
+                            weights=(concat('magM2') +
+                                     partCount*(partMean - magMean[partIndex])**2),
+                            minlength=nObjects)
+
+        # Positions: move each part's offsets to the merged reference vector
+        partRef = concat('refVector')
+        partOffsetSum = concat('offsetSum')
+        refVector = partRef[_firstOccurrence(partIndex, nObjects)]
+        shift = partRef - refVector[partIndex]
+        offsetSum = _groupSumVectors(partIndex,
+                                     partOffsetSum + partCount[:, np.newaxis]*shift,
+                                     nObjects)
+        offsetSumSq = np.bincount(
+            partIndex,
+            weights=(concat('offsetSumSq') +
+                     2*np.sum(shift*partOffsetSum, axis=1) +
+                     partCount*np.sum(shift**2, axis=1)),
+            minlength=nObjects)
+
+        flagged = np.bincount(partIndex, weights=concat('flagged'),
+                              minlength=nObjects) > 0
+        allFinite = np.bincount(partIndex, weights=~concat('allFinite'),
+                                minlength=nObjects) == 0
+        extendedness = _groupMax(partIndex, concat('extendedness'), nObjects)
+
+        # Detections: re-index into the merged objects
+        partStart = np.cumsum([0] + [len(s.ids) for s in statisticsList[:-1]])
+        detectionIndex = np.concatenate(
+            [partIndex[start + s.detectionIndex]
+             for start, s in zip(partStart, statisticsList)])
+
+        return ObjectStatistics(ids, count, magMean, magM2, refVector,
+                                offsetSum, offsetSumSq, flagged, allFinite,
+                                extendedness, detectionIndex,
+                                concat('snr'), concat('magErr'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def detections(self):
+        """Per-detection SNR and magnitude errors grouped by object, as a
+        `GroupedArrays` aligned with ``ids``.
+        """
+        if self._detections is None:
+            order = np.argsort(self.detectionIndex, kind='mergesort')
+            counts = np.bincount(self.detectionIndex, minlength=len(self))
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            self._detections = GroupedArrays(
+                offsets,
+                {'snr': self.snr[order], 'magErr': self.magErr[order]},
+                ids=self.ids)
+        return self._detections
+
+    @property
+    def medianSnr(self):
+        """Median SNR of each object (`numpy.ndarray`)."""
+        return self.detections.groupMedian('snr')
+
+    @property
+    def medianMagErr(self):
+        """Median magnitude error of each object, in mag
+        (`numpy.ndarray`).
+        """
+        return self.detections.groupMedian('magErr')
+
+    @property
+    def magRms(self):
+        """Standard deviation of the magnitudes of each object, as
+        `numpy.std`, in mag (`numpy.ndarray`).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.magM2 / self.count)
+
+    @property
+    def meanVector(self):
+        """Normalized mean unit vector of each object (`numpy.ndarray`,
+        shape ``(nObjects, 3)``).
+        """
+        mean = self.refVector + self.offsetSum / self.count[:, np.newaxis]
+        return mean / np.sqrt(np.sum(mean**2, axis=1))[:, np.newaxis]
+
+    @property
+    def meanRaDec(self):
+        """Mean RA and Dec of each object, in radians (`tuple` of
+        `numpy.ndarray`).
+        """
+        x, y, z = self.meanVector.T
+        ra = np.arctan2(y, x) % (2*np.pi)
+        dec = np.arctan2(z, np.hypot(x, y))
+        return ra, dec
+
+    @property
+    def positionRms(self):
+        """RMS distance of the detections of each object from its mean
+        position, in milliarcseconds (`numpy.ndarray`).
+        """
+        # Offset of the mean from the reference vector
+        meanOffset = self.meanVector - self.refVector
+        sumSq = (self.offsetSumSq -
+                 2*np.sum(meanOffset*self.offsetSum, axis=1) +
+                 self.count*np.sum(meanOffset**2, axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rmsRadians = np.sqrt(np.clip(sumSq, 0, None) / self.count)
+        return np.rad2deg(rmsRadians)*3600*1000
+
+    def isGood(self, goodSnr=3, nMatchesRequired=2):
+        """Select the objects that pass the good match criteria of
+        `~lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
+
+        Returns
+        -------
+        good : `numpy.ndarray`
+            Boolean mask with one entry per object.
+        """
+        with np.errstate(invalid='ignore'):
+            return ((self.count >= nMatchesRequired) & ~self.flagged &
+                    self.allFinite & (self.medianSnr >= goodSnr))
+
+    def isSafe(self, safeSnr=50.0, safeMaxExtended=1.0):
+        """Select the good objects that are bright and compact enough to be
+        safe matches.
+
+        Returns
+        -------
+        safe : `numpy.ndarray`
+            Boolean mask with one entry per object.
+        """
+        with np.errstate(invalid='ignore'):
+            return (self.isGood() & (self.medianSnr >= safeSnr) &
+                    (self.extendedness < safeMaxExtended))
+
+
+def _unitVectors(ra, dec):
+    cosDec = np.cos(dec)
+    return np.column_stack([cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)])
+
+
+def _firstOccurrence(index, n):
+    """Position of the first element of each of ``n`` non-empty groups in
+    ``index``.
+    """
+    order = np.argsort(index, kind='mergesort')
+    counts = np.bincount(index, minlength=n)
+    return order[np.cumsum(counts) - counts]
+
+
+def _groupSumVectors(index, vectors, n):
+    return np.column_stack([np.bincount(index, weights=vectors[:, i],
+                                        minlength=n)
+                            for i in range(vectors.shape[1])])
+
+
+def _groupMax(index, values, n):
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(index, kind='mergesort')
+    counts = np.bincount(index, minlength=n)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return GroupedArrays(offsets, {'values': values[order]}).groupMax('values')
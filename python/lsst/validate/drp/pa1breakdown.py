@@ -0,0 +1,203 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Photometric repeatability (the PA1 statistic) resolved by magnitude and
+by CCD.
+"""
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from lsst.validate.base import BlobBase
+
+from .calcsrd.pa1 import computeGroupedWidths
+from .groupedarrays import GroupedArrays
+from .util import quantityValues
+
+
+__all__ = ['PA1Breakdown']
+
+
+class PA1Breakdown(BlobBase):
+    """Serializable PA1 (RMS and IQR) of the stars in magnitude bins and on
+    each CCD.
+
+    The widths are computed from the pair differences of the PA1
+    measurement itself, for every random sample (or, if it is exact, from
+    the weighted pairs of visits), by grouped reductions over all samples
+    and bins at once; the values reported are averaged over the samples,
+    as for PA1. No pairs are drawn again, so the bins add up to PA1 up to
+    the scatter between them.
+
+    Each star is assigned the CCD on which it was most often detected.
+
+    Parameters
+    ----------
+    matchedMultiVisitDataset : `MatchedMultiVisitDataset`
+        The dataset of ``pa1``.
+    pa1 : `lsst.validate.drp.calcsrd.PA1Measurement`
+        PA1 measurement to break down.
+    magBins : `list` or `numpy.ndarray`, optional
+        Increasing edges of the magnitude bins [mag]. Default: 0.5 mag bins
+        covering all the stars.
+    byCcd : `bool`, optional
+        Also break PA1 down by CCD.
+
+    Attributes
+    ----------
+    magBins : `astropy.units.Quantity`
+        Edges of the magnitude bins.
+    magBinNStars : `astropy.units.Quantity`
+        Number of stars in each magnitude bin.
+    magBinRms : `astropy.units.Quantity`
+        PA1 RMS of the stars in each magnitude bin (NaN if there are none).
+    magBinIqr : `astropy.units.Quantity`
+        PA1 IQR of the stars in each magnitude bin.
+    ccds : `astropy.units.Quantity`
+        Identifiers of the CCDs, if ``byCcd``.
+    ccdNStars : `astropy.units.Quantity`
+        Number of stars on each CCD, if ``byCcd``.
+    ccdRms : `astropy.units.Quantity`
+        PA1 RMS of the stars on each CCD, if ``byCcd``.
+    ccdIqr : `astropy.units.Quantity`
+        PA1 IQR of the stars on each CCD, if ``byCcd``.
+    """
+
+    name = 'PA1Breakdown'
+
+    def __init__(self, matchedMultiVisitDataset, pa1, magBins=None,
+                 byCcd=True):
+        BlobBase.__init__(self)
+
+        self.register_datum(
+            'magBins',
+            label='Mag bins',
+            description='Edges of the magnitude bins')
+        self.register_datum(
+            'magBinNStars',
+            label='N(stars)',
+            description='Number of stars in each magnitude bin')
+        self.register_datum(
+            'magBinRms',
+            label='RMS',
+            description='Photometric repeatability RMS of the stars in each '
+                        'magnitude bin')
+        self.register_datum(
+            'magBinIqr',
+            label='IQR',
+            description='Photometric repeatability IQR of the stars in each '
+                        'magnitude bin')
+
+        matches = matchedMultiVisitDataset.safeMatches
+        samples = (pa1.shuffleMagDiffs, pa1.shuffleWeights, pa1.shuffleStars)
+
+        # Mean magnitude of each star, from that of each column
+        starMags = np.full(len(matches), np.nan)
+        starMags[pa1.shuffleStars] = quantityValues(pa1.magMean[0], u.mag)
+        if magBins is None:
+            magBins = np.arange(np.floor(2*np.nanmin(starMags))/2,
+                                np.floor(2*np.nanmax(starMags))/2 + 1, 0.5)
+        magBins = np.asarray(quantityValues(magBins, u.mag), dtype=float)
+        with np.errstate(invalid='ignore'):
+            starBins = np.searchsorted(magBins, starMags, side='right') - 1
+        nBins = len(magBins) - 1
+        starBins[np.isnan(starMags) | (starBins >= nBins)] = -1
+        nStars, rms, iqr = _groupedWidths(samples, starBins, nBins)
+        self.magBins = magBins * u.mag
+        self.magBinNStars = nStars * u.Unit('')
+        self.magBinRms = rms * u.mmag
+        self.magBinIqr = iqr * u.mmag
+
+        if byCcd:
+            self.register_datum(
+                'ccds',
+                label='CCD',
+                description='Identifiers of the CCDs')
+            self.register_datum(
+                'ccdNStars',
+                label='N(stars)',
+                description='Number of stars on each CCD')
+            self.register_datum(
+                'ccdRms',
+                label='RMS',
+                description='Photometric repeatability RMS of the stars on '
+                            'each CCD')
+            self.register_datum(
+                'ccdIqr',
+                label='IQR',
+                description='Photometric repeatability IQR of the stars on '
+                            'each CCD')
+
+            ccdKey = matchedMultiVisitDataset.ccdKey
+            if isinstance(matches, GroupedArrays):
+                starCcds = matches.groupMode(ccdKey)
+            else:
+                starCcds = matches.aggregate(_mostFrequent, field=ccdKey)
+            ccds, starCcdIndex = np.unique(starCcds, return_inverse=True)
+            nStars, rms, iqr = _groupedWidths(samples, starCcdIndex, len(ccds))
+            self.ccds = ccds * u.Unit('')
+            self.ccdNStars = nStars * u.Unit('')
+            self.ccdRms = rms * u.mmag
+            self.ccdIqr = iqr * u.mmag
+
+    @property
+    def magTable(self):
+        """`astropy.table.Table` of PA1 in magnitude bins, one row per bin.
+        """
+        return Table([self.magBins[:-1], self.magBins[1:], self.magBinNStars,
+                      self.magBinRms, self.magBinIqr],
+                     names=['magMin', 'magMax', 'nStars', 'rms', 'iqr'])
+
+    @property
+    def ccdTable(self):
+        """`astropy.table.Table` of PA1 on each CCD, one row per CCD."""
+        return Table([self.ccds, self.ccdNStars, self.ccdRms, self.ccdIqr],
+                     names=['ccd', 'nStars', 'rms', 'iqr'])
+
+
+def _groupedWidths(samples, starLabels, nGroups):
+    """Number of stars, and PA1 RMS and IQR averaged over the random samples
+    ``samples`` (see `PA1Breakdown`), of the stars with each of ``nGroups``
+    labels (-1 for none).
+    """
+    magDiffs, weights, stars = samples
+    labels = starLabels[stars]
+    columns, = np.where(labels >= 0)
+    columns = columns[np.argsort(labels[columns], kind='mergesort')]
+    # The same groups in every sample: the rows of the columns sorted by
+    # label are grouped by (sample, label).
+    counts = np.bincount(labels[columns], minlength=nGroups)
+    nRows = len(magDiffs)
+    offsets = np.concatenate([[0], np.cumsum(np.tile(counts, nRows))])
+    if weights is not None:
+        weights = weights[:, columns].ravel()
+    rms, iqr = computeGroupedWidths(offsets, magDiffs[:, columns].ravel(),
+                                    weights)
+    nStars = np.bincount(starLabels[starLabels >= 0], minlength=nGroups)
+    return (nStars, rms.reshape(nRows, nGroups).mean(axis=0),
+            iqr.reshape(nRows, nGroups).mean(axis=0))
+
+
+def _mostFrequent(values):
+    """Most frequent of ``values``, the smallest in case of a tie."""
+    uniqueValues, counts = np.unique(values, return_counts=True)
+    return uniqueValues[np.argmax(counts)]
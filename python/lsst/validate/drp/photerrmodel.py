@@ -28,6 +28,8 @@ from scipy.optimize import curve_fit
 
 from lsst.validate.base import BlobBase
 
+from .util import quantityValues
+
 
 __all__ = ['photErrModel', 'fitPhotErrModel', 'PhotometricErrorModel']
 
@@ -245,12 +247,15 @@ class PhotometricErrorModel(BlobBase):
                  brightSnr, medianRef, matchRef):
         self.brightSnr = brightSnr
 
-        bright = np.where(snr > self.brightSnr)
-        self.photScatter = np.median(magRms[bright])
+        # Select and fit on the plain arrays behind the dataset's datums
+        snr = quantityValues(snr, u.Unit(''))
+        bright = np.where(snr > quantityValues(brightSnr, u.Unit('')))
+        self.photScatter = np.median(quantityValues(magRms, u.mag)[bright]) * u.mag
         print('Photometric scatter (median) - SNR > {0:.1f} : {1:.1f}'.format(
               self.brightSnr, self.photScatter.to(u.mmag)))
 
-        fit_params = fitPhotErrModel(mag[bright], magErr[bright])
+        fit_params = fitPhotErrModel(quantityValues(mag, u.mag)[bright],
+                                     quantityValues(magErr, u.mag)[bright])
         self.sigmaSys = fit_params['sigmaSys']
         self.gamma = fit_params['gamma']
         self.m5 = fit_params['m5']
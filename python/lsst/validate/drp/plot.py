@@ -29,12 +29,14 @@ import astropy.units as u
 import scipy.stats
 from .astromerrmodel import astromErrModel
 from .photerrmodel import photErrModel
+from .util import quantityValues
 
 
 __all__ = ['plotOutlinedAxline',
            'plotAstrometryErrorModel',
            'plotAstromErrModelFit', 'plotPhotErrModelFit',
-           'plotPhotometryErrorModel', 'plotPA1', 'plotAMx']
+           'plotPhotometryErrorModel', 'plotPA1', 'plotAMx',
+           'plotAMxProfile', 'plotAMxCcdMap', 'plotPA1Breakdown']
 
 
 # Plotting defaults
@@ -140,7 +142,7 @@ def plotAstrometryErrorModel(dataset, astromModel, outputPrefix=''):
                                                    nAll=numMatched),
                transform=ax[1].transAxes, ha='left', va='baseline')
 
-    w, = np.where(dataset.dist < 200 * u.marcsec)
+    w, = np.where(quantityValues(dataset.dist, u.marcsec) < 200)
     plotAstromErrModelFit(dataset.snr[w], dataset.dist[w], astromModel,
                           ax=ax[1])
 
@@ -388,9 +390,9 @@ def plotPhotometryErrorModel(dataset, photomModel,
                      linestyle='dashed',
                      label=None)
 
-    w, = np.where(mmagErr < 200. * u.mmag)
-    plotPhotErrModelFit(dataset.mag[w].to(u.mag).value,
-                        dataset.magerr[w].to(u.mmag).value,
+    w, = np.where(mmagErr.value < 200.)
+    plotPhotErrModelFit(quantityValues(dataset.mag, u.mag)[w],
+                        mmagErr.value[w],
                         photomModel, ax=ax[1][1])
     ax[1][1].legend(loc='upper left')
 
@@ -416,22 +418,40 @@ def plotPA1(pa1, outputPrefix=""):
         titles. E.g., outputPrefix='Cfht_output_r_' will result in a file
         named ``'Cfht_output_r_AM1_D_5_arcmin_17.0-21.5.png'``
         for an ``AMx.name=='AM1'`` and ``AMx.magRange==[17, 21.5]``.
+
+    Raises
+    ------
+    RuntimeError
+        If ``pa1`` holds no magnitude differences, which happens for a
+        measurement made with ``storedShuffles=0`` and loaded from JSON.
     """
     diffRange = (-100, +100)
 
+    # index 0 because we show only the first sample from multiple trials
+    if len(pa1.magDiff) > 0:
+        magDiff = pa1.magDiff[0]
+        magDiffWeight = pa1.magDiffWeight[0] if pa1.magDiffWeight is not None else None
+    elif getattr(pa1, 'shuffleMagDiffs', None) is not None:
+        # No sample is stored as an extra (storedShuffles=0)
+        magDiffs, weights = pa1.shuffleSamples(allShuffles=False)
+        magDiff = u.Quantity(magDiffs[0], u.mmag)
+        magDiffWeight = weights[0] if weights is not None else None
+    else:
+        raise RuntimeError('No magnitude differences stored with the PA1 '
+                           'measurement to plot.')
+
     fig = plt.figure(figsize=(18, 12))
     ax1 = fig.add_subplot(1, 2, 1)
     ax1.scatter(pa1.magMean[0],
-                pa1.magDiff[0],
+                magDiff,
                 s=10, color=color['bright'], linewidth=0)
-    # index 0 because we show only the first sample from multiple trials
     ax1.axhline(+pa1.rms[0].value, color=color['rms'], linewidth=3)
     ax1.axhline(-pa1.rms[0].value, color=color['rms'], linewidth=3)
     ax1.axhline(+pa1.iqr[0].value, color=color['iqr'], linewidth=3)
     ax1.axhline(-pa1.iqr[0].value, color=color['iqr'], linewidth=3)
 
     ax2 = fig.add_subplot(1, 2, 2, sharey=ax1)
-    ax2.hist(pa1.magDiff[0], bins=25, range=diffRange,
+    ax2.hist(magDiff, bins=25, range=diffRange, weights=magDiffWeight,
              orientation='horizontal', histtype='stepfilled',
              normed=True, color=color['bright'])
     ax2.set_xlabel("relative # / bin")
@@ -447,7 +467,7 @@ def plotPA1(pa1, outputPrefix=""):
     ax2.set_ylim(*diffRange)
     ax2.legend()
     ax1.set_xlabel("psf magnitude")
-    ax1.set_ylabel(r"psf magnitude diff ({0.unit:latex})".format(pa1.extras['magDiff'].quantity))
+    ax1.set_ylabel(r"psf magnitude diff ({0.unit:latex})".format(magDiff))
     for label in ax2.get_yticklabels():
         label.set_visible(False)
 
@@ -460,6 +480,53 @@ def plotPA1(pa1, outputPrefix=""):
     plt.close(fig)
 
 
+def plotPA1Breakdown(breakdown, outputPrefix=""):
+    """Plot the photometric repeatability in magnitude bins and, if
+    computed, on each CCD.
+
+    Creates a file containing the plot with a filename beginning with
+    `outputPrefix`.
+
+    Parameters
+    ----------
+    breakdown : `PA1Breakdown`
+    outputPrefix : `str`, optional
+        Prefix to use for filename of plot file.
+    """
+    byCcd = 'ccds' in breakdown.datums
+    fig = plt.figure(figsize=(16 if byCcd else 8, 7))
+
+    ax1 = fig.add_subplot(1, 2 if byCcd else 1, 1)
+    magBins = quantityValues(breakdown.magBins, u.mag)
+    magCenters = 0.5*(magBins[:-1] + magBins[1:])
+    for values, label in ((breakdown.magBinRms, 'rms'),
+                          (breakdown.magBinIqr, 'iqr')):
+        ax1.plot(magCenters, quantityValues(values, u.mmag), marker='o',
+                 color=color[label], label=label.upper())
+    ax1.set_xlabel('psf magnitude')
+    ax1.set_ylabel('PA1 (mmag)')
+    ax1.legend()
+
+    if byCcd:
+        ax2 = fig.add_subplot(1, 2, 2)
+        ccds = breakdown.ccds.value
+        ticks = np.arange(len(ccds))
+        ax2.bar(ticks, quantityValues(breakdown.ccdIqr, u.mmag),
+                color=color['iqr'], label='IQR')
+        ax2.plot(ticks, quantityValues(breakdown.ccdRms, u.mmag), marker='o',
+                 linestyle='', color=color['rms'], label='RMS')
+        ax2.set_xticks(ticks)
+        ax2.set_xticklabels(['{0:g}'.format(c) for c in ccds], fontsize=8)
+        ax2.set_xlabel('CCD')
+        ax2.set_ylabel('PA1 (mmag)')
+        ax2.legend()
+
+    fig.suptitle('Photometric Repeatability by magnitude and CCD')
+    plotPath = '{0}PA1_breakdown.png'.format(outputPrefix)
+    plt.savefig(plotPath, dpi=300)
+    plt.close(fig)
+
+
 def plotAMx(amx, afx, filterName, amxSpecName='design', outputPrefix=""):
     """Plot a histogram of the RMS in relative distance between pairs of
     stars.
@@ -485,7 +552,12 @@ def plotAMx(amx, afx, filterName, amxSpecName='design', outputPrefix=""):
 
     histLabelTemplate = 'D: [{inner.value:.1f}{inner.unit:latex}-{outer.value:.1f}{outer.unit:latex}]\n'\
                         'Mag: [{magBright:.1f}-{magFaint:.1f}]'
-    ax1.hist(amx.rmsDistMas, bins=25, range=(0.0, 100.0),
+    if amx.rmsDistMas is None:
+        # Only a sketch of the RMS distances was kept
+        rmsDistMas, weights = amx.rmsSketch.binValues, amx.rmsSketch.counts
+    else:
+        rmsDistMas, weights = amx.rmsDistMas, None
+    ax1.hist(rmsDistMas, bins=25, range=(0.0, 100.0), weights=weights,
              histtype='stepfilled',
              label=histLabelTemplate.format(
                  inner=amx.annulus[0],
@@ -552,3 +624,115 @@ def plotAMx(amx, afx, filterName, amxSpecName='design', outputPrefix=""):
     plt.tight_layout()  # fix padding
     plt.savefig(plotPath, dpi=300)
     plt.close(fig)
+
+
+def plotAMxProfile(profile, amxs=None, outputPrefix=""):
+    """Plot the median and percentiles of the RMS in relative distance
+    between pairs of stars as a function of their separation.
+
+    Only the binned statistics of the profile are used, not the pairs.
+    Creates a file containing the plot with a filename beginning with
+    `outputPrefix`.
+
+    Parameters
+    ----------
+    profile : `AMxProfile`
+    amxs : `list` of `AMxMeasurement`, optional
+        AMx measurements to mark at their separation.
+    outputPrefix : `str`, optional
+        Prefix to use for filename of plot file.
+    """
+    if amxs is None:
+        amxs = []
+    separation = quantityValues(profile.separation, u.arcmin)
+    median = quantityValues(profile.medianRms, u.marcsec)
+    percentileRms = quantityValues(profile.percentileRms, u.marcsec)
+    percentiles = profile.percentiles.value
+
+    fig = plt.figure(figsize=(10, 6))
+    ax1 = fig.add_subplot(1, 1, 1)
+
+    # Shade the bands between symmetric pairs of percentiles
+    order = np.argsort(percentiles)
+    for i in range(len(order)//2):
+        low, high = order[i], order[-1 - i]
+        ax1.fill_between(separation, percentileRms[:, low],
+                         percentileRms[:, high], color=color['all'],
+                         alpha=0.2 + 0.2*i, linewidth=0,
+                         label='{0:g}-{1:g}%'.format(percentiles[low],
+                                                     percentiles[high]))
+    ax1.plot(separation, median, marker='o', linestyle='-', linewidth=2,
+             color='black', label='median')
+
+    for amx in amxs:
+        if amx.quantity is None:
+            continue
+        ax1.plot(amx.D.to(u.arcmin).value, amx.quantity.to(u.marcsec).value,
+                 marker='*', markersize=15, linestyle='', color='red')
+        ax1.annotate(amx.label, (amx.D.to(u.arcmin).value,
+                                 amx.quantity.to(u.marcsec).value),
+                     xytext=(5, 5), textcoords='offset points')
+
+    ax1.set_xscale('log')
+    ax1.set_xlabel('Separation (arcmin)')
+    ax1.set_ylabel('RMS relative distance (mas)')
+    ax1.set_title('Astrometric Repeatability vs. Separation')
+    ax1.legend(loc='upper left', fontsize=16)
+
+    plotPath = '{prefix}AMx_profile_{magBright:.1f}_{magFaint:.1f}_mag.png'.format(
+        prefix=outputPrefix,
+        magBright=profile.magRange[0].to(u.mag).value,
+        magFaint=profile.magRange[1].to(u.mag).value)
+
+    plt.tight_layout()  # fix padding
+    plt.savefig(plotPath, dpi=300)
+    plt.close(fig)
+
+
+def plotAMxCcdMap(ccdMap, outputPrefix=""):
+    """Plot the median RMS in relative distance between pairs of stars as a
+    heat map over pairs of CCDs, next to its value for each CCD.
+
+    Creates a file containing the plot with a filename beginning with
+    `outputPrefix`.
+
+    Parameters
+    ----------
+    ccdMap : `AMxCcdMap`
+    outputPrefix : `str`, optional
+        Prefix to use for filename of plot file.
+    """
+    ccds = ccdMap.ccds.value
+    medianRms = quantityValues(ccdMap.medianRms, u.marcsec)
+    ccdMedianRms = quantityValues(ccdMap.ccdMedianRms, u.marcsec)
+
+    fig = plt.figure(figsize=(16, 7))
+    ax1 = fig.add_subplot(1, 2, 1)
+    image = ax1.imshow(np.ma.masked_invalid(medianRms), origin='lower',
+                       interpolation='nearest', cmap='viridis')
+    colorbar = fig.colorbar(image, ax=ax1)
+    colorbar.set_label('Median RMS relative distance (mas)')
+    ticks = np.arange(len(ccds))
+    for setTicks, setLabels in ((ax1.set_xticks, ax1.set_xticklabels),
+                                (ax1.set_yticks, ax1.set_yticklabels)):
+        setTicks(ticks)
+        setLabels(['{0:g}'.format(c) for c in ccds], fontsize=8)
+    ax1.set_xlabel('CCD')
+    ax1.set_ylabel('CCD')
+
+    ax2 = fig.add_subplot(1, 2, 2)
+    ax2.bar(ticks, ccdMedianRms, color=color['all'])
+    ax2.set_xticks(ticks)
+    ax2.set_xticklabels(['{0:g}'.format(c) for c in ccds], fontsize=8)
+    ax2.set_xlabel('CCD')
+    ax2.set_ylabel('Median RMS relative distance (mas)')
+
+    inner, outer = ccdMap.annulus.to(u.arcmin).value
+    fig.suptitle('Astrometric Repeatability by CCD, '
+                 'D: [{0:.1f}-{1:.1f}] arcmin'.format(inner, outer))
+
+    plotPath = '{prefix}AMx_ccd_map_{inner:.1f}-{outer:.1f}_arcmin.png'.format(
+        prefix=outputPrefix, inner=inner, outer=outer)
+
+    plt.savefig(plotPath, dpi=300)
+    plt.close(fig)
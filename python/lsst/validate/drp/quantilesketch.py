@@ -0,0 +1,180 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Bounded-memory, mergeable summary of a stream of positive values from
+which percentiles can be computed.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object
+
+import numpy as np
+
+
+__all__ = ['LogQuantileSketch']
+
+
+class LogQuantileSketch(object):
+    """Counts of positive values in fine logarithmic bins.
+
+    Values can be added in any number of batches, and sketches of disjoint
+    sets of values merged, with the same result as a single sketch of all
+    the values. Memory use does not depend on the number of values.
+
+    Percentiles are resolved to a relative error of ``10**logStep - 1``
+    (0.23% by default) on the value. The corresponding error on the rank,
+    which depends on the values, is reported by `rankError`.
+
+    Parameters
+    ----------
+    logRange : 2-element `tuple` of `float`, optional
+        log10 of the smallest and largest values that are resolved. Smaller
+        values (including 0) are counted in an underflow bin and reported as
+        0, larger values are counted in the last bin.
+    logStep : `float`, optional
+        Width of the bins in log10.
+    """
+
+    def __init__(self, logRange=(-3., 5.), logStep=1e-3):
+        self.logRange = (float(logRange[0]), float(logRange[1]))
+        self.logStep = float(logStep)
+        nBins = int(round((self.logRange[1] - self.logRange[0]) / self.logStep))
+        # The first bin counts the values below the grid
+        self.counts = np.zeros(nBins + 1, dtype=np.int64)
+
+    @property
+    def count(self):
+        """Number of values in the sketch (`int`)."""
+        return int(self.counts.sum())
+
+    @property
+    def relativeError(self):
+        """Relative resolution of the percentiles (`float`)."""
+        return 10**self.logStep - 1
+
+    @property
+    def binValues(self):
+        """Geometric center of each bin, 0 for the underflow bin
+        (`numpy.ndarray`), e.g. to plot ``counts`` as a histogram.
+        """
+        index = np.arange(len(self.counts))
+        return np.where(index > 0,
+                        10**(self.logRange[0] + (index - 0.5)*self.logStep),
+                        0.)
+
+    def _binIndex(self, values):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index = np.floor((np.log10(values) - self.logRange[0]) /
+                             self.logStep) + 1
+        return np.clip(index, 0, len(self.counts) - 1).astype(np.int64)
+
+    def add(self, values):
+        """Add values to the sketch; NaN values are ignored.
+
+        Parameters
+        ----------
+        values : `numpy.ndarray`
+            Non-negative values.
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) > 0:
+            self.counts += np.bincount(self._binIndex(values),
+                                       minlength=len(self.counts))
+
+    def merge(self, other):
+        """Return the sketch of the values of both sketches.
+
+        Parameters
+        ----------
+        other : `LogQuantileSketch`
+            A sketch with the same bins.
+
+        Returns
+        -------
+        sketch : `LogQuantileSketch`
+        """
+        if (other.logRange != self.logRange or
+                other.logStep != self.logStep):
+            raise ValueError('Cannot merge sketches with different bins.')
+        merged = LogQuantileSketch(self.logRange, self.logStep)
+        merged.counts = self.counts + other.counts
+        return merged
+
+    def _rankBins(self, percentiles):
+        """Rank of ``percentiles``, as defined by `numpy.percentile`, and
+        the bin that contains each.
+        """
+        rank = np.asarray(percentiles, dtype=float)/100.*(self.count - 1)
+        cumulative = np.cumsum(self.counts)
+        index = np.searchsorted(cumulative, rank, side='right')
+        return rank, index, cumulative[index] - self.counts[index]
+
+    def percentile(self, percentiles):
+        """Percentiles of the values, as `numpy.percentile` would compute
+        them, to the resolution of the sketch.
+
+        Parameters
+        ----------
+        percentiles : `float` or `numpy.ndarray`
+            Percentiles to compute, between 0 and 100.
+
+        Returns
+        -------
+        values : `float` or `numpy.ndarray`
+            NaN if the sketch is empty.
+        """
+        if self.count == 0:
+            return np.full(np.shape(percentiles), np.nan)[()]
+        rank, index, before = self._rankBins(percentiles)
+        # Spread the values of each bin evenly in log(value)
+        fraction = (rank - before + 0.5) / self.counts[index]
+        values = np.where(index > 0,
+                          10**(self.logRange[0] +
+                               (index - 1 + fraction)*self.logStep),
+                          0.)
+        return values[()]
+
+    def rankError(self, percentiles):
+        """Bound on the error of the rank of `percentile`, as a fraction of
+        the number of values.
+
+        The value returned by `percentile` is in the same bin as the exact
+        percentile, so its rank differs from the exact one by at most the
+        number of values in that bin.
+        """
+        if self.count == 0:
+            return np.full(np.shape(percentiles), np.nan)[()]
+        _, index, _ = self._rankBins(percentiles)
+        return (self.counts[index] / self.count)[()]
+
+    def fractionAbove(self, threshold):
+        """Fraction of the values larger than ``threshold``, to the
+        resolution of the sketch (NaN if the sketch is empty).
+        """
+        if self.count == 0:
+            return np.nan
+        index = int(self._binIndex(np.array([threshold]))[0])
+        above = self.counts[index + 1:].sum()
+        if index > 0:
+            # Part of the bin containing the threshold, evenly in log(value)
+            lower = self.logRange[0] + (index - 1)*self.logStep
+            fraction = (np.log10(threshold) - lower) / self.logStep
+            above += self.counts[index]*(1 - np.clip(fraction, 0, 1))
+        return above / self.count
@@ -0,0 +1,301 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Photometric repeatability and error models as a function of the
+``safeSnr`` and ``brightSnr`` thresholds, evaluated in a single pass.
+"""
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from lsst.validate.base import BlobBase
+
+from .astromerrmodel import fitAstromErrModel
+from .photerrmodel import fitPhotErrModel
+from .calcsrd.pa1 import getRandomDiffsRmsInMmags, computeWidths
+from .util import makeSeed, quantityValues
+
+
+__all__ = ['SnrThresholdSweep']
+
+
+class SnrThresholdSweep(BlobBase):
+    """Serializable sweep of PA1, the photometric and astrometric error models
+    and the photometric scatter over lists of SNR thresholds.
+
+    Objects are sorted once by decreasing median SNR. Every ``safeSnr``
+    threshold then selects a prefix of the compact (non-extended) objects in
+    that order, and every ``brightSnr`` threshold a prefix of all good
+    objects, so the whole sweep costs about as much as a single evaluation.
+
+    Parameters
+    ----------
+    matchedMultiVisitDataset : `MatchedMultiVisitDataset`
+        A dataset containing matched statistics for stars across multiple
+        visits.
+    safeSnrs : `list` of `float`, optional
+        Minimum median SNR values for a match to be considered "safe".
+        PA1 is computed for each of them.
+    brightSnrs : `list` of `float`, optional
+        Minimum SNR values for a star to be considered "bright". The
+        photometric scatter and error models are fit for each of them.
+    numRandomShuffles : `int`, optional
+        Number of times to draw random pairs of visits for PA1. The same
+        random pairs are used for every ``safeSnr`` threshold.
+    seed : `int`, optional
+        Seed of the random pairs. A new seed is drawn if `None`.
+
+    Attributes
+    ----------
+    seed : `int`
+        Seed of the random pairs of visits for PA1.
+    safeSnr : `astropy.units.Quantity`
+        ``safeSnr`` thresholds, in increasing order.
+    nSafe : `astropy.units.Quantity`
+        Number of safe matches at each ``safeSnr`` threshold.
+    PA1 : `astropy.units.Quantity`
+        PA1 (mean IQR of the random samples) at each ``safeSnr`` threshold.
+    PA1Rms : `astropy.units.Quantity`
+        Mean RMS of the random samples at each ``safeSnr`` threshold.
+    brightSnr : `astropy.units.Quantity`
+        ``brightSnr`` thresholds, in increasing order.
+    nBright : `astropy.units.Quantity`
+        Number of bright good matches at each ``brightSnr`` threshold.
+    photScatter : `astropy.units.Quantity`
+        Median photometric RMS of the bright stars.
+    sigmaSys, gamma, m5 : `astropy.units.Quantity`
+        Photometric error model parameters fit to the bright stars
+        (see `PhotometricErrorModel`).
+    astromScatter : `astropy.units.Quantity`
+        Median astrometric RMS of the bright stars.
+    theta, astromSigmaSys : `astropy.units.Quantity`
+        Astrometric error model parameters fit to the bright stars
+        (see `AstrometricErrorModel`).
+
+    Notes
+    -----
+    Thresholds for which fewer than three stars are selected are reported
+    with NaN model parameters.
+
+    If the dataset rejects outliers from its safe matches (``clipSigma`` or
+    ``maxChi2``, see `MatchedMultiVisitDataset.rejectOutliers`), the same
+    detections and objects are rejected from the safe matches of every
+    ``safeSnr`` threshold, so ``nSafe`` at the dataset's own ``safeSnr`` is
+    the number of its safe matches. The random pairs of visits of each star
+    depend on the set of stars they are drawn for, so ``PA1`` there is
+    statistically consistent with, but not identical to, `PA1Measurement`
+    of the dataset with the same seed.
+    """
+
+    name = 'SnrThresholdSweep'
+
+    def __init__(self, matchedMultiVisitDataset, safeSnrs=None,
+                 brightSnrs=None, numRandomShuffles=50, seed=None):
+        BlobBase.__init__(self)
+
+        self.register_datum(
+            'seed',
+            quantity=makeSeed(seed),
+            label='seed',
+            description='Seed of the random pairs of visits for PA1')
+
+        self.register_datum(
+            'safeSnr',
+            label='Safe SNR',
+            description='Minimum median SNR for a match to be considered '
+                        'safe')
+        self.register_datum(
+            'nSafe',
+            label='N(safe)',
+            description='Number of safe matches at each safeSnr threshold')
+        self.register_datum(
+            'PA1',
+            label='PA1',
+            description='Mean IQR of photometric repeatability at each '
+                        'safeSnr threshold')
+        self.register_datum(
+            'PA1Rms',
+            label='PA1(RMS)',
+            description='Mean RMS of photometric repeatability at each '
+                        'safeSnr threshold')
+        self.register_datum(
+            'brightSnr',
+            label='Bright SNR',
+            description='Threshold in SNR for bright sources')
+        self.register_datum(
+            'nBright',
+            label='N(bright)',
+            description='Number of bright matches at each brightSnr '
+                        'threshold')
+        self.register_datum(
+            'photScatter',
+            label='RMS',
+            description='RMS photometric scatter for bright stars')
+        self.register_datum(
+            'sigmaSys',
+            label='sigma(sys)',
+            description='Photometric systematic error floor')
+        self.register_datum(
+            'gamma',
+            label='gamma',
+            description='Proxy for sky brightness and read noise')
+        self.register_datum(
+            'm5',
+            label='m5',
+            description='5-sigma depth')
+        self.register_datum(
+            'astromScatter',
+            label='RMS',
+            description='Astrometric scatter (RMS) for bright stars')
+        self.register_datum(
+            'theta',
+            label='theta',
+            description='Seeing')
+        self.register_datum(
+            'astromSigmaSys',
+            label='sigma(sys)',
+            description='Astrometric systematic error floor')
+
+        if safeSnrs is None:
+            safeSnrs = []
+        if brightSnrs is None:
+            brightSnrs = []
+
+        dataset = matchedMultiVisitDataset
+        snr = quantityValues(dataset.snr, u.Unit(''))
+
+        # Sort once by decreasing SNR. The objects above any threshold
+        # are then a prefix of this order.
+        order = np.argsort(-snr, kind='mergesort')
+        sortedSnr = snr[order]
+
+        self._computeSafeSweep(dataset, order, sortedSnr,
+                               np.sort(np.asarray(safeSnrs, dtype=float)),
+                               numRandomShuffles)
+        self._computeBrightSweep(dataset, order, sortedSnr,
+                                 np.sort(np.asarray(brightSnrs, dtype=float)))
+
+    def _computeSafeSweep(self, dataset, order, sortedSnr, safeSnrs,
+                          numRandomShuffles):
+        goodMatches = dataset.goodMatches
+        extended = goodMatches.aggregate(
+            np.max, field="base_ClassificationExtendedness_value")
+
+        # Safe matches are the compact objects above the SNR threshold
+        isCompact = extended[order] < 1.0
+        candidates = order[isCompact]
+        candidateSnr = sortedSnr[isCompact]
+        candidateMatches = goodMatches
+
+        # Reject outliers as from the safe matches. Every object is
+        # rejected independently of the others, so this can be done once
+        # for all thresholds on the candidates, kept in decreasing SNR order.
+        if dataset.rejectsOutliers:
+            rejected = dataset.rejectOutliers(goodMatches.subset(candidates))
+            candidateMatches = rejected.matches
+            candidateSnr = candidateSnr[rejected.objectMask]
+        nSafe = np.searchsorted(-candidateSnr, -safeSnrs, side='right')
+
+        # Draw the random pairs once for all thresholds
+        if len(safeSnrs) > 0:
+            magDiffs = getRandomDiffsRmsInMmags(candidateMatches,
+                                                dataset.magKey,
+                                                numRandomShuffles,
+                                                seed=self.seed)
+            if not dataset.rejectsOutliers:
+                magDiffs = magDiffs[:, candidates]
+
+        pa1 = np.full(len(safeSnrs), np.nan)
+        pa1Rms = np.full(len(safeSnrs), np.nan)
+        for i, n in enumerate(nSafe):
+            if n == 0:
+                continue
+            rms, iqr = computeWidths(magDiffs[:, :n])
+            pa1Rms[i], pa1[i] = np.mean(rms), np.mean(iqr)
+
+        self.safeSnr = safeSnrs * u.Unit('')
+        self.nSafe = nSafe * u.Unit('')
+        self.PA1 = pa1 * u.mmag
+        self.PA1Rms = pa1Rms * u.mmag
+
+    def _computeBrightSweep(self, dataset, order, sortedSnr, brightSnrs):
+        mag = quantityValues(dataset.mag, u.mag)[order]
+        magErr = quantityValues(dataset.magerr, u.mag)[order]
+        magRms = quantityValues(dataset.magrms, u.mag)[order]
+        dist = quantityValues(dataset.dist, u.marcsec)[order]
+
+        # Bright stars are strictly above the threshold
+        nBright = np.searchsorted(-sortedSnr, -brightSnrs, side='left')
+
+        results = np.full((len(brightSnrs), 7), np.nan)
+        for i, n in enumerate(nBright):
+            if n == 0:
+                continue
+            results[i, 0] = np.median(magRms[:n])
+            results[i, 4] = np.median(dist[:n])
+            if n < 3:
+                continue
+
+            photParams = fitPhotErrModel(mag[:n], magErr[:n])
+            results[i, 1] = photParams['sigmaSys'].to(u.mag).value
+            results[i, 2] = photParams['gamma'].value
+            results[i, 3] = photParams['m5'].to(u.mag).value
+
+            try:
+                astromParams = fitAstromErrModel(sortedSnr[:n], dist[:n])
+            except (RuntimeError, ValueError) as e:
+                print("fitAstromErrModel fitting failed for brightSnr "
+                      "{0:.1f} with".format(brightSnrs[i]))
+                print(e)
+                continue
+            results[i, 5] = astromParams['theta'].to(u.marcsec).value
+            results[i, 6] = astromParams['sigmaSys'].to(u.marcsec).value
+
+        self.brightSnr = brightSnrs * u.Unit('')
+        self.nBright = nBright * u.Unit('')
+        self.photScatter = results[:, 0] * u.mag
+        self.sigmaSys = results[:, 1] * u.mag
+        self.gamma = results[:, 2] * u.Unit('')
+        self.m5 = results[:, 3] * u.mag
+        self.astromScatter = results[:, 4] * u.marcsec
+        self.theta = results[:, 5] * u.marcsec
+        self.astromSigmaSys = results[:, 6] * u.marcsec
+
+    @property
+    def safeSnrTable(self):
+        """`astropy.table.Table` of the ``safeSnr`` sweep, one row per
+        threshold.
+        """
+        return Table([self.safeSnr, self.nSafe, self.PA1, self.PA1Rms],
+                     names=('safeSnr', 'nSafe', 'PA1', 'PA1Rms'))
+
+    @property
+    def brightSnrTable(self):
+        """`astropy.table.Table` of the ``brightSnr`` sweep, one row per
+        threshold.
+        """
+        return Table([self.brightSnr, self.nBright, self.photScatter,
+                      self.sigmaSys, self.gamma, self.m5,
+                      self.astromScatter, self.theta, self.astromSigmaSys],
+                     names=('brightSnr', 'nBright', 'photScatter',
+                            'sigmaSys', 'gamma', 'm5',
+                            'astromScatter', 'theta', 'astromSigmaSys'))
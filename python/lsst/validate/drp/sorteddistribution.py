@@ -0,0 +1,137 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Sorted samples of values, from which many percentiles and tail fractions
+can be read without scanning the values again.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object, zip
+
+import numpy as np
+
+
+__all__ = ['SortedDistribution']
+
+
+class SortedDistribution(object):
+    """Sorted copy of one or more samples of values.
+
+    Sorting costs as much as a couple of `numpy.percentile` calls, after
+    which every percentile is an index lookup and every tail fraction a
+    binary search, so a distribution that is evaluated at many thresholds
+    (e.g., one per specification level) is sorted once and shared. It
+    answers `percentile` and `fractionAbove` as a `LogQuantileSketch` does,
+    but exactly.
+
+    Parameters
+    ----------
+    values : `numpy.ndarray`
+        Finite values of a sample, or of several samples of the same size,
+        one per row.
+    weights : `numpy.ndarray`, optional
+        Non-negative weight of each of ``values``. Percentiles are then
+        computed as by `lsst.validate.drp.util.weightedPercentile`.
+    """
+
+    def __init__(self, values, weights=None):
+        values = np.asarray(values, dtype=float)
+        if weights is None:
+            self.values = np.sort(values, axis=-1)
+            self.cumulativeWeights = None
+        else:
+            order = np.argsort(values, axis=-1, kind='mergesort')
+            index = tuple(np.indices(order.shape)[:-1]) + (order,)
+            weights = np.broadcast_to(np.asarray(weights, dtype=float),
+                                      values.shape)[index]
+            self.values = values[index]
+            self.cumulativeWeights = np.cumsum(weights, axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._midpoints = ((self.cumulativeWeights - 0.5*weights) /
+                                   self.cumulativeWeights[..., -1:])
+
+    @property
+    def count(self):
+        """Number of values in each sample (`int`)."""
+        return self.values.shape[-1]
+
+    def percentile(self, percentiles):
+        """Percentiles of each sample, as `numpy.percentile` would compute
+        them.
+
+        Parameters
+        ----------
+        percentiles : `float` or `numpy.ndarray`
+            Percentiles to compute, between 0 and 100.
+
+        Returns
+        -------
+        values : `float` or `numpy.ndarray`
+            Shape: the shape of the samples other than the last axis, then
+            that of ``percentiles``. NaN for empty samples, or samples of
+            zero total weight.
+        """
+        quantiles = np.asarray(percentiles, dtype=float)/100.
+        shape = self.values.shape[:-1] + quantiles.shape
+        if self.count == 0:
+            return np.full(shape, np.nan)[()]
+        if self.cumulativeWeights is None:
+            rank = quantiles*(self.count - 1)
+            lower = np.floor(rank).astype(int)
+            upper = np.minimum(lower + 1, self.count - 1)
+            below = self.values[..., lower]
+            return (below + (rank - lower)*(self.values[..., upper] - below))[()]
+
+        values = self.values.reshape(-1, self.count)
+        midpoints = self._midpoints.reshape(-1, self.count)
+        result = np.array([np.interp(quantiles, m, v)
+                           for m, v in zip(midpoints, values)])
+        result[self.cumulativeWeights.reshape(-1, self.count)[:, -1] <= 0] = np.nan
+        return result.reshape(shape)[()]
+
+    def fractionAbove(self, threshold):
+        """Fraction of the values of each sample larger than ``threshold``
+        (weighted, if there are weights).
+
+        Parameters
+        ----------
+        threshold : `float`
+
+        Returns
+        -------
+        fraction : `float` or `numpy.ndarray`
+            Shape: the shape of the samples other than the last axis. NaN
+            for empty samples, or samples of zero total weight.
+        """
+        shape = self.values.shape[:-1]
+        if self.count == 0:
+            return np.full(shape, np.nan)[()]
+        values = self.values.reshape(-1, self.count)
+        index = np.array([np.searchsorted(v, threshold, side='right')
+                          for v in values])
+        if self.cumulativeWeights is None:
+            fraction = (self.count - index) / self.count
+        else:
+            cumulative = self.cumulativeWeights.reshape(-1, self.count)
+            rows = np.arange(len(cumulative))
+            below = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.where(cumulative[:, -1] > 0,
+                                    1 - below / cumulative[:, -1], np.nan)
+        return fraction.reshape(shape)[()]
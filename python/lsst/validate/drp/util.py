@@ -26,6 +26,7 @@ from past.builtins import basestring
 import os
 
 import numpy as np
+import astropy.units as u
 import yaml
 
 import lsst.daf.persistence as dafPersist
@@ -140,6 +141,107 @@ def sphDist(ra1, dec1, ra2, dec2):
     return dist
 
 
+def quantityValues(quantity, unit):
+    """Return the values of ``quantity`` in ``unit`` as a plain array.
+
+    No copy is made if ``quantity`` is already in ``unit``, so this is the
+    cheap way to get at the arrays behind the datums of a blob.
+
+    Parameters
+    ----------
+    quantity : `astropy.units.Quantity`, `numpy.ndarray` or scalar
+        Values to convert. Plain arrays and scalars are assumed to already
+        be in ``unit``.
+    unit : `astropy.units.Unit` or `str`
+        Unit of the returned values.
+
+    Returns
+    -------
+    values : `numpy.ndarray` or `float`
+        Values of ``quantity`` in ``unit``.
+    """
+    if not isinstance(quantity, u.Quantity):
+        return np.asarray(quantity)
+    if quantity.unit == u.Unit(unit):
+        return quantity.value
+    return quantity.to(unit).value
+
+
+def weightedPercentile(values, weights, percentiles):
+    """Percentiles of weighted values.
+
+    Each value is taken to fill a share of the cumulative distribution
+    proportional to its weight, centered on the midpoint of that share; the
+    percentiles interpolate linearly between those midpoints.
+
+    Parameters
+    ----------
+    values : `numpy.ndarray`
+        Values.
+    weights : `numpy.ndarray`
+        Non-negative weight of each value.
+    percentiles : `float` or `numpy.ndarray`
+        Percentiles to compute, between 0 and 100.
+
+    Returns
+    -------
+    percentiles : `float` or `numpy.ndarray`
+        NaN if the total weight is zero.
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    totalWeight = weights.sum()
+    if totalWeight <= 0:
+        return np.full(np.shape(percentiles), np.nan)[()]
+    order = np.argsort(values, kind='mergesort')
+    midpoints = (np.cumsum(weights[order]) - 0.5*weights[order]) / totalWeight
+    return np.interp(np.asarray(percentiles, dtype=float)/100., midpoints,
+                     values[order])[()]
+
+
+def makeSeed(seed=None):
+    """Return ``seed``, or a new random seed if it is `None`.
+
+    A stochastic computation that resolves its seed with this function can
+    always record it, and be reproduced from the recorded seed.
+
+    Parameters
+    ----------
+    seed : `int`, optional
+        Seed, between 0 and 2**32 - 1.
+
+    Returns
+    -------
+    seed : `int`
+    """
+    if seed is None:
+        return int(np.random.randint(2**31))
+    return int(seed)
+
+
+def randomStream(seed, index):
+    """Return random stream ``index`` of ``seed``.
+
+    Each stream depends only on ``seed`` and ``index``, so the streams of
+    one seed can be consumed in any order, or split between processes, with
+    bitwise-identical results. Their Mersenne Twister states are
+    initialized from the key ``[seed, index]``, which decorrelates streams
+    with nearby indices.
+
+    Parameters
+    ----------
+    seed : `int`
+        Seed shared by the streams, e.g. from `makeSeed`.
+    index : `int`
+        Index of the stream (e.g., of a random shuffle).
+
+    Returns
+    -------
+    rng : `numpy.random.RandomState`
+    """
+    return np.random.RandomState([seed, index])
+
+
 def getCcdKeyName(dataid):
     """Return the key in a dataId that's referring to the CCD or moral equivalent.
 
@@ -34,10 +34,17 @@ from .util import repoNameToPrefix
 from .matchreduce import MatchedMultiVisitDataset
 from .photerrmodel import PhotometricErrorModel
 from .astromerrmodel import AstrometricErrorModel
-from .calcsrd import (AMxMeasurement, AFxMeasurement, ADxMeasurement,
-                      PA1Measurement, PA2Measurement, PF1Measurement)
-from .plot import (plotAMx, plotPA1, plotPhotometryErrorModel,
-                   plotAstrometryErrorModel)
+from .snrsweep import SnrThresholdSweep
+from .amxccdmap import AMxCcdMap
+from .amxprofile import AMxProfile
+from .pa1breakdown import PA1Breakdown
+from .zeropoints import ZeroPointResiduals
+from .calcsrd import (makeAMxMeasurements, AMxObjectArrays, AFxMeasurement,
+                      ADxMeasurement, PA1Measurement, PA2Measurement,
+                      PF1Measurement)
+from .plot import (plotAMx, plotAMxCcdMap, plotAMxProfile, plotPA1,
+                   plotPA1Breakdown,
+                   plotPhotometryErrorModel, plotAstrometryErrorModel)
 
 
 __all__ = ['plot_metrics', 'print_metrics', 'print_pass_fail_summary',
@@ -217,8 +224,14 @@ def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False,
 
 def runOneFilter(repo, visitDataIds, metrics, brightSnr=100,
                  makeJson=True, filterName=None, outputPrefix='',
-                 useJointCal=False, verbose=False,
-                 **kwargs):
+                 useJointCal=False, compact=False, safeSnrSweep=None,
+                 brightSnrSweep=None, nWorkers=1, amxMaxPairs=None,
+                 amxTolerance=None, amxProfileBins=None, amxPairStore=None,
+                 amxMaxStoredPairs=None, amxCcdMapAnnulus=None, seed=None,
+                 pa1Exact=False, pa1StoredShuffles=None, pa2AllShuffles=False,
+                 pa1MagBins=None, pa1ByCcd=False, nBootstrap=None,
+                 clipSigma=None, maxChi2=None, zeroPoints=False,
+                 zeroPointsByCcd=False, verbose=False, **kwargs):
     """Main executable for the case where there is just one filter.
 
     Plot files and JSON files are generated in the local directory
@@ -251,50 +264,197 @@ def runOneFilter(repo, visitDataIds, metrics, brightSnr=100,
         Name of the filter (bandpass).
     useJointCal : bool, optional
         Use jointcal/meas_mosaic outputs to calibrate positions and fluxes.
+    compact : bool, optional
+        Store the matched data in compact form to reduce memory use;
+        see `MatchedMultiVisitDataset`.
+    clipSigma, maxChi2 : float, optional
+        If given, reject outlying detections and variable stars from the
+        safe matches used by every metric (see `MatchedMultiVisitDataset`).
+        Require ``compact``.
+    safeSnrSweep : list of float, optional
+        If given, PA1 is also evaluated for each of these ``safeSnr``
+        thresholds and stored in a `SnrThresholdSweep` blob.
+    brightSnrSweep : list of float, optional
+        If given, the photometric scatter and error models are also
+        evaluated for each of these ``brightSnr`` thresholds and stored in
+        a `SnrThresholdSweep` blob.
+    nWorkers : int, optional
+        Number of processes used to evaluate pairs of stars for AMx and
+        the random shuffles of PA1.
+    amxMaxPairs : int, optional
+        If given, estimate AM1, AM2 and AM3 from random samples of at most
+        this many pairs of stars, with confidence intervals.
+    amxTolerance : float, optional
+        Stop sampling pairs once the confidence interval on AMx is narrower
+        than this [milliarcsec]. Only used with ``amxMaxPairs``.
+    amxProfileBins : list of float, optional
+        If given, the median and percentiles of the astrometric
+        repeatability are also computed in these separation bins
+        [arcmin] and stored in an `AMxProfile` blob.
+    amxPairStore : str, optional
+        Directory of an `AMxPairStore` from which to evaluate AMx. It is
+        built on first use, and reused by later runs on the same data.
+    amxMaxStoredPairs : int, optional
+        If given, keep the RMS distances of at most this many pairs of stars
+        per AMx metric; AMx, AFx and ADx are computed from a sketch of the
+        RMS distances of the others.
+    amxCcdMapAnnulus : list of float, optional
+        If given, the median astrometric repeatability of the pairs of stars
+        separated by these inner and outer radii [arcmin] is also computed
+        for each pair of CCDs and stored in an `AMxCcdMap` blob, from the
+        same pass over pairs as AM1, AM2 and AM3.
+    seed : int, optional
+        Seed of the random draws (PA1 pairs of visits, AMx pair sampling),
+        recorded with each measurement. A new seed is drawn if `None`.
+    pa1Exact : bool, optional
+        Compute PA1, PA2 and PF1 from every pair of visits of every star
+        instead of random pairs.
+    pa1StoredShuffles : int, optional
+        Number of random samples of the PA1 magnitude differences to store
+        in the JSON output. All are stored if `None`.
+    pa2AllShuffles : bool, optional
+        Compute PA2 and PF1 as the mean over every random sample of PA1,
+        instead of from the first one.
+    pa1MagBins : list of float, optional
+        If given, PA1 is also computed in these magnitude bins [mag], from
+        the same pairs of visits, and stored in a `PA1Breakdown` blob linked
+        to the PA1 measurement.
+    pa1ByCcd : bool, optional
+        Also compute PA1 for the stars on each CCD, in the `PA1Breakdown`
+        blob.
+    zeroPoints : bool, optional
+        Fit a magnitude offset to each visit, and compute PA1 once they are
+        removed, in a `ZeroPointResiduals` blob linked to the PA1
+        measurement.
+    zeroPointsByCcd : bool, optional
+        With ``zeroPoints``, fit an offset to each CCD of each visit.
+    nBootstrap : int, optional
+        If given, number of bootstrap resamplings of the stars (and of the
+        pairs of stars, by first star, for AMx) from which a confidence
+        interval is computed and stored with each measurement.
     verbose : bool, optional
         Output additional information on the analysis steps.
     """
     matchedDataset = MatchedMultiVisitDataset(repo, visitDataIds,
                                               useJointCal=useJointCal,
+                                              compact=compact,
+                                              clipSigma=clipSigma,
+                                              maxChi2=maxChi2,
                                               verbose=verbose)
     photomModel = PhotometricErrorModel(matchedDataset)
     astromModel = AstrometricErrorModel(matchedDataset)
     linkedBlobs = {'photomModel': photomModel, 'astromModel': astromModel}
 
-    job = Job(blobs=[matchedDataset, photomModel, astromModel])
+    blobs = [matchedDataset, photomModel, astromModel]
+    if safeSnrSweep or brightSnrSweep:
+        snrSweep = SnrThresholdSweep(matchedDataset, safeSnrs=safeSnrSweep,
+                                     brightSnrs=brightSnrSweep, seed=seed)
+        if safeSnrSweep:
+            print(snrSweep.safeSnrTable)
+        if brightSnrSweep:
+            print(snrSweep.brightSnrTable)
+        blobs.append(snrSweep)
+
+    amxMetrics = [metrics['AM{0:d}'.format(x)] for x in (1, 2, 3)
+                  if 'AM{0:d}'.format(x) in metrics]
+    if amxMetrics or amxProfileBins or amxCcdMapAnnulus:
+        # Positions of the safe stars, shared by all AMx computations
+        amxObjects = AMxObjectArrays.fromGroupView(
+            matchedDataset.safeMatches,
+            ccdKey=matchedDataset.ccdKey if amxCcdMapAnnulus else None)
+
+    if amxProfileBins:
+        amxProfile = AMxProfile(matchedDataset, binEdges=amxProfileBins,
+                                nWorkers=nWorkers, objectArrays=amxObjects,
+                                verbose=verbose)
+        print(amxProfile.table)
+        blobs.append(amxProfile)
+        linkedBlobs['amxProfile'] = amxProfile
+
+    if amxCcdMapAnnulus and not amxMetrics:
+        # Otherwise the map is made from the pairs of the AMx measurements
+        amxCcdMap = AMxCcdMap(matchedDataset, annulus=amxCcdMapAnnulus,
+                              nWorkers=nWorkers, objectArrays=amxObjects,
+                              verbose=verbose)
+        blobs.append(amxCcdMap)
+        linkedBlobs['amxCcdMap'] = amxCcdMap
+
+    job = Job(blobs=blobs)
+
+    # Only metrics present in `metrics` are measured. The per-object
+    # statistics of `matchedDataset` are computed lazily, so a run
+    # that requests a subset of metrics only pays for what they use.
+    # AM1, AM2 and AM3 share a single pass over pairs of objects.
+    if amxMetrics:
+        makeAMxMeasurements(amxMetrics, matchedDataset, filterName,
+                            job=job, linkedBlobs=linkedBlobs, verbose=verbose,
+                            nWorkers=nWorkers, maxPairs=amxMaxPairs,
+                            tolerance=amxTolerance, seed=seed,
+                            objectArrays=amxObjects,
+                            pairStorePath=amxPairStore,
+                            maxStoredPairs=amxMaxStoredPairs,
+                            nBootstrap=nBootstrap,
+                            ccdMapAnnulus=amxCcdMapAnnulus)
 
     for x in (1, 2, 3):
         amxName = 'AM{0:d}'.format(x)
         afxName = 'AF{0:d}'.format(x)
         adxName = 'AD{0:d}'.format(x)
 
-        AMxMeasurement(metrics[amxName], matchedDataset, filterName,
-                       job=job, linkedBlobs=linkedBlobs, verbose=verbose)
-
-        for specName in metrics[afxName].get_spec_names(filter_name=filterName):
-            AFxMeasurement(metrics[afxName], matchedDataset,
-                           job.get_measurement(amxName), filterName, specName,
-                           job=job, linkedBlobs=linkedBlobs, verbose=verbose)
-
-            ADxMeasurement(metrics[adxName], matchedDataset,
-                           job.get_measurement(amxName), filterName, specName,
-                           job=job, linkedBlobs=linkedBlobs, verbose=verbose)
-
-    PA1Measurement(metrics['PA1'], matchedDataset, filterName,
-                   job=job, linkedBlobs=linkedBlobs,
-                   verbose=verbose)
-
-    for specName in metrics['PA2'].get_spec_names(filter_name=filterName):
-        PA2Measurement(metrics['PA2'], matchedDataset,
-                       pa1=job.get_measurement('PA1'), filter_name=filterName,
-                       spec_name=specName, verbose=verbose,
-                       job=job, linkedBlobs=linkedBlobs)
-
-    for specName in metrics['PF1'].get_spec_names(filter_name=filterName):
-        PF1Measurement(metrics['PF1'], matchedDataset,
-                       job.get_measurement('PA1'),
-                       filterName, specName, verbose=verbose,
-                       job=job, linkedBlobs=linkedBlobs)
+        if amxName not in metrics:
+            continue
+
+        if afxName in metrics:
+            for specName in metrics[afxName].get_spec_names(filter_name=filterName):
+                AFxMeasurement(metrics[afxName], matchedDataset,
+                               job.get_measurement(amxName), filterName, specName,
+                               job=job, linkedBlobs=linkedBlobs, verbose=verbose)
+
+        if adxName in metrics:
+            for specName in metrics[adxName].get_spec_names(filter_name=filterName):
+                ADxMeasurement(metrics[adxName], matchedDataset,
+                               job.get_measurement(amxName), filterName, specName,
+                               job=job, linkedBlobs=linkedBlobs, verbose=verbose)
+
+    if 'PA1' in metrics:
+        PA1Measurement(metrics['PA1'], matchedDataset, filterName,
+                       job=job, linkedBlobs=linkedBlobs,
+                       verbose=verbose, seed=seed, nWorkers=nWorkers,
+                       exact=pa1Exact, storedShuffles=pa1StoredShuffles,
+                       nBootstrap=nBootstrap)
+        if pa1MagBins or pa1ByCcd:
+            pa1 = job.get_measurement('PA1')
+            pa1Breakdown = PA1Breakdown(matchedDataset, pa1,
+                                        magBins=pa1MagBins or None,
+                                        byCcd=pa1ByCcd)
+            print(pa1Breakdown.magTable)
+            pa1.pa1Breakdown = pa1Breakdown
+        if zeroPoints:
+            pa1 = job.get_measurement('PA1')
+            zeroPointResiduals = ZeroPointResiduals(matchedDataset, pa1,
+                                                    byCcd=zeroPointsByCcd)
+            print(zeroPointResiduals.largestOffsets())
+            print('PA1 after removing the zero-point offsets: {0:.2f} '
+                  '(before: {1:.2f})'.format(zeroPointResiduals.pa1Corrected,
+                                             zeroPointResiduals.pa1))
+            pa1.zeroPointResiduals = zeroPointResiduals
+
+        if 'PA2' in metrics:
+            for specName in metrics['PA2'].get_spec_names(filter_name=filterName):
+                PA2Measurement(metrics['PA2'], matchedDataset,
+                               pa1=job.get_measurement('PA1'),
+                               filter_name=filterName,
+                               spec_name=specName, verbose=verbose,
+                               job=job, linkedBlobs=linkedBlobs,
+                               allShuffles=pa2AllShuffles)
+
+        if 'PF1' in metrics:
+            for specName in metrics['PF1'].get_spec_names(filter_name=filterName):
+                PF1Measurement(metrics['PF1'], matchedDataset,
+                               job.get_measurement('PA1'),
+                               filterName, specName, verbose=verbose,
+                               job=job, linkedBlobs=linkedBlobs,
+                               allShuffles=pa2AllShuffles)
 
     if makeJson:
         job.write_json(outputPrefix + '.json')
@@ -305,21 +465,30 @@ def runOneFilter(repo, visitDataIds, metrics, brightSnr=100,
 def plot_metrics(job, filterName, outputPrefix=''):
     """Plot AM1, AM2, AM3, PA1 plus related informational plots.
 
+    Plots of metrics that were not measured in ``job`` are skipped.
+
     Parameters
     ---
     job - an lsst.validate.base.Job object
     filterName - string identifying the filter.
     """
+    amxs = []
     for x in (1, 2, 3):
         amxName = 'AM{0:d}'.format(x)
         afxName = 'AF{0:d}'.format(x)
         # ADx is included on the AFx plots
         spec_name = 'design'
 
-        amx = job.get_measurement(amxName)
-        afx = job.get_measurement(afxName, spec_name=spec_name)
+        amx = _findMeasurement(job, amxName)
+        if amx is None:
+            continue
+        amxs.append(amx)
+        afx = _findMeasurement(job, afxName, spec_name=spec_name)
 
-        if amx.quantity is not None:
+        if amx.quantity is not None and afx is None:
+            print('\tSkipped plot{0}: {1} was not measured'.format(
+                amxName, afxName))
+        elif amx.quantity is not None:
             try:
                 plotAMx(amx, afx, filterName, amxSpecName=spec_name,
                         outputPrefix=outputPrefix)
@@ -327,33 +496,80 @@ def plot_metrics(job, filterName, outputPrefix=''):
                 print(e)
                 print('\tSkipped plot{}'.format(amxName))
 
+    pa1 = _findMeasurement(job, 'PA1')
+    measurements = amxs + ([pa1] if pa1 is not None else [])
+
+    # The separation profile and CCD map are linked to the measurements, if
+    # computed
+    amxProfile = _findLinkedBlob(measurements, 'amxProfile')
+    if amxProfile is not None:
+        try:
+            plotAMxProfile(amxProfile, amxs=amxs, outputPrefix=outputPrefix)
+        except RuntimeError as e:
+            print(e)
+            print('\tSkipped plotAMxProfile')
+
+    amxCcdMap = _findLinkedBlob(measurements, 'amxCcdMap')
+    if amxCcdMap is not None:
+        try:
+            plotAMxCcdMap(amxCcdMap, outputPrefix=outputPrefix)
+        except RuntimeError as e:
+            print(e)
+            print('\tSkipped plotAMxCcdMap')
+
+    if pa1 is not None:
+        try:
+            plotPA1(pa1, outputPrefix=outputPrefix)
+        except RuntimeError as e:
+            print(e)
+            print('\tSkipped plotPA1')
+
+        if 'pa1Breakdown' in pa1.blobs:
+            try:
+                plotPA1Breakdown(pa1.blobs['pa1Breakdown'],
+                                 outputPrefix=outputPrefix)
+            except RuntimeError as e:
+                print(e)
+                print('\tSkipped plotPA1Breakdown')
+
+    matchedDataset = _findLinkedBlob(measurements, 'matchedDataset')
+    photomModel = _findLinkedBlob(measurements, 'photomModel')
+    if matchedDataset is not None and photomModel is not None:
+        try:
+            plotPhotometryErrorModel(matchedDataset, photomModel,
+                                     filterName=filterName,
+                                     outputPrefix=outputPrefix)
+        except RuntimeError as e:
+            print(e)
+            print('\tSkipped plotPhotometryErrorModel')
+
+    astromModel = _findLinkedBlob(measurements, 'astromModel')
+    if matchedDataset is not None and astromModel is not None:
+        try:
+            plotAstrometryErrorModel(matchedDataset, astromModel,
+                                     outputPrefix=outputPrefix)
+        except RuntimeError as e:
+            print(e)
+            print('\tSkipped plotAstrometryErrorModel')
+
+
+def _findMeasurement(job, metricName, **kwargs):
+    """Return the measurement of ``metricName`` in ``job``, or `None` if it
+    was not measured.
+    """
     try:
-        pa1 = job.get_measurement('PA1')
-        plotPA1(pa1, outputPrefix=outputPrefix)
-    except RuntimeError as e:
-        print(e)
-        print('\tSkipped plotPA1')
+        return job.get_measurement(metricName, **kwargs)
+    except RuntimeError:
+        return None
 
-    try:
-        matchedDataset = pa1.blobs['matchedDataset']
-        photomModel = pa1.blobs['photomModel']
-        filterName = pa1.filter_name
-        plotPhotometryErrorModel(matchedDataset, photomModel,
-                                 filterName=filterName,
-                                 outputPrefix=outputPrefix)
-    except RuntimeError as e:
-        print(e)
-        print('\tSkipped plotPhotometryErrorModel')
 
-    try:
-        am1 = job.get_measurement('AM1')
-        matchedDataset = am1.blobs['matchedDataset']
-        astromModel = am1.blobs['astromModel']
-        plotAstrometryErrorModel(matchedDataset, astromModel,
-                                 outputPrefix=outputPrefix)
-    except RuntimeError as e:
-        print(e)
-        print('\tSkipped plotAstrometryErrorModel')
+def _findLinkedBlob(measurements, name):
+    """Return the blob ``name`` linked to any of ``measurements``, or `None`.
+    """
+    for measurement in measurements:
+        if name in measurement.blobs:
+            return measurement.blobs[name]
+    return None
 
 
 def print_metrics(job, filterName, metrics):
@@ -0,0 +1,321 @@
+# LSST Data Management System
+# Copyright 2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Per-visit (or per-exposure) photometric zero-point residuals, from a
+sparse least-squares fit of all the detections of the good matches.
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import astropy.units as u
+from astropy.table import Table
+
+import lsst.pipe.base as pipeBase
+from lsst.validate.base import BlobBase
+
+from .calcsrd.pa1 import calcPa1
+from .groupedarrays import GroupedArrays
+
+
+__all__ = ['ZeroPointResiduals', 'solveMagnitudeOffsets']
+
+
+class ZeroPointResiduals(BlobBase):
+    """Serializable magnitude offsets of each visit (or of each CCD of each
+    visit) relative to the mean magnitudes of the objects, and PA1 once they
+    are removed.
+
+    The magnitude of each detection of the good matches is modelled as the
+    magnitude of its object plus the offset of its visit, and both are
+    fitted at once by sparse least squares (see `solveMagnitudeOffsets`).
+    Offsets are relative: their weighted mean over the detections is 0.
+
+    PA1 is then computed again from the safe matches with the offsets
+    subtracted, from the same random pairs of visits as ``pa1``, so the
+    difference between the two is due to the zero points alone.
+
+    Parameters
+    ----------
+    matchedMultiVisitDataset : `MatchedMultiVisitDataset`
+        The dataset of ``pa1``.
+    pa1 : `lsst.validate.drp.calcsrd.PA1Measurement`
+        PA1 measurement, whose random pairs of visits (or exact pairs) are
+        reused.
+    byCcd : `bool`, optional
+        Fit an offset for each CCD of each visit, instead of each visit.
+    weighted : `bool`, optional
+        Weight the detections by their inverse magnitude variance.
+    atol, btol : `float`, optional
+        Stopping tolerances of `scipy.sparse.linalg.lsmr`.
+    maxIter : `int`, optional
+        Maximum number of iterations of `scipy.sparse.linalg.lsmr`.
+
+    Attributes
+    ----------
+    visits : `astropy.units.Quantity`
+        Visit of each offset.
+    ccds : `astropy.units.Quantity`
+        CCD of each offset, if ``byCcd``.
+    nDetections : `astropy.units.Quantity`
+        Number of good detections in each visit (or CCD of a visit).
+    offsets : `astropy.units.Quantity`
+        Magnitude offset of each visit (or CCD of a visit).
+    residualRms : `astropy.units.Quantity`
+        RMS of the residuals of the fit of the detections of each visit (or
+        CCD of a visit), weighted if ``weighted``.
+    pa1 : `astropy.units.Quantity`
+        PA1 of ``pa1``.
+    pa1Corrected : `astropy.units.Quantity`
+        PA1 from the same pairs, with the offsets subtracted.
+    nIterations : `int`
+        Number of iterations of the solver. Not serialized.
+    """
+
+    name = 'ZeroPointResiduals'
+
+    def __init__(self, matchedMultiVisitDataset, pa1, byCcd=False,
+                 weighted=True, atol=1e-10, btol=1e-10, maxIter=None):
+        BlobBase.__init__(self)
+
+        self.register_datum(
+            'visits',
+            label='visit',
+            description='Visit of each magnitude offset')
+        self.register_datum(
+            'nDetections',
+            label='N(detections)',
+            description='Number of good detections in each visit')
+        self.register_datum(
+            'offsets',
+            label='offset',
+            description='Magnitude offset of each visit relative to the mean '
+                        'magnitudes of the objects')
+        self.register_datum(
+            'residualRms',
+            label='RMS',
+            description='RMS of the residuals of the fit of the magnitudes in '
+                        'each visit')
+        self.register_datum(
+            'pa1',
+            label='PA1',
+            description='PA1 before removing the offsets')
+        self.register_datum(
+            'pa1Corrected',
+            label='PA1 corrected',
+            description='PA1 from the same pairs of visits, after removing '
+                        'the offsets')
+        if byCcd:
+            self.register_datum(
+                'ccds',
+                label='CCD',
+                description='CCD of each magnitude offset')
+
+        ccdKey = matchedMultiVisitDataset.ccdKey
+        magName, errName = 'base_PsfFlux_mag', 'base_PsfFlux_magErr'
+        unitFields = ['visit', ccdKey] if byCcd else ['visit']
+        good = _groupedArrays(matchedMultiVisitDataset.goodMatches,
+                              [magName, errName] + unitFields)
+
+        # Index of the visit (or exposure) of each detection
+        unitKeys = np.stack([good.get(name) for name in unitFields], axis=1)
+        units, unitIndex = np.unique(unitKeys, axis=0, return_inverse=True)
+        unitIndex = unitIndex.ravel()
+        weights = None
+        if weighted:
+            with np.errstate(divide='ignore'):
+                weights = 1. / np.asarray(good.get(errName), dtype=float)**2
+        solution = solveMagnitudeOffsets(good.groupIndex, unitIndex,
+                                         good.get(magName),
+                                         weights=weights, atol=atol,
+                                         btol=btol, maxIter=maxIter)
+        if weights is None:
+            weights = np.ones(good.nSources)
+        nDetections = np.bincount(unitIndex, minlength=len(units))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            residualVariance = (
+                np.bincount(unitIndex, weights=weights*solution.residuals**2,
+                            minlength=len(units)) /
+                np.bincount(unitIndex, weights=weights, minlength=len(units)))
+
+        self.visits = units[:, 0] * u.Unit('')
+        if byCcd:
+            self.ccds = units[:, 1] * u.Unit('')
+        self.nDetections = nDetections * u.Unit('')
+        self.offsets = solution.offsets * u.mag
+        self.residualRms = np.sqrt(residualVariance) * u.mag
+        self.nIterations = solution.nIterations
+
+        # Subtract the offsets from the safe matches; detections of visits
+        # without good ones are left as they are
+        safe = _groupedArrays(matchedMultiVisitDataset.safeMatches,
+                              [magName] + unitFields)
+        safeKeys = np.stack([safe.get(name) for name in unitFields], axis=1)
+        safeIndex = _rowIndex(units, safeKeys)
+        safeOffsets = np.zeros(safe.nSources)
+        found = safeIndex >= 0
+        safeOffsets[found] = solution.offsets[safeIndex[found]]
+        columns = dict(safe.columns)
+        columns[magName] = safe.get(magName) - safeOffsets
+        corrected = GroupedArrays(safe.offsets, columns, ids=safe.ids)
+
+        exact = bool(pa1.exact)
+        seed = None if exact else int(pa1.seed)
+        results = calcPa1(corrected, magName,
+                          numRandomShuffles=int(pa1.numRandomShuffles),
+                          seed=seed, exact=exact)
+        self.pa1 = pa1.quantity
+        self.pa1Corrected = results['PA1']
+
+    @property
+    def table(self):
+        """`astropy.table.Table` of the offsets, one row per visit (or CCD of
+        a visit).
+        """
+        columns = [self.visits]
+        names = ['visit']
+        if 'ccds' in self.datums:
+            columns.append(self.ccds)
+            names.append('ccd')
+        columns += [self.nDetections, self.offsets.to(u.mmag),
+                    self.residualRms.to(u.mmag)]
+        names += ['nDetections', 'offset', 'residualRms']
+        return Table(columns, names=names)
+
+    def largestOffsets(self, n=10):
+        """`table` of the ``n`` largest offsets, in decreasing absolute
+        value: the visits with the worst zero points.
+        """
+        table = self.table
+        order = np.argsort(-np.abs(self.offsets.value), kind='mergesort')
+        return table[order[:n]]
+
+
+def solveMagnitudeOffsets(objectIndex, unitIndex, mags, weights=None,
+                          atol=1e-10, btol=1e-10, maxIter=None):
+    """Fit the magnitudes of detections as the magnitude of their object
+    plus an offset of their unit (e.g. visit), by sparse least squares.
+
+    The design matrix has one row per detection, with two non-zero entries:
+    one in the column of its object and one in that of its unit. It is
+    solved with `scipy.sparse.linalg.lsmr` after scaling its columns to
+    unit norm, so memory and time per iteration grow with the number of
+    detections only, whatever the number of objects and units.
+
+    Parameters
+    ----------
+    objectIndex : `numpy.ndarray`
+        Index of the object of each detection, from 0 to the number of
+        objects.
+    unitIndex : `numpy.ndarray`
+        Index of the unit of each detection, from 0 to the number of units.
+    mags : `numpy.ndarray`
+        Magnitude of each detection.
+    weights : `numpy.ndarray`, optional
+        Weight of each detection, e.g. its inverse variance. Detections
+        with a non-finite magnitude or weight are ignored.
+    atol, btol : `float`, optional
+        Stopping tolerances of `scipy.sparse.linalg.lsmr`.
+    maxIter : `int`, optional
+        Maximum number of iterations of `scipy.sparse.linalg.lsmr`.
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+        Result struct with components:
+
+        - ``objectMags``: fitted magnitude of each object (`numpy.ndarray`).
+        - ``offsets``: offset of each unit (`numpy.ndarray`); their
+          weighted mean over the detections is 0. Offsets of units that
+          are not connected to the others by shared objects are only
+          determined up to a common constant.
+        - ``residuals``: residual of each detection (`numpy.ndarray`), 0
+          where it was ignored.
+        - ``nIterations``: number of iterations of the solver (`int`).
+    """
+    objectIndex = np.asarray(objectIndex, dtype=np.int64)
+    unitIndex = np.asarray(unitIndex, dtype=np.int64)
+    mags = np.asarray(mags, dtype=float)
+    nObjects = int(objectIndex.max()) + 1 if len(objectIndex) else 0
+    nUnits = int(unitIndex.max()) + 1 if len(unitIndex) else 0
+    if weights is None:
+        weights = np.ones(len(mags))
+    weights = np.asarray(weights, dtype=float)
+    valid = np.isfinite(mags) & np.isfinite(weights) & (weights > 0)
+    weights = np.where(valid, weights, 0.)
+    mags = np.where(valid, mags, 0.)
+
+    # Start from the mean magnitude of each object, so that the solver
+    # only fits the small residuals
+    with np.errstate(invalid='ignore', divide='ignore'):
+        objectWeights = np.bincount(objectIndex, weights=weights,
+                                    minlength=nObjects)
+        objectMeans = np.nan_to_num(
+            np.bincount(objectIndex, weights=weights*mags, minlength=nObjects) /
+            objectWeights)
+    unitWeights = np.bincount(unitIndex, weights=weights, minlength=nUnits)
+
+    # Rows weighted by sqrt(weight), columns scaled to unit norm
+    sqrtWeights = np.sqrt(weights)
+    columnNorms = np.sqrt(np.concatenate([objectWeights, unitWeights]))
+    columnNorms[columnNorms == 0] = 1.
+    rows = np.arange(len(mags))
+    columns = np.concatenate([objectIndex, nObjects + unitIndex])
+    design = scipy.sparse.csr_matrix(
+        (np.concatenate([sqrtWeights, sqrtWeights]) / columnNorms[columns],
+         (np.concatenate([rows, rows]), columns)),
+        shape=(len(mags), nObjects + nUnits))
+    rhs = sqrtWeights*(mags - objectMeans[objectIndex])
+    result = scipy.sparse.linalg.lsmr(design, rhs, atol=atol, btol=btol,
+                                      maxiter=maxIter)
+    solution = result[0] / columnNorms
+    objectMags = objectMeans + solution[:nObjects]
+    offsets = solution[nObjects:]
+
+    # Fix the degeneracy between the object magnitudes and the offsets
+    shift = np.sum(unitWeights*offsets) / max(np.sum(unitWeights), 1e-300)
+    offsets = offsets - shift
+    objectMags = objectMags + shift
+    residuals = np.where(valid, mags - objectMags[objectIndex] -
+                         offsets[unitIndex], 0.)
+    return pipeBase.Struct(objectMags=objectMags, offsets=offsets,
+                           residuals=residuals, nIterations=int(result[2]))
+
+
+def _groupedArrays(matches, fields):
+    """``matches`` as `GroupedArrays`, copying ``fields`` out of a
+    `lsst.afw.table.GroupView`.
+    """
+    if isinstance(matches, GroupedArrays):
+        return matches
+    return GroupedArrays.fromGroupView(matches, fields)
+
+
+def _rowIndex(rows, keys):
+    """Index of each row of ``keys`` in the unique, sorted ``rows`` (-1 if
+    absent).
+    """
+    allRows, inverse = np.unique(np.concatenate([rows, keys]), axis=0,
+                                 return_inverse=True)
+    inverse = inverse.ravel()
+    position = np.full(len(allRows), -1, dtype=np.int64)
+    position[inverse[:len(rows)]] = np.arange(len(rows))
+    return position[inverse[len(rows):]]
@@ -22,14 +22,32 @@
 
 from __future__ import print_function
 
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
 
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
+
+import astropy.units as u
 
 import lsst.utils
-from lsst.validate.drp.calcsrd.amx import matchVisitComputeDistance
+import lsst.pipe.base as pipeBase
+from lsst.validate.base import Datum
+from lsst.validate.drp import amxccdmap
+from lsst.validate.drp.calcsrd import amx
+from lsst.validate.drp.calcsrd.amx import (matchVisitComputeDistance, VisitVectors,
+                                           arcminToRadians, AMxObjectArrays, AMxPairStore,
+                                           calcPairRmsDistances, calcRmsDistances,
+                                           calcRmsDistancesByFirstObject,
+                                           calcRmsDistancesMultiAnnulus, calcRmsDistanceSketches,
+                                           iterRmsDistanceChunks, makeAMxMeasurements,
+                                           sampleRmsDistances)
+from lsst.validate.drp.amxccdmap import AMxCcdMap
+from lsst.validate.drp.amxprofile import AMxProfile
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.util import sphDist
 
 
 def test_basic_matchVisitComputeDistance():
@@ -93,6 +111,341 @@ def test_speed_matchVisitComputeDistance(N=5000):
                               visit_obj2, ra_obj2, dec_obj2)
 
 
+def test_calcPairRmsDistances():
+    np.random.seed(54321)
+    N = 200
+    allVisits = np.arange(20) * 7 + 100
+    visits = [np.random.choice(allVisits, np.random.randint(1, 15), replace=False)
+              for _ in range(N)]
+    ras = [np.deg2rad(10 + 0.1*np.random.rand()) + 5e-8*np.random.randn(len(v))
+           for v in visits]
+    decs = [np.deg2rad(20 + 0.1*np.random.rand()) + 5e-8*np.random.randn(len(v))
+            for v in visits]
+    ras[3][0] = np.nan
+
+    obj1, obj2 = np.triu_indices(N, 1)
+    exp = []
+    for o1, o2 in zip(obj1, obj2):
+        distances = matchVisitComputeDistance(visits[o1], ras[o1], decs[o1],
+                                              visits[o2], ras[o2], decs[o2])
+        exp.append(np.std(distances) if distances else np.nan)
+
+    visitVectors = VisitVectors.fromDetections(visits, ras, decs)
+    assert_array_equal(visitVectors.visits, allVisits)
+    assert len(visitVectors.keys) == sum(len(v) for v in visits) - 1
+    obs = calcPairRmsDistances(visitVectors, obj1, obj2, batchElements=1000)
+    assert np.any(np.isnan(exp))
+    # Chords between unit vectors agree with the haversine formula to
+    # float64 rounding, i.e. 1e-15 radians (2e-7 mas)
+    assert_allclose(exp, obs, rtol=1e-10, atol=1e-15)
+
+    # A selection of objects shares the detections
+    selection = np.arange(N) % 3 != 0
+    selected = visitVectors.select(selection)
+    assert selected.vectors is visitVectors.vectors
+    index = np.flatnonzero(selection)
+    first, second = np.triu_indices(len(index), 1)
+    assert_array_equal(calcPairRmsDistances(selected, first, second),
+                       calcPairRmsDistances(visitVectors, index[first], index[second]))
+
+
+def makeMatches(N=300, nVisits=6, seed=2468):
+    np.random.seed(seed)
+    counts = np.random.randint(2, nVisits + 1, N)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    index = np.repeat(np.arange(N), counts)
+    ra0 = np.deg2rad(10 + np.random.uniform(-0.5, 0.5, N))
+    dec0 = np.deg2rad(20 + np.random.uniform(-0.5, 0.5, N))
+    columns = {'coord_ra': ra0[index] + 5e-8*np.random.randn(len(index)),
+               'coord_dec': dec0[index] + 5e-8*np.random.randn(len(index)),
+               'visit': np.concatenate([np.random.choice(nVisits, n, replace=False)
+                                        for n in counts]),
+               'base_PsfFlux_mag': np.random.uniform(17, 22, N)[index]}
+    # 3x3 CCDs of 20 arcmin
+    columns['ccd'] = (np.floor((np.rad2deg(columns['coord_ra']) - 9.5)*3)*3 +
+                      np.floor((np.rad2deg(columns['coord_dec']) - 19.5)*3)).astype(np.int32)
+    return GroupedArrays(offsets, columns)
+
+
+def test_calcRmsDistancesMultiAnnulus():
+    matches = makeMatches()
+    annuli = [np.array([4., 6.])*u.arcmin, np.array([19., 21.])*u.arcmin,
+              np.array([5., 25.])*u.arcmin]
+    magRange = np.array([17.5, 21.5])*u.mag
+    obs = calcRmsDistancesMultiAnnulus(matches, annuli, magRange)
+    for annulus, rmsDistances in zip(annuli, obs):
+        exp = calcRmsDistances(matches, annulus, magRange)
+        assert len(exp) > 0
+        assert_allclose(exp.to(u.marcsec).value, rmsDistances.to(u.marcsec).value)
+
+    # Splitting the pairs over processes gives the same result, in the same order
+    parallel = calcRmsDistancesMultiAnnulus(matches, annuli, magRange,
+                                            nWorkers=2, chunkSize=50)
+    for serialRms, parallelRms in zip(obs, parallel):
+        np.testing.assert_array_equal(serialRms.value, parallelRms.value)
+
+    # The arrays extracted once can be shared between calls
+    objectArrays = AMxObjectArrays.fromGroupView(matches)
+    shared = calcRmsDistancesMultiAnnulus(objectArrays, annuli, magRange)
+    for rmsDistances, sharedRms in zip(obs, shared):
+        np.testing.assert_array_equal(rmsDistances.value, sharedRms.value)
+
+
+def test_pairsInAnnulus():
+    matches = makeMatches()
+    annulus = np.array([19., 21.])*u.arcmin
+    magRange = np.array([17.5, 21.5])*u.mag
+    objects = AMxObjectArrays.fromGroupView(matches).inMagRange(magRange)
+    groups = [group for group in matches.groups
+              if magRange[0].value <= np.median(group.get('base_PsfFlux_mag')) < magRange[1].value]
+    assert len(groups) == len(objects)
+
+    annulusRadians = arcminToRadians(annulus.value)
+    exp_obj1, exp_obj2 = [], []
+    for obj1 in range(len(objects)):
+        dist = sphDist(objects.meanRa[obj1], objects.meanDec[obj1],
+                       objects.meanRa[obj1+1:], objects.meanDec[obj1+1:])
+        for obj2 in obj1 + 1 + np.flatnonzero((annulusRadians[0] <= dist) &
+                                              (dist < annulusRadians[1])):
+            # Pairs without a shared visit have no RMS distance
+            if np.intersect1d(groups[obj1].get('visit'), groups[obj2].get('visit')).size:
+                exp_obj1.append(obj1)
+                exp_obj2.append(obj2)
+
+    _, obs_obj1, obs_obj2 = calcRmsDistancesByFirstObject(objects, [annulus], magRange,
+                                                          chunkSize=70,
+                                                          withSecondObjects=True)
+    assert len(exp_obj1) > 0
+    assert_array_equal(exp_obj1, obs_obj1[0])
+    assert_array_equal(exp_obj2, obs_obj2[0])
+
+
+def test_calcRmsDistancesByFirstObject():
+    matches = makeMatches()
+    annuli = [np.array([4., 6.])*u.arcmin, np.array([19., 21.])*u.arcmin]
+    magRange = np.array([17.5, 21.5])*u.mag
+    full = calcRmsDistancesMultiAnnulus(matches, annuli, magRange)
+    rmsDistances, firstObjects = calcRmsDistancesByFirstObject(matches, annuli, magRange)
+    chunks = list(iterRmsDistanceChunks(matches, annuli, magRange, withPairs=True))
+    for i in range(len(annuli)):
+        assert_array_equal(rmsDistances[i].value, full[i].value)
+        assert_array_equal(firstObjects[i],
+                           np.concatenate([pairs[i][0] for _, pairs in chunks]))
+
+
+def test_calcRmsDistanceSketches():
+    matches = makeMatches()
+    annuli = [np.array([4., 6.])*u.arcmin, np.array([5., 25.])*u.arcmin]
+    magRange = np.array([17.5, 21.5])*u.mag
+    exact = calcRmsDistancesMultiAnnulus(matches, annuli, magRange)
+    maxStoredPairs = (len(exact[0]) + len(exact[1]))//2
+    assert len(exact[0]) <= maxStoredPairs < len(exact[1])
+
+    sketches, rmsDistances = calcRmsDistanceSketches(matches, annuli, magRange,
+                                                     maxStoredPairs=maxStoredPairs,
+                                                     chunkSize=50)
+    # Only the annulus with few enough pairs keeps its RMS distances
+    assert_array_equal(rmsDistances[0].value, exact[0].to(u.marcsec).value)
+    assert rmsDistances[1] is None
+    for sketch, rms in zip(sketches, exact):
+        rms = rms.to(u.marcsec).value
+        assert sketch.count == len(rms)
+        assert_allclose(sketch.percentile(50.), np.median(rms), rtol=sketch.relativeError)
+
+
+def test_sampleRmsDistances():
+    matches = makeMatches(N=600)
+    annulus = np.array([19., 21.])*u.arcmin
+    magRange = np.array([17.5, 21.5])*u.mag
+    full = calcRmsDistances(matches, annulus, magRange).to(u.marcsec).value
+
+    # Sampling more pairs than there are evaluates all of them
+    sample = sampleRmsDistances(matches, annulus, magRange, maxPairs=10*len(full),
+                                seed=1)
+    assert sample.samplingFraction == 1
+    assert_allclose(np.sort(sample.rmsDistances.value), np.sort(full))
+
+    sample = sampleRmsDistances(matches, annulus, magRange, maxPairs=len(full)//4,
+                                seed=1)
+    rms = sample.rmsDistances.to(u.marcsec).value
+    assert 0 < len(rms) <= len(full)//4
+    assert sample.samplingFraction < 1
+    assert np.all(np.isin(rms, full))
+    lower, upper = sample.interval.to(u.marcsec).value
+    assert lower <= np.median(rms) <= upper
+    assert_allclose(np.median(sample.bootstrap.values), np.median(rms))
+    assert lower <= np.median(full) <= upper
+
+    # All the pairs of the first object are kept, even beyond maxPairs
+    tiny = sampleRmsDistances(matches, annulus, magRange, maxPairs=1, seed=1)
+    firstObjects = np.unique(tiny.firstObject)
+    assert len(tiny.rmsDistances) > 1
+    assert len(firstObjects) == 1
+    assert np.all(np.isfinite(tiny.interval.value))
+    assert 0 < tiny.samplingFraction < 1
+
+    # A loose tolerance stops the sampling early
+    early = sampleRmsDistances(matches, annulus, magRange, maxPairs=len(full),
+                               tolerance=1e3*u.marcsec, seed=1)
+    assert len(early.rmsDistances) < len(full)
+
+
+def test_AMxProfile():
+    class Dataset(object):
+        safeMatches = makeMatches(N=600)
+
+    binEdges = np.array([1., 4., 6., 19., 21., 40.])*u.arcmin
+    magRange = np.array([17.5, 21.5])*u.mag
+    profile = AMxProfile(Dataset(), binEdges=binEdges, magRange=magRange,
+                         percentiles=[10., 90.])
+    for i in range(len(binEdges) - 1):
+        exp = calcRmsDistances(Dataset.safeMatches, binEdges[i:i + 2],
+                               magRange).to(u.marcsec).value
+        assert profile.nPairs[i] == len(exp)
+        # Percentiles are resolved to the width of the histogram bins
+        assert_allclose(profile.medianRms[i].to(u.marcsec).value, np.median(exp),
+                        rtol=3e-3)
+        assert_allclose(profile.percentileRms[i].to(u.marcsec).value,
+                        np.percentile(exp, [10., 90.]), rtol=3e-3)
+
+
+def test_AMxCcdMap():
+    class Dataset(object):
+        safeMatches = makeMatches(N=600)
+        ccdKey = 'ccd'
+
+    annulus = np.array([4., 6.])*u.arcmin
+    magRange = np.array([17.5, 21.5])*u.mag
+    ccdMap = AMxCcdMap(Dataset(), annulus=annulus, magRange=magRange)
+
+    objectArrays = AMxObjectArrays.fromGroupView(Dataset.safeMatches, ccdKey='ccd')
+    objects = objectArrays.inMagRange(magRange)
+    chunks = list(iterRmsDistanceChunks(objectArrays, [annulus], magRange, withPairs=True))
+    rms = np.concatenate([c[0][0] for c in chunks])
+    obj1 = np.concatenate([c[1][0][0] for c in chunks])
+    obj2 = np.concatenate([c[1][0][1] for c in chunks])
+    # The pairs are those of the RMS distances
+    assert_array_equal(rms, calcPairRmsDistances(objects.visitVectors, obj1, obj2))
+    assert_allclose(rms, calcRmsDistances(Dataset.safeMatches, annulus, magRange).to(u.rad).value)
+
+    rmsMas = np.rad2deg(rms)*3600*1000
+    ccds = ccdMap.ccds.value
+    assert len(ccds) == 9
+    nPairs, medianRms = ccdMap.nPairs.value, ccdMap.medianRms.to(u.marcsec).value
+    assert np.triu(nPairs).sum() == len(rms)
+    assert_array_equal(nPairs, nPairs.T)
+    ccd1, ccd2 = objects.ccds[obj1], objects.ccds[obj2]
+    for i, c1 in enumerate(ccds):
+        onCcd = (ccd1 == c1) | (ccd2 == c1)
+        assert ccdMap.ccdNPairs[i] == onCcd.sum()
+        if onCcd.any():
+            assert_allclose(ccdMap.ccdMedianRms[i].to(u.marcsec).value,
+                            np.median(rmsMas[onCcd]))
+        for j, c2 in enumerate(ccds):
+            inCell = ((ccd1 == c1) & (ccd2 == c2)) | ((ccd1 == c2) & (ccd2 == c1))
+            assert nPairs[i, j] == inCell.sum()
+            if inCell.any():
+                assert_allclose(medianRms[i, j], np.median(rmsMas[inCell]))
+            else:
+                assert np.isnan(medianRms[i, j])
+
+
+def test_makeAMxMeasurementsCcdMap():
+    class Dataset(object):
+        safeMatches = makeMatches(N=600)
+        ccdKey = 'ccd'
+
+    metrics = [pipeBase.Struct(D=Datum(5*u.arcmin)), pipeBase.Struct(D=Datum(20*u.arcmin))]
+    magRange = np.array([17.5, 21.5])*u.mag
+    standalone = AMxCcdMap(Dataset(), annulus=[4., 6.], magRange=magRange)
+
+    # Count the passes over pairs
+    passes = []
+
+    def countingIter(*args, **kwargs):
+        passes.append(args[1])
+        return iterRmsDistanceChunks(*args, **kwargs)
+
+    amx.iterRmsDistanceChunks = countingIter
+    amxccdmap.iterRmsDistanceChunks = countingIter
+    try:
+        for ccdMapAnnulus in ([4., 6.], [10., 12.]):
+            del passes[:]
+            amxs = makeAMxMeasurements(metrics, Dataset(), 'r', magRange=magRange,
+                                       ccdMapAnnulus=ccdMapAnnulus)
+            assert len(passes) == 1
+            assert len(passes[0]) == 2 if ccdMapAnnulus == [4., 6.] else 3
+            ccdMap = amxs[0].amxCcdMap
+            assert amxs[1].amxCcdMap is ccdMap
+            for amxMeas, metric in zip(amxs, metrics):
+                exp = calcRmsDistances(Dataset.safeMatches, amxMeas.annulus, magRange)
+                assert_array_equal(amxMeas.rmsDistMas.value, exp.value)
+        del passes[:]
+        amxs = makeAMxMeasurements(metrics, Dataset(), 'r', magRange=magRange,
+                                   ccdMapAnnulus=[4., 6.], nBootstrap=10, seed=1)
+        assert len(passes) == 1
+        assert amxs[0].bootstrap is not None
+    finally:
+        amx.iterRmsDistanceChunks = iterRmsDistanceChunks
+        amxccdmap.iterRmsDistanceChunks = iterRmsDistanceChunks
+
+    # The map from the shared pass is the map computed on its own
+    ccdMap = amxs[0].amxCcdMap
+    assert_array_equal(ccdMap.nPairs.value, standalone.nPairs.value)
+    assert_array_equal(ccdMap.medianRms.value, standalone.medianRms.value)
+    assert_array_equal(ccdMap.ccdMedianRms.value, standalone.ccdMedianRms.value)
+
+
+def test_AMxPairStore():
+    matches = makeMatches()
+    objectArrays = AMxObjectArrays.fromGroupView(matches)
+    directory = tempfile.mkdtemp()
+    try:
+        inMemory = AMxPairStore.build(objectArrays, 21*u.arcmin)
+        onDisk = AMxPairStore.loadOrBuild(directory, objectArrays, 21*u.arcmin)
+        reopened = AMxPairStore.loadOrBuild(directory, matches, 10*u.arcmin)
+        assert isinstance(reopened.pairs, np.memmap)
+        for annulus in (np.array([4., 6.])*u.arcmin, np.array([19., 21.])*u.arcmin):
+            for magRange in (np.array([17.5, 21.5])*u.mag, np.array([18., 20.])*u.mag):
+                exp = calcRmsDistances(matches, annulus, magRange)
+                assert len(exp) > 0
+                for store in (inMemory, onDisk, reopened):
+                    assert_array_equal(exp.value, calcRmsDistances(store, annulus,
+                                                                   magRange).value)
+
+        # Objects with the same magnitudes but other positions or visits
+        # are not mistaken for those of the store
+        columns = matches.columns
+        moved = GroupedArrays(matches.offsets,
+                              dict(columns, coord_dec=columns['coord_dec'] + 1e-7))
+        revisited = GroupedArrays(matches.offsets,
+                                  dict(columns, visit=columns['visit'] + 100))
+        annulus = np.array([4., 6.])*u.arcmin
+        magRange = np.array([17.5, 21.5])*u.mag
+        for other in (moved, revisited):
+            otherArrays = AMxObjectArrays.fromGroupView(other)
+            assert_array_equal(otherArrays.medianMag, objectArrays.medianMag)
+            assert otherArrays.digest() != onDisk.digest
+            rebuilt = AMxPairStore.loadOrBuild(directory, otherArrays, 21*u.arcmin)
+            assert rebuilt.digest == otherArrays.digest()
+            assert_array_equal(calcRmsDistances(other, annulus, magRange).value,
+                               calcRmsDistances(rebuilt, annulus, magRange).value)
+            del rebuilt
+
+        # A selection has the digest of the same objects extracted directly
+        everything = objectArrays.inMagRange(np.array([0., 100.])*u.mag)
+        assert everything.digest() == objectArrays.digest()
+        del onDisk, reopened
+    finally:
+        shutil.rmtree(directory)
+
+    # Results are memoized by annulus and magnitude range
+    annulus = np.array([4., 6.])*u.arcmin
+    magRange = np.array([17.5, 21.5])*u.mag
+    first = calcRmsDistances(objectArrays, annulus, magRange)
+    assert calcRmsDistances(objectArrays, annulus, magRange) is first
+
+
 if __name__ == "__main__":
     lsst.utils.tests.init()
     unittest.main()
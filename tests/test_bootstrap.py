@@ -0,0 +1,103 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+from lsst.validate.drp.bootstrap import ClusterBootstrap, bootstrapCounts, percentileInterval
+from lsst.validate.drp.util import weightedPercentile
+
+
+def makeClusters(nClusters=40, n=300, nSamples=3, seed=97):
+    rng = np.random.RandomState(seed)
+    return (rng.randn(nSamples, n), rng.randint(0, nClusters, n),
+            rng.uniform(0.1, 1, n))
+
+
+def test_bootstrapCounts():
+    counts = bootstrapCounts(40, 25, seed=3)
+    assert counts.shape == (25, 40)
+    assert_array_equal(counts.sum(axis=1), 40)
+    assert_array_equal(counts, bootstrapCounts(40, 25, seed=3))
+    assert bootstrapCounts(0, 5, seed=3).shape == (5, 0)
+
+
+def test_percentile():
+    values, clusters, weights = makeClusters()
+    counts = bootstrapCounts(40, 20, seed=5)
+    percentiles = [0., 10., 50., 93.3, 100.]
+    unweighted = ClusterBootstrap(values, clusters, counts).percentile(percentiles)
+    weighted = ClusterBootstrap(values, clusters, counts, weights).percentile(percentiles)
+    assert unweighted.shape == weighted.shape == (20, 3, 5)
+    for replicate in range(20):
+        # The resampled values, explicitly
+        drawn = np.repeat(np.arange(values.shape[1]), counts[replicate][clusters])
+        multiplicity = counts[replicate][clusters]*weights
+        for row in range(3):
+            assert_allclose(unweighted[replicate, row],
+                            np.percentile(values[row, drawn], percentiles))
+            assert_allclose(weighted[replicate, row],
+                            weightedPercentile(values[row][multiplicity > 0],
+                                               multiplicity[multiplicity > 0],
+                                               percentiles))
+
+
+def test_fractionAbove():
+    values, clusters, weights = makeClusters()
+    counts = bootstrapCounts(40, 20, seed=5)
+    unweighted = ClusterBootstrap(values, clusters, counts).fractionAbove(0.3)
+    weighted = ClusterBootstrap(values, clusters, counts, weights).fractionAbove(0.3)
+    assert unweighted.shape == weighted.shape == (20, 3)
+    for replicate in range(20):
+        multiplicity = counts[replicate][clusters]
+        assert_allclose(unweighted[replicate],
+                        np.sum(multiplicity*(values > 0.3), axis=1)/np.sum(multiplicity))
+        multiplicity = multiplicity*weights
+        assert_allclose(weighted[replicate],
+                        np.sum(multiplicity*(values > 0.3), axis=1)/np.sum(multiplicity))
+
+
+def test_fromLabels():
+    values, clusters, _ = makeClusters(nSamples=1)
+    labels = 1000 + 7*clusters
+    bootstrap = ClusterBootstrap.fromLabels(values[0], labels, nBootstrap=30, seed=2)
+    assert bootstrap.nBootstrap == 30
+    assert bootstrap.counts.shape == (30, len(np.unique(labels)))
+    median = bootstrap.percentile(50.)
+    assert median.shape == (30, 1)
+    lower, upper = percentileInterval(median[:, 0])
+    assert lower <= np.median(values) <= upper
+
+    empty = ClusterBootstrap.fromLabels(np.zeros(0), np.zeros(0, dtype=int), nBootstrap=30)
+    assert np.all(np.isnan(percentileInterval(empty.percentile(50.)[:, 0])))
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
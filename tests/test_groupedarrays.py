@@ -0,0 +1,186 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.util import weightedPercentile
+
+
+def makeGroupedArrays(nGroups=200, dtype=np.float64, seed=1234):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, 12, size=nGroups)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    mag = 20 + 3*rng.rand(offsets[-1]) + 0.02*rng.randn(offsets[-1])
+    visit = rng.randint(0, 100, size=offsets[-1])
+    columns = {'mag': mag.astype(dtype), 'visit': visit}
+    return GroupedArrays(offsets, columns)
+
+
+def test_reductions():
+    grouped = makeGroupedArrays()
+    mag = grouped.get('mag')
+    for function in (np.sum, np.mean, np.std, np.median, np.max, np.min):
+        exp = [function(mag[start:stop])
+               for start, stop in zip(grouped.offsets[:-1], grouped.offsets[1:])]
+        obs = grouped.aggregate(function, field='mag')
+        assert_allclose(exp, obs, rtol=1e-12)
+
+
+def test_float32_reductions():
+    """Reductions over float32 magnitudes agree with float64 to well below
+    a millimagnitude.
+    """
+    grouped64 = makeGroupedArrays()
+    grouped32 = makeGroupedArrays(dtype=np.float32)
+    for function in (np.mean, np.std, np.median):
+        assert_allclose(grouped64.aggregate(function, field='mag'),
+                        grouped32.aggregate(function, field='mag'),
+                        atol=1e-5)
+
+
+def test_median_nan():
+    grouped = GroupedArrays([0, 2, 5], {'mag': np.array([1., np.nan, 3., 1., 2.])})
+    obs = grouped.aggregate(np.median, field='mag')
+    assert np.isnan(obs[0])
+    assert_allclose(obs[1], 2.)
+
+
+def test_percentile_and_mode():
+    grouped = makeGroupedArrays()
+    # Include empty groups
+    grouped = GroupedArrays(np.concatenate([[0], grouped.offsets]),
+                            dict(grouped.columns,
+                                 weight=np.random.RandomState(5).uniform(0, 2, grouped.nSources)))
+    slices = [slice(start, stop)
+              for start, stop in zip(grouped.offsets[:-1], grouped.offsets[1:])]
+    mag, weight, visit = grouped.get('mag'), grouped.get('weight'), grouped.get('visit')
+    for percentile in (0., 25., 50., 90., 100.):
+        obs = grouped.groupPercentile('mag', percentile)
+        weighted = grouped.groupPercentile('mag', percentile, weightField='weight')
+        assert np.isnan(obs[0]) and np.isnan(weighted[0])
+        assert_allclose(obs[1:], [np.percentile(mag[s], percentile) for s in slices[1:]],
+                        rtol=1e-12)
+        assert_allclose(weighted[1:], [weightedPercentile(mag[s], weight[s], percentile)
+                                       for s in slices[1:]], rtol=1e-12)
+
+    mode = grouped.groupMode('visit')
+    assert np.isnan(mode[0])
+    for s, obs in zip(slices[1:], mode[1:]):
+        values, counts = np.unique(visit[s], return_counts=True)
+        assert obs == values[np.argmax(counts)]
+
+
+def test_subset_and_where():
+    grouped = makeGroupedArrays()
+    selection = grouped.counts > 5
+    subset = grouped.subset(selection)
+    where = grouped.where(lambda group: len(group) > 5)
+
+    assert len(subset) == np.sum(selection)
+    assert_array_equal(subset.ids, grouped.ids[selection])
+    assert_array_equal(subset.get('mag'), where.get('mag'))
+    for index, group in zip(np.flatnonzero(selection), subset.groups):
+        assert_array_equal(group.get('visit'), grouped.groups[index].get('visit'))
+
+
+def makeOutliers(nGroups=300, seed=4321):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, 15, size=nGroups)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    n = offsets[-1]
+    index = np.repeat(np.arange(nGroups), counts)
+    magErr = rng.uniform(0.005, 0.02, n)
+    mag = rng.uniform(17, 21, nGroups)[index] + magErr*rng.randn(n)
+    outlier = rng.rand(n) < 0.05
+    mag[outlier] += rng.choice([-0.3, 0.3], size=outlier.sum())
+    # Variable objects
+    mag += np.where(rng.rand(nGroups) < 0.1, 0.05, 0.)[index]*rng.randn(n)
+    mag[3] = np.nan
+    return GroupedArrays(offsets, {'mag': mag, 'magErr': magErr})
+
+
+def sigmaClip(mag, magErr=None, nSigma=3., maxIter=5):
+    kept = np.isfinite(mag)
+    for _ in range(maxIter):
+        if not kept.any():
+            break
+        residuals = np.abs(mag - np.median(mag[kept]))
+        tolerance = nSigma*(magErr if magErr is not None else np.std(mag[kept]))
+        clipped = kept & (residuals <= tolerance)
+        if np.array_equal(clipped, kept):
+            break
+        kept = clipped
+    return kept
+
+
+def test_sigmaClip():
+    grouped = makeOutliers()
+    mag, magErr = grouped.get('mag'), grouped.get('magErr')
+    bounds = list(zip(grouped.offsets[:-1], grouped.offsets[1:]))
+    kept = grouped.groupSigmaClip('mag', nSigma=2.5)
+    assert_array_equal(kept, np.concatenate([sigmaClip(mag[a:b], nSigma=2.5)
+                                             for a, b in bounds]))
+    assert not kept[3]
+    kept = grouped.groupSigmaClip('mag', errField='magErr')
+    assert_array_equal(kept, np.concatenate([sigmaClip(mag[a:b], magErr[a:b])
+                                             for a, b in bounds]))
+    assert_array_equal(grouped.groupSigmaClip('mag', mask=np.zeros(len(mag), dtype=bool)),
+                       False)
+
+
+def test_reducedChi2():
+    grouped = makeOutliers()
+    mag, magErr = grouped.get('mag'), grouped.get('magErr')
+    kept = grouped.groupSigmaClip('mag')
+    chi2 = grouped.groupReducedChi2('mag', 'magErr', mask=kept)
+    for i, (a, b) in enumerate(zip(grouped.offsets[:-1], grouped.offsets[1:])):
+        m, w = mag[a:b][kept[a:b]], magErr[a:b][kept[a:b]]**-2
+        if len(m) < 2:
+            assert np.isnan(chi2[i])
+        else:
+            mean = np.sum(w*m)/np.sum(w)
+            assert_allclose(chi2[i], np.sum(w*(m - mean)**2)/(len(m) - 1), rtol=1e-9)
+
+
+def test_selectSources():
+    grouped = makeOutliers()
+    kept = grouped.groupSigmaClip('mag')
+    selected = grouped.selectSources(kept)
+    assert len(selected) == len(grouped)
+    assert_array_equal(selected.ids, grouped.ids)
+    assert_array_equal(selected.counts, np.bincount(grouped.groupIndex[kept],
+                                                    minlength=len(grouped)))
+    assert_array_equal(selected.groupIndex, grouped.groupIndex[kept])
+    assert_array_equal(selected.get('magErr'), grouped.get('magErr')[kept])
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -99,6 +99,26 @@ class ParseJsonJob(unittest.TestCase):
         expectedCheckAstrometryFile = '%s_%s' % (outputPrefix, 'check_astrometry.png')
         assert os.path.exists(expectedCheckAstrometryFile)
 
+    def testPlotMetricsFromJsonJobSubset(self):
+        """Are the plots of the metrics that were not measured skipped?"""
+        job = SubsetJob(load_json_output(self.jsonFile), ['AM2', 'PA1'])
+        plot_metrics(job, self.jsonFile_filter, outputPrefix='subset')
+        assert os.path.exists('subset_check_astrometry.png')
+        plot_metrics(SubsetJob(job, []), self.jsonFile_filter)
+
+
+class SubsetJob(object):
+    """A Job with only some of the measurements of another."""
+
+    def __init__(self, job, metricNames):
+        self.job = job
+        self.metricNames = metricNames
+
+    def get_measurement(self, metric, **kwargs):
+        if metric not in self.metricNames:
+            raise RuntimeError('{0} was not measured'.format(metric))
+        return self.job.get_measurement(metric, **kwargs)
+
 
 def setup_module(module):
     lsst.utils.tests.init()
@@ -0,0 +1,262 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import astropy.units as u
+
+import lsst.utils
+import lsst.pipe.base as pipeBase
+from lsst.validate.base import Datum
+from lsst.validate.drp.astromerrmodel import AstrometricErrorModel
+from lsst.validate.drp.calcsrd.amx import makeAMxMeasurements
+from lsst.validate.drp.calcsrd.pa1 import PA1Measurement
+from lsst.validate.drp.calcsrd.pa2 import PA2Measurement
+from lsst.validate.drp.calcsrd.pf1 import PF1Measurement
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.matchreduce import MatchedMultiVisitDataset
+from lsst.validate.drp.photerrmodel import PhotometricErrorModel
+from lsst.validate.drp.snrsweep import SnrThresholdSweep
+from lsst.validate.drp.util import quantityValues
+
+
+def makeMatchedSources(nObjects=800, nVisits=8, seed=3579):
+    """Sources matched across visits, with the fields read by
+    `MatchedMultiVisitDataset`, stored in float64.
+
+    Stars follow the photometric error model with sigmaSys = 5 mmag,
+    gamma = 0.039 and m5 = 24.5 and an astrometric error of 700 mas / SNR
+    with a 10 mas floor, over a 4x4 degree field. A tenth of the objects
+    are extended, the brightest are saturated and 1% of the sources are hit
+    by cosmic rays.
+    """
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, nVisits + 1, nObjects)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    index = np.repeat(np.arange(nObjects), counts)
+    nSources = offsets[-1]
+
+    trueMag = rng.uniform(16.5, 24., nObjects)[index]
+    x = 10**(0.4*(trueMag - 24.5))
+    magErr = np.sqrt(0.005**2 + (0.04 - 0.039)*x + 0.039*x**2)
+    snr = 2.5/np.log(10)/magErr
+    posErr = np.deg2rad(np.hypot(700./snr, 10.)/3.6e6)
+    ra = 10 + 4*rng.uniform(-0.5, 0.5, nObjects)
+    dec = 4*rng.uniform(-0.5, 0.5, nObjects)
+
+    columns = {
+        'visit': np.concatenate([rng.choice(nVisits, n, replace=False) for n in counts]),
+        'ccd': (np.floor(ra - 8)*4 + np.floor(dec + 2))[index].astype(np.int64),
+        'coord_ra': np.deg2rad(ra)[index] + posErr*rng.randn(nSources),
+        'coord_dec': np.deg2rad(dec)[index] + posErr*rng.randn(nSources),
+        'base_PsfFlux_mag': trueMag + magErr*rng.randn(nSources),
+        'base_PsfFlux_magErr': magErr,
+        'base_PsfFlux_snr': snr,
+        'base_ClassificationExtendedness_value': (rng.rand(nObjects) < 0.1)[index].astype(float),
+        'base_PixelFlags_flag_saturated': trueMag < 16.8,
+        'base_PixelFlags_flag_cr': rng.rand(nSources) < 0.01,
+        'base_PixelFlags_flag_bad': np.zeros(nSources, dtype=bool),
+        'base_PixelFlags_flag_edge': np.zeros(nSources, dtype=bool),
+    }
+    return GroupedArrays(offsets, columns)
+
+
+class Spec(object):
+    """Stand-in for a metric with the same specification at every level and
+    in every filter, and the specifications of other metrics as attributes.
+    """
+
+    def __init__(self, quantity=None, **linkedSpecs):
+        self.datum = Datum(quantity)
+        for name, spec in linkedSpecs.items():
+            setattr(self, name, spec)
+
+    def get_spec(self, spec_name, filter_name=None):
+        return self
+
+
+def test_compactMatchesFullPrecision():
+    # Tolerances of the class Notes of MatchedMultiVisitDataset
+    matches = makeMatchedSources()
+    dataIds = [{'visit': 0, 'ccd': 0, 'filter': 'r'}]
+    full = MatchedMultiVisitDataset(matches, dataIds, compact=False)
+    compact = MatchedMultiVisitDataset(matches, dataIds, compact=True)
+    assert compact.goodMatches.get('base_PsfFlux_mag').dtype == np.float32
+    assert full.goodMatches.get('base_PsfFlux_mag').dtype == np.float64
+    assert_array_equal(full.goodMatches.ids, compact.goodMatches.ids)
+    assert 0 < len(full.goodMatches) < len(matches)
+
+    for name in ('mag', 'magrms', 'magerr'):
+        assert_allclose(getattr(compact, name).to(u.mmag).value,
+                        getattr(full, name).to(u.mmag).value, rtol=0, atol=0.01)
+    assert_allclose(compact.snr.value, full.snr.value, rtol=1e-7)
+    assert_array_equal(compact.dist.value, full.dist.value)
+
+    # PA1, PA2 and PF1: < 0.01 mmag per pair difference
+    assert_array_equal(full.safeMatches.ids, compact.safeMatches.ids)
+    pa1s = [PA1Measurement(None, dataset, 'r', numRandomShuffles=10, seed=5)
+            for dataset in (full, compact)]
+    magDiffs = [pa1.shuffleSamples()[0] for pa1 in pa1s]
+    assert_allclose(magDiffs[1], magDiffs[0], rtol=0, atol=0.01)
+    assert abs(pa1s[1].quantity - pa1s[0].quantity) < 0.01*u.mmag
+    assert_allclose(pa1s[1].iqr.value, pa1s[0].iqr.value, rtol=0, atol=0.01)
+
+    pa2Metric = Spec(PF1=Spec(10*u.Unit('')))
+    pa2s = [PA2Measurement(pa2Metric, dataset, pa1, 'r', 'design')
+            for dataset, pa1 in zip((full, compact), pa1s)]
+    assert abs(pa2s[1].quantity - pa2s[0].quantity) < 0.01*u.mmag
+
+    pa2Spec = 15*u.mmag
+    pf1s = [PF1Measurement(Spec(PA2=Spec(pa2Spec)), dataset, pa1, 'r', 'design')
+            for dataset, pa1 in zip((full, compact), pa1s)]
+    # Only differences within 0.01 mmag of the PA2 specification can move
+    # across it
+    nNear = np.sum(np.abs(np.abs(magDiffs[0][0]) - pa2Spec.value) < 0.01)
+    assert abs(pf1s[1].quantity.value - pf1s[0].quantity.value) <= \
+        100.*nNear/magDiffs[0].shape[1]
+
+    # AM1, AM2 and AM3: identical
+    metrics = [pipeBase.Struct(D=Datum(D*u.arcmin)) for D in (5, 20, 200)]
+    amxs = [makeAMxMeasurements(metrics, dataset, 'r') for dataset in (full, compact)]
+    for fullAmx, compactAmx in zip(*amxs):
+        assert np.isfinite(fullAmx.quantity)
+        assert compactAmx.quantity == fullAmx.quantity
+        assert_array_equal(compactAmx.rmsDistMas.value, fullAmx.rmsDistMas.value)
+
+    # Error models: fitted parameters to relative 1e-5, photometric scatter
+    # to 0.01 mmag, astrometric scatter identical
+    photomModels = [PhotometricErrorModel(dataset) for dataset in (full, compact)]
+    astromModels = [AstrometricErrorModel(dataset) for dataset in (full, compact)]
+    for fullModel, compactModel, names in ((photomModels[0], photomModels[1],
+                                            ('sigmaSys', 'gamma', 'm5')),
+                                           (astromModels[0], astromModels[1],
+                                            ('sigmaSys', 'theta'))):
+        for name in names:
+            fullValue = getattr(fullModel, name)
+            assert np.isfinite(fullValue)
+            assert_allclose(quantityValues(getattr(compactModel, name), fullValue.unit),
+                            fullValue.value, rtol=1e-5)
+    assert abs(photomModels[1].photScatter - photomModels[0].photScatter) < 0.01*u.mmag
+    assert astromModels[1].astromRms == astromModels[0].astromRms
+
+
+def test_snrSweepRejectsOutliers():
+    matches = makeMatchedSources()
+    rng = np.random.RandomState(24)
+    mag = matches.get('base_PsfFlux_mag')
+    mag[rng.rand(len(mag)) < 0.02] += 0.5
+    variable = (rng.rand(len(matches)) < 0.05)[matches.groupIndex]
+    mag[variable] += 0.2*rng.randn(np.sum(variable))
+    dataIds = [{'visit': 0, 'ccd': 0, 'filter': 'r'}]
+
+    sweeps = []
+    for kwargs in ({}, {'clipSigma': 3., 'maxChi2': 5.}):
+        dataset = MatchedMultiVisitDataset(matches, dataIds, compact=True, **kwargs)
+        sweep = SnrThresholdSweep(dataset, safeSnrs=[20., dataset.safeSnr, 100.],
+                                  numRandomShuffles=50, seed=5)
+        # The sweep selects the safe matches of the dataset at its safeSnr
+        assert sweep.nSafe[1] == len(dataset.safeMatches)
+        assert np.all(np.diff(sweep.nSafe) < 0)
+
+        pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=50, seed=5)
+        assert abs(sweep.PA1[1] - pa1.quantity) < np.std(pa1.iqr)
+        sweeps.append(sweep)
+
+    assert np.all(sweeps[1].nSafe < sweeps[0].nSafe)
+    assert np.all(sweeps[1].PA1 < sweeps[0].PA1)
+
+
+def test_pa2FromLoadedPA1():
+    dataIds = [{'visit': 0, 'ccd': 0, 'filter': 'r'}]
+    dataset = MatchedMultiVisitDataset(makeMatchedSources(), dataIds)
+    metric = Spec(PF1=Spec(10*u.Unit('')))
+    for exact in (False, True):
+        pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=10, seed=5,
+                             exact=exact, storedShuffles=3, nBootstrap=20)
+        pa2 = PA2Measurement(metric, dataset, pa1, 'r', 'design')
+        pa2s = PA2Measurement(metric, dataset, pa1, 'r', 'design', allShuffles=True)
+        assert 'interval' in pa2.extras
+
+        # As when loaded from JSON: only the stored samples are left, as
+        # float32
+        del pa1.shuffleMagDiffs
+        loaded = PA2Measurement(metric, dataset, pa1, 'r', 'design')
+        assert_allclose(loaded.quantity.value, pa2.quantity.value, rtol=1e-6)
+        assert 'interval' not in loaded.extras
+        loaded = PA2Measurement(metric, dataset, pa1, 'r', 'design', allShuffles=True)
+        assert_allclose(loaded.shuffleValues.value,
+                        pa2s.shuffleValues[:len(pa1.magDiff)].value, rtol=1e-6)
+
+    pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=2, storedShuffles=0)
+    del pa1.shuffleMagDiffs
+    try:
+        PA2Measurement(metric, dataset, pa1, 'r', 'design')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Measured PA2 without magnitude differences')
+
+
+def test_pf1FromLoadedPA1():
+    dataIds = [{'visit': 0, 'ccd': 0, 'filter': 'r'}]
+    dataset = MatchedMultiVisitDataset(makeMatchedSources(), dataIds)
+    metric = Spec(PA2=Spec(15*u.mmag))
+    for exact in (False, True):
+        pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=10, seed=5,
+                             exact=exact, storedShuffles=3, nBootstrap=20)
+        pf1 = PF1Measurement(metric, dataset, pa1, 'r', 'design')
+        pf1s = PF1Measurement(metric, dataset, pa1, 'r', 'design', allShuffles=True)
+        assert 'interval' in pf1.extras
+
+        # As when loaded from JSON: only the stored samples are left, as
+        # float32
+        del pa1.shuffleMagDiffs
+        loaded = PF1Measurement(metric, dataset, pa1, 'r', 'design')
+        assert_allclose(loaded.quantity.value, pf1.quantity.value, rtol=1e-6)
+        assert 'interval' not in loaded.extras
+        loaded = PF1Measurement(metric, dataset, pa1, 'r', 'design', allShuffles=True)
+        assert_allclose(loaded.shuffleValues.value,
+                        pf1s.shuffleValues[:len(pa1.magDiff)].value, rtol=1e-6)
+
+    pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=2, storedShuffles=0)
+    del pa1.shuffleMagDiffs
+    try:
+        PF1Measurement(metric, dataset, pa1, 'r', 'design')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Measured PF1 without magnitude differences')
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,98 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+from lsst.validate.drp.objectstats import ObjectStatistics
+from lsst.validate.drp.util import sphDist
+
+
+def makeSources(nObjects=300, seed=4321):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, 8, size=nObjects)
+    objectIds = np.repeat(rng.permutation(nObjects) * 3 + 11, counts)
+    n = len(objectIds)
+    index = np.unique(objectIds, return_inverse=True)[1]
+    ra0, dec0 = rng.uniform(0, 2*np.pi, nObjects), rng.uniform(-1.5, 1.5, nObjects)
+    return dict(objectIds=objectIds,
+                ra=ra0[index] + 5e-8*rng.randn(n),
+                dec=dec0[index] + 5e-8*rng.randn(n),
+                mag=(18 + 5*rng.rand(nObjects))[index] + 0.01*rng.randn(n),
+                magErr=rng.uniform(0.005, 0.05, n),
+                snr=rng.uniform(1, 500, n),
+                flagged=rng.rand(n) < 0.02,
+                extendedness=(rng.rand(n) < 0.1).astype(float))
+
+
+def shard(sources, nShards, seed=1):
+    part = np.random.RandomState(seed).randint(0, nShards, len(sources['ra']))
+    return [ObjectStatistics.fromSources(**{name: values[part == k]
+                                            for name, values in sources.items()})
+            for k in range(nShards)]
+
+
+def test_statistics():
+    sources = makeSources()
+    stats = ObjectStatistics.fromSources(**sources)
+    index = np.searchsorted(stats.ids, sources['objectIds'])
+    for i in range(len(stats)):
+        inObject = index == i
+        mag = sources['mag'][inObject]
+        assert_allclose(stats.magMean[i], np.mean(mag), rtol=1e-14)
+        assert_allclose(stats.magRms[i], np.std(mag), rtol=1e-8, atol=1e-14)
+        assert_allclose(stats.medianSnr[i], np.median(sources['snr'][inObject]))
+        assert_allclose(stats.medianMagErr[i], np.median(sources['magErr'][inObject]))
+
+        ra, dec = stats.meanRaDec
+        separations = sphDist(ra[i], dec[i],
+                              sources['ra'][inObject], sources['dec'][inObject])
+        rmsMas = np.rad2deg(np.sqrt(np.mean(separations**2)))*3600*1000
+        assert_allclose(stats.positionRms[i], rmsMas, atol=1e-6)
+
+
+def test_merge():
+    sources = makeSources()
+    full = ObjectStatistics.fromSources(**sources)
+    a, b, c = shard(sources, 3)
+    for merged in (a.merge(b).merge(c), a.merge(b.merge(c)),
+                   c.merge(a).merge(b), ObjectStatistics.mergeAll([a, b, c])):
+        assert_array_equal(merged.ids, full.ids)
+        assert_array_equal(merged.count, full.count)
+        assert_array_equal(merged.isGood(), full.isGood())
+        assert_array_equal(merged.isSafe(), full.isSafe())
+        assert_allclose(merged.magMean, full.magMean, rtol=1e-14)
+        assert_allclose(merged.magRms, full.magRms, atol=1e-12)
+        assert_allclose(merged.medianSnr, full.medianSnr)
+        assert_allclose(merged.medianMagErr, full.medianMagErr)
+        assert_allclose(merged.positionRms, full.positionRms, atol=1e-6)
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,296 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+import lsst.pipe.base as pipeBase
+from lsst.validate.drp.bootstrap import percentileInterval
+from lsst.validate.drp.calcsrd.pa1 import (PA1Measurement, calcPa1, computeExactWidths,
+                                           computeWidths, getAllDiffsRmsInMmags, getRandomDiffRmsInMmags,
+                                           getRandomDiffsRmsInMmags)
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.pa1breakdown import PA1Breakdown
+from lsst.validate.drp.plot import plotPA1
+from lsst.validate.drp.util import weightedPercentile
+
+
+def makeMatches(N=2000, nVisits=8, seed=1357):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(2, nVisits + 1, N)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    index = np.repeat(np.arange(N), counts)
+    mag = rng.uniform(17, 21, N)[index] + 0.01*rng.randn(len(index))
+    ccd = rng.randint(0, 4, len(index))
+    return GroupedArrays(offsets, {'base_PsfFlux_mag': mag, 'ccd': ccd})
+
+
+def test_getRandomDiffsRmsInMmags():
+    # Every ordered pair of distinct visits is equally likely
+    nStars = 60000
+    mag = np.tile([0., 1., 3.], nStars)
+    matches = GroupedArrays(np.arange(nStars + 1)*3, {'mag': mag})
+    diffs = getRandomDiffsRmsInMmags(matches, 'mag', 1, seed=2468)[0]*np.sqrt(2)/1000
+    values, counts = np.unique(np.round(diffs), return_counts=True)
+    assert set(values) == {-3., -2., -1., 1., 2., 3.}
+    assert_allclose(counts/len(diffs), 1/6., atol=0.01)
+
+    # Same distribution as the per-object shuffles
+    matches = makeMatches()
+    np.random.seed(1)
+    vectorized = getRandomDiffsRmsInMmags(matches, 'base_PsfFlux_mag', 20)
+    assert vectorized.shape == (20, len(matches))
+    shuffled = np.array([matches.aggregate(getRandomDiffRmsInMmags,
+                                           field='base_PsfFlux_mag')
+                         for _ in range(20)])
+    assert_allclose(np.std(vectorized), np.std(shuffled), rtol=0.02)
+    assert_allclose(np.percentile(np.abs(vectorized), [25, 50, 75]),
+                    np.percentile(np.abs(shuffled), [25, 50, 75]), rtol=0.03)
+
+
+def test_seed():
+    matches = makeMatches()
+    first = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=6, seed=42)
+    assert first['seed'] == 42
+    # Reproducible, shuffle by shuffle, whether or not the shuffles are split
+    # between processes
+    for nWorkers in (1, 3):
+        again = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=6, seed=42,
+                        nWorkers=nWorkers)
+        assert_array_equal(again['magDiff'].value, first['magDiff'].value)
+        assert_array_equal(again['iqr'].value, first['iqr'].value)
+    more = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=8, seed=42)
+    assert_array_equal(more['magDiff'].value[:6], first['magDiff'].value)
+
+    other = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=6, seed=43)
+    assert not np.any(np.all(other['magDiff'].value == first['magDiff'].value, axis=1))
+    # Without a seed, a new one is drawn and returned
+    unseeded = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=6)
+    assert_array_equal(calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=6,
+                               seed=unseeded['seed'])['magDiff'].value,
+                       unseeded['magDiff'].value)
+
+
+def test_computeWidths():
+    samples = np.random.RandomState(11).standard_t(3, size=(7, 1001))
+    rms, iqr = computeWidths(samples)
+    for sample, sampleRms, sampleIqr in zip(samples, rms, iqr):
+        assert_allclose(sampleRms, np.sqrt(np.mean(sample**2)), rtol=1e-12)
+        q75, q25 = np.percentile(sample, [75, 25])
+        assert_allclose(sampleIqr, (q75 - q25)/1.3489795003921634, rtol=1e-12)
+        assert_allclose(computeWidths(sample), (sampleRms, sampleIqr), rtol=1e-12)
+    # Interpolation between order statistics
+    assert_allclose(computeWidths(np.array([0., 1., 2., 10.]))[1],
+                    (np.percentile([0, 1, 2, 10], 75) - 0.75)/1.3489795003921634)
+
+
+def test_getAllDiffsRmsInMmags():
+    matches = GroupedArrays([0, 3, 5], {'mag': np.array([0., 1., 3., 10., 14.])})
+    pairs = getAllDiffsRmsInMmags(matches, 'mag')
+    assert_allclose(pairs.magDiffs*np.sqrt(2)/1000, [-1., -3., -2., -4.])
+    assert_allclose(pairs.weights, [1/3., 1/3., 1/3., 1.])
+    assert_array_equal(pairs.star, [0, 0, 0, 1])
+
+
+def test_exact():
+    matches = makeMatches()
+    pairs = getAllDiffsRmsInMmags(matches, 'base_PsfFlux_mag')
+    rms, iqr = computeExactWidths(pairs.magDiffs, pairs.weights)
+    # Each star contributes the mean squared difference of its pairs
+    mags = [group.get('base_PsfFlux_mag') for group in matches.groups]
+    meanSq = [np.mean([(a - b)**2 for i, a in enumerate(m) for b in m[i + 1:]])
+              for m in mags]
+    assert_allclose(rms, 1000*np.sqrt(np.mean(meanSq)/2), rtol=1e-10)
+
+    # The limit of many random shuffles
+    pooled = getRandomDiffsRmsInMmags(matches, 'base_PsfFlux_mag', 200, seed=5).ravel()
+    assert_allclose((rms, iqr), computeWidths(pooled), rtol=0.01)
+
+    pa1 = calcPa1(matches, 'base_PsfFlux_mag', exact=True)
+    assert pa1['seed'] is None
+    assert pa1['magDiff'].shape == pa1['magDiffWeight'].shape == (1, len(pairs.magDiffs))
+    assert_allclose(pa1['PA1'].value, iqr)
+    assert_allclose(pa1['rms'][0].value, rms)
+
+
+def test_exactMeasurement():
+    matches = makeMatches()
+    dataset = pipeBase.Struct(safeMatches=matches, magKey='base_PsfFlux_mag')
+    pa1 = PA1Measurement(None, dataset, 'r', exact=True)
+    assert pa1.magDiffWeight.shape == pa1.magDiff.shape
+    assert_allclose(np.sum(pa1.magDiffWeight.value), len(matches))
+    assert PA1Measurement(None, dataset, 'r', numRandomShuffles=2).magDiffWeight is None
+
+
+def test_weightedPercentile():
+    values = np.array([3., 1., 2., 5.])
+    weights = np.array([1., 2., 1., 3.])
+    repeated = np.repeat(values, weights.astype(int))
+    for percentile in (0., 10., 50., 90., 100.):
+        assert_allclose(weightedPercentile(values, weights, percentile),
+                        weightedPercentile(repeated, np.ones(len(repeated)), percentile))
+    assert weightedPercentile(values, weights, 50.) == 3.
+    assert np.isnan(weightedPercentile(values, np.zeros(4), 50.))
+
+
+def test_calcPa1():
+    matches = makeMatches()
+    np.random.seed(3)
+    pa1 = calcPa1(matches, 'base_PsfFlux_mag', numRandomShuffles=10)
+    assert pa1['magDiff'].shape == (10, len(matches))
+    assert pa1['magMean'].shape == (10, len(matches))
+    assert_allclose(pa1['magMean'][3].value, matches.groupMean('base_PsfFlux_mag'))
+    # The magnitudes scatter by 10 mmag
+    assert_allclose(pa1['PA1'].value, 10., rtol=0.05)
+    assert_allclose(np.mean(pa1['rms']).value, 10., rtol=0.05)
+
+
+def test_storedShuffles():
+    matches = makeMatches()
+    dataset = pipeBase.Struct(safeMatches=matches, magKey='base_PsfFlux_mag')
+    full = calcPa1(matches, dataset.magKey, numRandomShuffles=10, seed=3)
+    pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=10, seed=3,
+                         storedShuffles=2)
+    assert pa1.magDiff.shape == (2, len(matches))
+    assert pa1.magMean.shape == (1, len(matches))
+    assert pa1.magDiff.dtype == pa1.magMean.dtype == np.float32
+    assert_allclose(pa1.magMean[0].value, full['magMean'][0].value, rtol=1e-7)
+    assert pa1.quantity == full['PA1']
+
+    magDiffs, weights = pa1.shuffleSamples()
+    assert weights is None
+    assert_allclose(magDiffs, full['magDiff'].value, rtol=1e-6)
+    assert_array_equal(pa1.shuffleSamples(allShuffles=False)[0], magDiffs[:1])
+
+    exact = PA1Measurement(None, dataset, 'r', exact=True, storedShuffles=0)
+    magDiffs, weights = exact.shuffleSamples()
+    assert magDiffs.shape == weights.shape == (1, len(getAllDiffsRmsInMmags(
+        matches, dataset.magKey).weights))
+    assert exact.magDiff.shape == exact.magDiffWeight.shape == (0, magDiffs.shape[1])
+
+
+def test_plotPA1WithoutStoredShuffles():
+    matches = makeMatches()
+    dataset = pipeBase.Struct(safeMatches=matches, magKey='base_PsfFlux_mag')
+    directory = tempfile.mkdtemp()
+    try:
+        for exact in (False, True):
+            pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=3, seed=3,
+                                 exact=exact, storedShuffles=0)
+            outputPrefix = os.path.join(directory, 'exact' if exact else 'shuffled')
+            plotPA1(pa1, outputPrefix=outputPrefix)
+            assert os.path.exists(outputPrefix + '_PA1.png')
+
+        # As when loaded from JSON: nothing to plot
+        del pa1.shuffleMagDiffs
+        try:
+            plotPA1(pa1, outputPrefix=os.path.join(directory, 'loaded'))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('Plotted PA1 without magnitude differences')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_bootstrap():
+    matches = makeMatches()
+    dataset = pipeBase.Struct(safeMatches=matches, magKey='base_PsfFlux_mag')
+    pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=5, seed=3,
+                         nBootstrap=20)
+    exact = PA1Measurement(None, dataset, 'r', exact=True, seed=3, nBootstrap=20)
+    assert pa1.bootstrapCounts.shape == exact.bootstrapCounts.shape == (20, len(matches))
+
+    # Against the widths of the explicitly resampled stars
+    magDiffs, _ = pa1.shuffleSamples()
+    exactDiffs, weights = exact.shuffleSamples()
+    replicates = []
+    exactReplicates = []
+    for counts in pa1.bootstrapCounts:
+        replicates.append(np.mean(computeWidths(
+            magDiffs[:, np.repeat(np.arange(len(matches)), counts)])[1]))
+        # Each pair counts as many times as its star is drawn
+        multiplicity = counts[exact.shuffleStars]*weights[0]
+        drawn = multiplicity > 0
+        exactReplicates.append(computeExactWidths(exactDiffs[0, drawn],
+                                                  multiplicity[drawn])[1])
+    assert_allclose(pa1.interval.value, percentileInterval(replicates), rtol=1e-6)
+    assert_allclose(exact.interval.value, percentileInterval(exactReplicates), rtol=1e-6)
+    assert pa1.interval[0] <= pa1.quantity <= pa1.interval[1]
+    assert exact.interval[0] <= exact.quantity <= exact.interval[1]
+
+    assert PA1Measurement(None, dataset, 'r', numRandomShuffles=2).absMagDiffBootstrap() is None
+    bootstrap = pa1.absMagDiffBootstrap(allShuffles=False)
+    assert bootstrap is pa1.absMagDiffBootstrap(allShuffles=False)
+    assert bootstrap.fractionAbove(15.).shape == (20, 1)
+
+
+def test_breakdown():
+    matches = makeMatches()
+    dataset = pipeBase.Struct(safeMatches=matches, magKey='base_PsfFlux_mag', ccdKey='ccd')
+    magMean = matches.groupMean(dataset.magKey)
+    ccds = matches.groupMode('ccd')
+    magBins = [17., 18.5, 21.]
+    for exact in (False, True):
+        pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=5, seed=7, exact=exact)
+        breakdown = PA1Breakdown(dataset, pa1, magBins=magBins)
+        magDiffs, weights = pa1.shuffleSamples()
+        stars = pa1.shuffleStars
+        for i in range(len(magBins) - 1):
+            inBin = (magBins[i] <= magMean) & (magMean < magBins[i + 1])
+            assert breakdown.magBinNStars[i] == np.sum(inBin)
+            columns = inBin[stars]
+            if exact:
+                rms, iqr = computeExactWidths(magDiffs[0, columns], weights[0, columns])
+            else:
+                rms, iqr = np.mean(computeWidths(magDiffs[:, columns]), axis=1)
+            assert_allclose(breakdown.magBinRms[i].value, rms, rtol=1e-7)
+            assert_allclose(breakdown.magBinIqr[i].value, iqr, rtol=1e-7)
+
+        for i, ccd in enumerate(breakdown.ccds.value):
+            columns = (ccds == ccd)[stars]
+            if exact:
+                iqr = computeExactWidths(magDiffs[0, columns], weights[0, columns])[1]
+            else:
+                iqr = np.mean(computeWidths(magDiffs[:, columns])[1])
+            assert_allclose(breakdown.ccdIqr[i].value, iqr, rtol=1e-7)
+        assert np.sum(breakdown.ccdNStars) == len(matches)
+
+    # Default bins cover every star
+    breakdown = PA1Breakdown(dataset, pa1, byCcd=False)
+    assert np.sum(breakdown.magBinNStars) == len(matches)
+    assert 'ccds' not in breakdown.datums
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,79 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+from lsst.validate.drp.quantilesketch import LogQuantileSketch
+
+
+def test_percentile():
+    values = np.random.RandomState(1357).lognormal(2, 1, 20000)
+    sketch = LogQuantileSketch()
+    sketch.add(values)
+    sketch.add([np.nan])
+    assert sketch.count == len(values)
+    percentiles = [0., 1., 10., 50., 90., 99., 100.]
+    assert_allclose(sketch.percentile(percentiles), np.percentile(values, percentiles),
+                    rtol=sketch.relativeError)
+    assert np.all(sketch.rankError(percentiles) < 1e-2)
+    for threshold in np.percentile(values, [5., 50., 95.]):
+        assert_allclose(sketch.fractionAbove(threshold), np.mean(values > threshold),
+                        atol=1e-3)
+
+    # Values below the grid, including 0, are reported as 0
+    small = LogQuantileSketch()
+    small.add([0., 1e-6, 1.])
+    assert_array_equal(small.percentile([0., 50.]), [0., 0.])
+    assert np.isnan(LogQuantileSketch().percentile(50.))
+
+
+def test_merge():
+    values = np.random.RandomState(2468).lognormal(0, 2, 5000)
+    full = LogQuantileSketch()
+    full.add(values)
+    parts = []
+    for chunk in np.array_split(values, 3):
+        parts.append(LogQuantileSketch())
+        parts[-1].add(chunk)
+    merged = parts[0].merge(parts[1]).merge(parts[2])
+    assert_array_equal(merged.counts, full.counts)
+    assert merged.percentile(50.) == full.percentile(50.)
+
+    try:
+        full.merge(LogQuantileSketch(logStep=1e-2))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Merged sketches with different bins')
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
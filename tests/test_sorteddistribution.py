@@ -0,0 +1,82 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose
+
+import lsst.utils
+from lsst.validate.drp.sorteddistribution import SortedDistribution
+from lsst.validate.drp.util import weightedPercentile
+
+
+def test_percentile():
+    rng = np.random.RandomState(1357)
+    percentiles = [0., 5., 50., 90., 99.9, 100.]
+    for n in (1, 2, 1000, 1001):
+        values = rng.lognormal(2, 1, n)
+        distribution = SortedDistribution(values)
+        assert distribution.count == n
+        assert_allclose(distribution.percentile(percentiles),
+                        np.percentile(values, percentiles), rtol=1e-12)
+        assert_allclose(distribution.percentile(37.), np.percentile(values, 37.), rtol=1e-12)
+        for threshold in np.percentile(values, [5., 50., 95.]):
+            assert distribution.fractionAbove(threshold) == np.mean(values > threshold)
+
+    # One row per sample
+    samples = rng.standard_normal((4, 501))
+    distribution = SortedDistribution(samples)
+    assert_allclose(distribution.percentile(percentiles),
+                    np.percentile(samples, percentiles, axis=1).T, rtol=1e-12)
+    assert_allclose(distribution.fractionAbove(0.5), np.mean(samples > 0.5, axis=1))
+
+    assert np.isnan(SortedDistribution([]).percentile(50.))
+    assert np.isnan(SortedDistribution([]).fractionAbove(1.))
+
+
+def test_weighted():
+    rng = np.random.RandomState(2468)
+    samples = rng.standard_normal((3, 300))
+    weights = rng.uniform(0, 2, samples.shape)
+    distribution = SortedDistribution(samples, weights)
+    percentiles = [1., 50., 90.]
+    for row in range(len(samples)):
+        assert_allclose(distribution.percentile(percentiles)[row],
+                        weightedPercentile(samples[row], weights[row], percentiles))
+        above = samples[row] > 0.3
+        assert_allclose(distribution.fractionAbove(0.3)[row],
+                        np.sum(weights[row][above]) / np.sum(weights[row]))
+
+    # Equal weights give the unweighted fractions
+    distribution = SortedDistribution(samples[0], np.ones(samples.shape[1]))
+    assert_allclose(distribution.fractionAbove(0.3), np.mean(samples[0] > 0.3))
+    assert np.isnan(SortedDistribution([1., 2.], [0., 0.]).percentile(50.))
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,109 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from numpy.testing import assert_allclose, assert_array_equal
+
+import astropy.units as u
+
+import lsst.utils
+import lsst.pipe.base as pipeBase
+from lsst.validate.drp.calcsrd.pa1 import PA1Measurement
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.zeropoints import ZeroPointResiduals, solveMagnitudeOffsets
+
+
+def makeMatches(nObjects=3000, nVisits=12, magErr=0.005, seed=8642):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(2, nVisits + 1, nObjects)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    index = np.repeat(np.arange(nObjects), counts)
+    visitIndex = np.concatenate([rng.choice(nVisits, n, replace=False) for n in counts])
+    zeroPoints = 0.002*rng.randn(nVisits)
+    zeroPoints[3] = 0.05
+    magErrs = rng.uniform(0.5, 1.5, len(index))*magErr
+    mag = (rng.uniform(17, 21, nObjects)[index] + zeroPoints[visitIndex] +
+           magErrs*rng.randn(len(index)))
+    columns = {'base_PsfFlux_mag': mag, 'base_PsfFlux_magErr': magErrs,
+               'visit': 100 + 2*visitIndex, 'ccd': rng.randint(0, 3, len(index))}
+    matches = GroupedArrays(offsets, columns)
+    return matches, visitIndex, zeroPoints
+
+
+def test_solveMagnitudeOffsets():
+    matches, visitIndex, zeroPoints = makeMatches()
+    objectMags = np.linspace(17, 21, len(matches))
+    # Without noise, the offsets are recovered up to a constant
+    mags = objectMags[matches.groupIndex] + zeroPoints[visitIndex]
+    solution = solveMagnitudeOffsets(matches.groupIndex, visitIndex, mags)
+    expected = zeroPoints - np.mean(zeroPoints[visitIndex])
+    assert_allclose(solution.offsets, expected, atol=1e-9)
+    assert_allclose(solution.objectMags, objectMags + np.mean(zeroPoints[visitIndex]),
+                    atol=1e-9)
+    assert_allclose(solution.residuals, 0., atol=1e-9)
+
+    # Ignored detections do not contribute
+    mags[::7] = np.nan
+    weights = np.ones(len(mags))
+    weights[1::7] = 0.
+    solution = solveMagnitudeOffsets(matches.groupIndex, visitIndex, mags, weights)
+    valid = np.isfinite(mags) & (weights > 0)
+    shift = np.mean(zeroPoints[visitIndex[valid]])
+    assert_allclose(solution.offsets, zeroPoints - shift, atol=1e-9)
+
+
+def test_zeroPointResiduals():
+    matches, visitIndex, zeroPoints = makeMatches()
+    dataset = pipeBase.Struct(goodMatches=matches, safeMatches=matches,
+                              magKey='base_PsfFlux_mag', ccdKey='ccd')
+    pa1 = PA1Measurement(None, dataset, 'r', numRandomShuffles=5, seed=7)
+    residuals = ZeroPointResiduals(dataset, pa1)
+
+    assert_array_equal(residuals.visits.value, 100 + 2*np.arange(len(zeroPoints)))
+    assert_array_equal(residuals.nDetections.value, np.bincount(visitIndex))
+    weights = matches.get('base_PsfFlux_magErr')**-2
+    expected = zeroPoints - np.average(zeroPoints[visitIndex], weights=weights)
+    assert_allclose(residuals.offsets.to(u.mag).value, expected, atol=5e-4)
+    assert residuals.largestOffsets(1)['visit'][0] == 106
+    # Detections are weighted by inverse variance, favouring the precise ones
+    rms = residuals.residualRms.to(u.mmag).value
+    assert np.all((rms > 3.) & (rms < 5.))
+
+    # Removing the offsets of the bad visit improves PA1
+    assert residuals.pa1 == pa1.quantity
+    assert residuals.pa1Corrected < 0.8*residuals.pa1
+
+    byCcd = ZeroPointResiduals(dataset, pa1, byCcd=True, weighted=False)
+    assert len(byCcd.table) == len(np.unique(visitIndex*3 + matches.get('ccd')))
+    assert_array_equal(byCcd.table.colnames,
+                       ['visit', 'ccd', 'nDetections', 'offset', 'residualRms'])
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()